@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks for the parsers and formatters of the ss.py script, on synthetic
+inputs far bigger than any real system has: a million sockets, 50k utmp
+records, 5k mounts and so on. Every benchmark records its best time, its
+throughput and the peak memory it allocated (with tracemalloc, or the peak
+RSS of the whole run without it), and is compared against the baseline saved
+with --save. Without a baseline to compare against, nothing passes.
+'''
+
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import random
+import re
+import struct
+import sys
+import time
+import ss
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python < 3.4
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def gen_ssout(n, seed=0):
+    '''
+    Generate 'n' lines of 'ss -utnaps' output, mostly ESTAB with a few
+    LISTEN sockets, with the summary 'ss -s' puts on top.
+    '''
+    r = random.Random(seed)
+    lines = ['Total: {0} (kernel 0)'.format(n),
+             'TCP:   {0} (estab {0}, closed 0, orphaned 0, timewait 0)'.format(
+                 n)] + [''] * 9 + [
+        'Netid State Recv-Q Send-Q Local Address:Port Peer Address:Port']
+    estab = ('tcp    ESTAB      0      0     10.0.{0}.{1}:{2}     '
+             '192.168.{3}.{4}:{5}    users:(("nginx",pid={6},fd={7}))')
+    listen = ('tcp    LISTEN     0      128        0.0.0.0:{0}        '
+              '0.0.0.0:*      users:(("nginx",pid={1},fd={2}))')
+    for i in range(n):
+        if i % 1000:
+            lines.append(estab.format(
+                r.randint(0, 255), r.randint(1, 254), r.choice((80, 443)),
+                r.randint(0, 255), r.randint(1, 254),
+                r.randint(32768, 60999), r.randint(100, 200), i))
+        else:
+            lines.append(listen.format(8000 + i // 1000,
+                                       r.randint(100, 200), i))
+    return lines
+
+
+def gen_utmp(n, seed=0):
+    '''
+    Generate a utmp buffer of 'n' records, mostly logged in users with a boot
+    record every thousand.
+    '''
+    r = random.Random(seed)
+    records = []
+    for i in range(n):
+        if i % 1000:
+            records.append(struct.pack(
+                ss._UTMP_FMT, ss.USER_PROCESS, r.randint(100, 99999),
+                'pts/{0}'.format(i).encode(), b'ts/0',
+                'user{0}'.format(r.randint(0, 999)).encode(),
+                '10.0.{0}.{1}'.format(r.randint(0, 255),
+                                      r.randint(1, 254)).encode(),
+                0, 0, 1500000000 + i, 0, b'', b''))
+        else:
+            records.append(struct.pack(
+                ss._UTMP_FMT, ss.BOOT_TIME, 0, b'~', b'~~', b'reboot',
+                b'4.19.0', 0, 0, 1500000000 + i, 0, b'', b''))
+    return b''.join(records)
+
+
+def gen_mounts(n, seed=0):
+    '''
+    Generate 'n' rows of __get_usage(), with their statvfs, one in a hundred
+    of them stale.
+    '''
+    r = random.Random(seed)
+    rows = []
+    for i in range(n):
+        st = None
+        if i % 100:
+            blocks = r.randint(1 << 10, 1 << 30)
+            files = r.randint(1 << 10, 1 << 24)
+            st = os.statvfs_result((
+                4096, 4096, blocks, r.randint(0, blocks), r.randint(0, blocks),
+                files, r.randint(0, files), 0, 0, 255))
+        rows.append(['/dev/mapper/vg-lv{0}'.format(i), '/srv/{0}'.format(i),
+                     'ext4', 'rw,relatime', '0', '0', st])
+    return rows
+
+
+def gen_meminfo(n, seed=0):
+    '''
+    Generate a /proc/meminfo with the usual fields and 'n' more.
+    '''
+    r = random.Random(seed)
+    lines = ['MemTotal:       16318412 kB', 'MemFree:         3170228 kB',
+             'MemAvailable:   10318988 kB', 'Buffers:          712372 kB',
+             'Cached:          6262008 kB', 'SwapTotal:       8388604 kB',
+             'SwapFree:        8388604 kB', 'HugePages_Total:       0']
+    lines.extend('Node{0}Field:  {1} kB'.format(i, r.randint(0, 1 << 24))
+                 for i in range(n))
+    return '\n'.join(lines) + '\n'
+
+
+def gen_ip(n, seed=0):
+    '''
+    Generate 'ip -o a' output for 'n' interfaces, with an IPv4, a global
+    IPv6 and a link local address each.
+    '''
+    r = random.Random(seed)
+    lines = []
+    for i in range(n):
+        name = 'veth{0}'.format(i)
+        lines.append('{0}: {1}    inet 10.{2}.{3}.{4}/24 brd 10.{2}.{3}.255 '
+                     'scope global {1}\\       valid_lft forever '
+                     'preferred_lft forever'.format(
+                         i, name, r.randint(0, 255), r.randint(0, 255),
+                         r.randint(1, 254)))
+        lines.append('{0}: {1}    inet6 2001:db8::{2:x}/64 scope global '
+                     '\\       valid_lft forever preferred_lft forever'.format(
+                         i, name, i))
+        lines.append('{0}: {1}    inet6 fe80::{2:x}/64 scope link '
+                     '\\       valid_lft forever preferred_lft forever'.format(
+                         i, name, i))
+    return '\n'.join(lines) + '\n'
+
+
+def gen_procs(n, seed=0):
+    '''
+    Generate two samples of 'n' processes, a second apart, as
+    __proc_sample() returns them.
+    '''
+    r = random.Random(seed)
+    prev = {}
+    cur = {}
+    for i in range(n):
+        key = (str(i + 1), r.randint(0, 1 << 20))
+        ticks = r.randint(0, 1 << 20)
+        prev[key] = (b'worker', ticks, 0, 0, 0)
+        cur[key] = (b'worker', ticks + r.randint(0, 100),
+                    r.randint(1 << 10, 1 << 20), r.randint(0, 1 << 10),
+                    r.randint(3, 1 << 12))
+    return prev, cur
+
+
+# An os-release, as parse_release() gets it.
+OS_RELEASE = '''NAME="Debian GNU/Linux"
+VERSION_ID="12"
+VERSION="12 (bookworm)"
+VERSION_CODENAME=bookworm
+ID=debian
+HOME_URL="https://www.debian.org/"
+SUPPORT_URL="https://www.debian.org/support"
+BUG_REPORT_URL="https://bugs.debian.org/"'''.splitlines()
+
+
+def legacy_ss(sslist, header=12):
+    '''
+    The ss.py parsers before _scan_ss(), for comparison: two regex passes
+    for the ESTAB ports and a third pass for the listeners.
+    '''
+    def regex_ss(a, n):
+        return re.match('.+:([^:]*$)', a.split()[n]).groups()[0]
+    ss_ = sslist[header:]
+    nin = ss.Counter(regex_ss(x, 4) for x in ss_
+                     if re.match('^(tcp|udp) +ESTAB', x))
+    nout = ss.Counter(regex_ss(x, 5) for x in ss_
+                      if re.match('^(tcp|udp) +ESTAB', x))
+    listen = [x.split() for x in sslist if re.match('^(tcp|udp) +LISTEN.*', x)]
+    return nin, nout, listen
+
+
+def single_pass(sslist):
+    scan = ss._scan_ss(sslist)
+    return scan.nin, scan.nout, scan.listeners
+
+
+def timeit(f, *args, **kwargs):
+    '''Return the best wall time of a few runs of f(*args)'''
+    repeat = kwargs.get('repeat', 3)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        f(*args)
+        t = time.time() - start
+        best = t if best is None else min(best, t)
+    return best
+
+
+def peak_memory(f, *args):
+    '''
+    Return the peak bytes allocated by a run of f(*args). This is a run of
+    its own, since tracing slows it down. Without tracemalloc it is the peak
+    RSS of the process so far, which is only comparable between runs of the
+    same suite, or None without that either.
+    '''
+    if tracemalloc is None:
+        if resource is None:
+            return None
+        f(*args)
+        # ru_maxrss is in kB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    tracemalloc.start()
+    try:
+        f(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def suite(scale=1.0):
+    '''
+    The benchmarks: a name, the number of items (lines, records, mounts...)
+    it goes through, and a function running it, with its input generated
+    'scale' times as big as the defaults.
+    '''
+    def size(n):
+        return max(1, int(n * scale))
+    sslist = gen_ssout(size(1000000))
+    utmp = gen_utmp(size(50000))
+    mounts = gen_mounts(size(5000))
+    meminfo = gen_meminfo(size(100000))
+    ip = gen_ip(size(20000))
+    releases = size(100000)
+    prev, cur = gen_procs(size(30000))
+    return [
+        ('_parse_ssutn', len(sslist), lambda: ss._parse_ssutn(sslist)),
+        ('format_ssutn', len(sslist), lambda: ss.format_ssutn(sslist)),
+        ('format_ssntlp', len(sslist), lambda: list(ss.format_ssntlp(sslist))),
+        ('format_ssutn approx', len(sslist),
+         lambda: ss.format_ssutn(ss._sketch_ss(sslist))),
+        ('_parse_utmp', len(utmp) // struct.calcsize(ss._UTMP_FMT),
+         lambda: ss._parse_utmp(utmp)),
+        ('format_size', len(mounts), lambda: list(ss.format_size(mounts))),
+        ('format_inodes', len(mounts), lambda: list(ss.format_inodes(mounts))),
+        ('_parse_mem + format_mem', meminfo.count('\n'),
+         lambda: ss.format_mem(ss._parse_mem(meminfo))),
+        ('format_ip_output', ip.count('\n'),
+         lambda: list(ss.format_ip_output(ip))),
+        ('_parse_ip_output', ip.count('\n'),
+         lambda: ss._parse_ip_output(ip)),
+        ('_top_procs', len(cur), lambda: ss._top_procs(prev, cur, 1.0)),
+        ('parse_release', releases,
+         lambda: [ss.parse_release(OS_RELEASE, name='os-release')
+                  for _ in range(releases)]),
+    ]
+
+
+def run_suite(scale=1.0, repeat=3):
+    '''
+    Run the suite(), returning a dict of the benchmark names to their best
+    'time', their 'items' and the 'peak' bytes they allocated.
+    '''
+    results = {}
+    for name, items, f in suite(scale):
+        results[name] = {'items': items, 'time': timeit(f, repeat=repeat),
+                         'peak': peak_memory(f)}
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    '''
+    Compare the results of run_suite() with a baseline of the same scale:
+    for every benchmark in both, the ratios of their times and of their peak
+    memory (None if either doesn't have it), and whether either is more than
+    'tolerance' worse.
+    '''
+    ret = {}
+    for name, r in results.items():
+        b = baseline.get(name)
+        if b is None or b['items'] != r['items']:
+            continue
+        ratio = r['time'] / b['time']
+        mem = None
+        if r.get('peak') is not None and b.get('peak'):
+            mem = r['peak'] / b['peak']
+        ret[name] = (ratio, mem, ratio > 1 + tolerance or
+                     (mem is not None and mem > 1 + tolerance))
+    return ret
+
+
+def bench_ss(n=500000):
+    sslist = gen_ssout(n)
+    # Both have to agree before their times mean anything.
+    old = legacy_ss(sslist)
+    new = single_pass(sslist)
+    assert old[0] == new[0] and old[1] == new[1]
+    assert len(old[2]) == len(new[2])
+    told = timeit(legacy_ss, sslist)
+    tnew = timeit(single_pass, sslist)
+    return [('legacy _parse_ssutn + format_ssntlp', n, told),
+            ('_scan_ss', n, tnew),
+            ('speedup', None, told / tnew)]
+
+
+def __options(args=None):
+    from optparse import OptionParser
+    p = OptionParser(description='Benchmark the parsers of ss.py.')
+    p.add_option('--scale', type='float', default=1.0,
+                 help='scale the size of the inputs, e.g. 0.1 for a quick run')
+    p.add_option('--repeat', type='int', default=3,
+                 help='take the best of this many runs')
+    p.add_option('--baseline', default='bench_baseline.json',
+                 help='the saved results to compare against')
+    p.add_option('--save', action='store_true', default=False,
+                 help='save the results as the new --baseline')
+    p.add_option('--legacy', type='int', metavar='LINES', default=None,
+                 help='also compare _scan_ss with the old regex parsers on '
+                      'LINES lines')
+    return p.parse_args(args)[0]
+
+
+def main(args=None):
+    opts = __options(args)
+    results = run_suite(opts.scale, opts.repeat)
+    try:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        if not opts.save:
+            print('No baseline to compare against in {0} ({1}), make one '
+                  'with --save'.format(opts.baseline, e), file=sys.stderr)
+            return 2
+        baseline = {}
+    ratios = compare(results, baseline)
+    worse = False
+    for name in sorted(results):
+        r = results[name]
+        peak = '{0:>9.1f}MB'.format(r['peak'] / 2 ** 20) \
+            if r['peak'] is not None else '{0:>11}'.format('-')
+        vs = ''
+        if name in ratios:
+            ratio, mem, bad = ratios[name]
+            vs = '{0:>6.2f}x time {1} memory of baseline{2}'.format(
+                ratio, '-' if mem is None else '{0:.2f}x'.format(mem),
+                ' WORSE' if bad else '')
+            worse = worse or bad
+        print('{0:24} {1:>9} {2:>8.3f}s {3:>12.0f}/s {4} {5}'.format(
+            name, r['items'], r['time'], r['items'] / r['time'], peak, vs))
+    if opts.legacy:
+        for name, lines, t in bench_ss(opts.legacy):
+            if lines is None:
+                print('{0:40} {1:>10.2f}x'.format(name, t))
+            else:
+                print('{0:40} {1:>10.3f}s {2:>12.0f} lines/s'.format(
+                    name, t, lines / t))
+    if opts.save:
+        with open(opts.baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    elif len(ratios) < len(results):
+        print('{0} of the benchmarks are not in {1}, or at another --scale'
+              .format(len(results) - len(ratios), opts.baseline),
+              file=sys.stderr)
+        return 2
+    return 1 if worse else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -21,41 +21,94 @@ from __future__ import division
 from __future__ import with_statement
 from __future__ import print_function
 
+import mmap
+from array import array
 import struct
 import time
-import socket
+import binascii
 import re
+import errno
+import heapq
 import os
+import select
+import signal
+import stat
 import sys
-from datetime import timedelta
+import threading
+from collections import namedtuple
+from itertools import chain, islice
+from operator import itemgetter
 
-try:
-    from subprocess import check_output
 
-    def __output(*popenargs, **kwargs):
-        '''Returns the output of a subprocess'''
-        return check_output(*popenargs, **kwargs)
+class _LazyModule(object):
+    '''
+    A module that is only imported once something in it is used, for the
+    ones that take a while to import and that only some of the sections
+    need. It then replaces itself with the module.
+    '''
+    def __init__(self, name):
+        self._name = name
 
-except ImportError:
-    # Python 2.6 also does not have subprocess.check_output, so we're having to
-    # reinvent the wheel on this one, too. Code used from the Python 2.7 module
-    # once again.
-    from subprocess import Popen, PIPE, CalledProcessError
+    def __getattr__(self, attr):
+        module = __import__(self._name)
+        globals()[self._name] = module
+        return getattr(module, attr)
 
-    def __output(*popenargs, **kwargs):
-        '''Returns the output of a subprocess'''
+
+json = _LazyModule('json')
+socket = _LazyModule('socket')
+subprocess = _LazyModule('subprocess')
+tempfile = _LazyModule('tempfile')
+
+
+def __output(*popenargs, **kwargs):
+    '''Returns the output of a subprocess'''
+    __account('subprocesses')
+    try:
+        output = subprocess.check_output(*popenargs, **kwargs)
+    except AttributeError:
+        # Python 2.6 also does not have subprocess.check_output, so we're
+        # having to reinvent the wheel on this one, too. Code used from the
+        # Python 2.7 module once again.
         if 'stdout' in kwargs:
             raise ValueError(
                 'stdout argument not allowed, it will be overridden.')
-        process = Popen(stdout=PIPE, *popenargs, **kwargs)
+        process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs,
+                                   **kwargs)
         output, unused_err = process.communicate()
         retcode = process.poll()
         if retcode:
             cmd = kwargs.get("args")
             if cmd is None:
                 cmd = popenargs[0]
-            raise CalledProcessError(retcode, cmd, output=output)
-        return output
+            raise subprocess.CalledProcessError(retcode, cmd, output=output)
+    __account('bytes', len(output))
+    return output
+
+
+def __account(key, n=1):
+    '''Count 'n' toward 'key' of what the Profiler is measuring, if any'''
+    if _profiler is not None:
+        _profiler.account(key, n)
+
+
+def __stream(*popenargs, **kwargs):
+    '''
+    Yields the output of a subprocess line by line, as it is read from the
+    pipe, instead of buffering all of it like __output() does.
+    '''
+    __account('subprocesses')
+    process = subprocess.Popen(stdout=subprocess.PIPE,
+                               universal_newlines=True, *popenargs, **kwargs)
+    try:
+        for line in process.stdout:
+            __account('bytes', len(line))
+            yield line
+    finally:
+        process.stdout.close()
+        retcode = process.wait()
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, popenargs[0])
 
 
 try:
@@ -193,6 +246,99 @@ class UtmpLengthError(Exception):
     pass
 
 
+class ProbeTimeout(Exception):
+    pass
+
+
+# A single socket, with the fields in the same order as the columns of
+# 'ss -utnaps' so that a record can be indexed just like a split line.
+SsRecord = namedtuple('SsRecord', ['netid', 'state', 'recvq', 'sendq',
+                                   'local', 'peer', 'users'])
+
+# The fields of /proc/<pid>/stat that we use, see proc(5). 'tty' is the
+# device number of the controlling terminal, the times are in clock ticks.
+ProcStat = namedtuple('ProcStat', ['pid', 'comm', 'state', 'ppid', 'pgrp',
+                                   'session', 'tty', 'tpgid', 'utime',
+                                   'stime', 'starttime', 'cmdline'])
+
+# A process in the top processes: its CPU use since the previous sample, in
+# percent of a CPU, its resident and swapped out memory in kB and its number
+# of open files (0 if we can't look).
+ProcUsage = namedtuple('ProcUsage', ['pid', 'comm', 'cpu', 'rss', 'swap',
+                                     'fds'])
+
+# The I/O of a block device between two samples of /proc/diskstats: reads
+# and writes per second, bytes read and written per second, the average
+# time an I/O took in ms and how much of the time it was busy, in percent.
+DiskIO = namedtuple('DiskIO', ['name', 'rps', 'wps', 'rbps', 'wbps', 'wait',
+                               'util'])
+
+# An address of a network interface.
+IpAddr = namedtuple('IpAddr', ['ifname', 'family', 'address', 'prefixlen',
+                               'scope'])
+
+# The login history from _parse_last()
+LoginHistory = namedtuple('LoginHistory', ['since', 'logins', 'reboots',
+                                           'failed'])
+
+# What a Profiler measured of a probe or a section. The times are in
+# seconds, 'peak' is the most bytes allocated at once (None if unknown).
+ProfileStats = namedtuple('ProfileStats', ['wall', 'cpu', 'subprocesses',
+                                           'bytes', 'peak'])
+
+# Everything the ss formatters need, collected in a single pass over the
+# sockets by _scan_ss(). 'states' counts (netid, state) pairs, 'peers' the
+# remote addresses and 'procs' the processes of ESTAB sockets, if they were
+# asked for. 'owners' are the ProcOwners of the listeners, by pid.
+SsScan = namedtuple('SsScan', ['nin', 'nout', 'listeners', 'states',
+                               'peers', 'procs', 'owners'])
+
+# Who a process is: its name, command line, the systemd unit or container
+# scope it runs in, and its start time in clock ticks since boot.
+ProcOwner = namedtuple('ProcOwner', ['name', 'cmdline', 'unit', 'starttime'])
+
+# Socket states from include/net/tcp_states.h, named the way 'ss' names them.
+_SS_STATES = {1: 'ESTAB', 2: 'SYN-SENT', 3: 'SYN-RECV', 4: 'FIN-WAIT-1',
+              5: 'FIN-WAIT-2', 6: 'TIME-WAIT', 7: 'UNCONN', 8: 'CLOSE-WAIT',
+              9: 'LAST-ACK', 10: 'LISTEN', 11: 'CLOSING', 12: 'SYN-RECV'}
+
+# NETLINK_SOCK_DIAG constants from linux/netlink.h and linux/sock_diag.h.
+_NETLINK_SOCK_DIAG = 4
+_SOCK_DIAG_BY_FAMILY = 20
+_NLM_F_REQUEST = 0x1
+_NLM_F_DUMP = 0x300
+_NLMSG_ERROR = 2
+_NLMSG_DONE = 3
+# struct nlmsghdr
+_NLMSG = struct.Struct('=LHHLL')
+# struct inet_diag_req_v2, without the (zeroed) inet_diag_sockid
+_INET_DIAG_REQ = struct.Struct('=BBBxL48x')
+# struct inet_diag_msg, ports are in network order, the rest in host order.
+_INET_DIAG_MSG = struct.Struct('=BBBBHH16s16sL8sLLLLL')
+# Every socket state, up to TCP_NEW_SYN_RECV: the summary counts them all.
+_INET_DIAG_STATES = (1 << 13) - 1
+
+# rtnetlink constants from linux/rtnetlink.h and linux/if_addr.h.
+_NETLINK_ROUTE = 0
+_RTM_NEWADDR = 20
+_RTM_GETADDR = 22
+_IFA_ADDRESS = 1
+_IFA_LOCAL = 2
+_IFA_LABEL = 3
+# struct ifaddrmsg
+_IFADDRMSG = struct.Struct('=BBBBL')
+# struct rtattr
+_RTATTR = struct.Struct('=HH')
+# The rtm_scope of addresses, named the way 'ip' names them.
+_RT_SCOPES = {0: 'global', 200: 'site', 253: 'link', 254: 'host',
+              255: 'nowhere'}
+# The scopes of /proc/net/if_inet6, IPV6_ADDR_* from include/net/ipv6.h
+_IF_INET6_SCOPES = {0: 'global', 0x10: 'host', 0x20: 'link', 0x40: 'site'}
+# ioctls from linux/sockios.h
+_SIOCGIFCONF = 0x8912
+_SIOCGIFNETMASK = 0x891b
+
+
 class bcolors:
     if sys.stdout.isatty():
         GREEN = '\033[1;32m'
@@ -207,30 +353,1001 @@ class bcolors:
 
 
 def __get_file(f, m='r'):
+    if _replay is not None:
+        data = _replay.read(f)
+        return data if 'b' in m else data.decode('utf-8', 'replace')
     with open(f, m) as xf:
-        return xf.read()
+        data = xf.read()
+    __account('bytes', len(data))
+    if _capture is not None:
+        _capture.add(f, data)
+    return data
+
+
+def __file_lines(f):
+    '''
+    The lines of the file 'f' as they are read, rather than all of it at
+    once like __get_file(). Opening it fails right away. The lines are only
+    kept in memory when capturing.
+    '''
+    if _replay is not None:
+        return iter(_replay.read(f).decode('utf-8', 'replace').splitlines(
+            True))
+    return __read_lines(f, open(f))
+
+
+def __read_lines(f, xf):
+    lines = [] if _capture is not None else None
+    try:
+        for line in xf:
+            __account('bytes', len(line))
+            if lines is not None:
+                lines.append(line)
+            yield line
+    finally:
+        xf.close()
+        if lines is not None:
+            _capture.add(f, ''.join(lines))
+
+
+def __map_file(f):
+    '''
+    Map a file into memory, read only, for the parsers that take a buffer.
+    '''
+    if _replay is not None:
+        return _replay.read(f)
+    with open(f, 'rb') as xf:
+        try:
+            data = mmap.mmap(xf.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            data = b''
+    __account('bytes', len(data))
+    if _capture is not None:
+        _capture.add(f, data[:])
+    return data
+
+
+def __exists(f):
+    if _replay is not None:
+        return _replay.exists(f)
+    return os.path.exists(f)
+
+
+def __listdir(d):
+    if _replay is not None:
+        return _replay.listdir(d)
+    return os.listdir(d)
+
+
+class Capture(object):
+    '''
+    Records the raw inputs of the probes while they run: every file they
+    read, under its path, and everything else they get from the system as
+    JSON under .ss.py/. write() puts them in a tar archive that Replay can
+    run the report from.
+    '''
+    def __init__(self):
+        self.members = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        with self.lock:
+            self.members[name.lstrip('/')] = data
+
+    def write(self, out):
+        '''Write the inputs to the tar archive 'out', a path or a file'''
+        import io
+        import tarfile
+        now = time.time()
+        kwargs = {'name': out} if isinstance(out, str) else {'fileobj': out}
+        with self.lock:
+            members = sorted(self.members.items())
+        t = tarfile.open(mode='w', **kwargs)
+        try:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = now
+                t.addfile(info, io.BytesIO(data))
+        finally:
+            t.close()
+
+
+class Replay(object):
+    '''
+    Serves the raw inputs of the probes from 'path': either a tar archive
+    written by Capture, or a directory laid out the same way, like an
+    extracted capture or the root of another system. Inputs that aren't
+    there raise IOError, failing only the probes that need them.
+    '''
+    def __init__(self, path):
+        self.root = None
+        self.members = {}
+        if os.path.isdir(path):
+            self.root = path
+            return
+        import tarfile
+        t = tarfile.open(path)
+        try:
+            for m in t.getmembers():
+                if m.isfile():
+                    self.members[m.name.lstrip('/')] = \
+                        t.extractfile(m).read()
+        finally:
+            t.close()
+
+    def read(self, f):
+        name = f.lstrip('/')
+        if self.root is not None:
+            with open(os.path.join(self.root, name), 'rb') as xf:
+                return xf.read()
+        try:
+            return self.members[name]
+        except KeyError:
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), f)
+
+    def exists(self, f):
+        if self.root is not None:
+            return os.path.exists(os.path.join(self.root, f.lstrip('/')))
+        return f.lstrip('/') in self.members
+
+    def listdir(self, d):
+        if self.root is not None:
+            return os.listdir(os.path.join(self.root, d.lstrip('/')))
+        prefix = d.strip('/') + '/'
+        ret = set(x[len(prefix):].split('/')[0] for x in self.members
+                  if x.startswith(prefix))
+        if not ret:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), d)
+        return sorted(ret)
+
+
+# The Capture recording, or the Replay serving, the inputs of the probes.
+_capture = None
+_replay = None
+
+
+def __recorded(name, f, dump=None, load=None):
+    '''
+    f(), for the inputs that don't come from files. It is recorded as
+    .ss.py/<name>.json when capturing, and read back from there instead when
+    replaying. 'dump' and 'load' turn it into something JSON can take and
+    back.
+    '''
+    path = '/.ss.py/{0}.json'.format(name)
+    if _replay is not None:
+        data = json.loads(_replay.read(path).decode('utf-8'))
+        return load(data) if load else data
+    data = f()
+    if _capture is not None:
+        _capture.add(path, json.dumps(dump(data) if dump else data))
+    return data
+
+
+def __recorded_iter(name, f, dump=None, load=None):
+    '''
+    __recorded() for an f() that yields its data a piece at a time, which is
+    recorded as a list. 'dump' and 'load' are for each piece. The pieces are
+    passed on as they come, and only kept in memory when capturing.
+    '''
+    path = '/.ss.py/{0}.json'.format(name)
+    if _replay is not None:
+        for x in json.loads(_replay.read(path).decode('utf-8')):
+            yield load(x) if load else x
+        return
+    if _capture is None:
+        for x in f():
+            yield x
+        return
+    data = []
+    for x in f():
+        data.append(dump(x) if dump else x)
+        yield x
+    _capture.add(path, json.dumps(data))
+
+
+def __runtime_path(name):
+    '''
+    Where we keep the runtime file 'name': /run for root, and the user's
+    $XDG_RUNTIME_DIR otherwise, with the uid in the name. Without one it is
+    in a directory of our own, /tmp/ss.py-<uid>, which _runtime_dir() makes
+    and checks before anything is kept in it.
+    '''
+    if os.geteuid() == 0:
+        return '/run/ss.py.' + name
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'],
+                            'ss.py-{0}.{1}'.format(os.geteuid(), name))
+    return '/tmp/ss.py-{0}/{1}'.format(os.geteuid(), name)
+
+
+def _runtime_dir(path, create=False):
+    '''
+    Check that no one but us, or root, can put anything in the directory of
+    the runtime file 'path', making it (mode 0700) first if 'create' is set
+    and it isn't there. Raises OSError if it isn't safe.
+    '''
+    d = os.path.dirname(path) or '.'
+    if create:
+        try:
+            os.mkdir(d, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    st = os.lstat(d)
+    if not stat.S_ISDIR(st.st_mode) or \
+            st.st_uid not in (0, os.geteuid()) or st.st_mode & 0o022:
+        raise OSError(errno.EPERM, 'not a private directory', d)
 
 
-def __get_usage():
+class ParseCache(object):
+    '''
+    Keeps what the parsers made of files that rarely change, keyed on the
+    path and the (st_dev, st_ino, st_mtime, st_size) of the file, so a file
+    that was replaced or written to is parsed again. The cache is kept as
+    JSON in 'path' and holds at most 'size' files, evicting the least
+    recently used first. With no 'path' it is only kept in memory.
+
+    The file is only trusted if it is ours, and is written with mode 0600,
+    since it has the logged in users in it.
+    '''
+    version = 1
+
+    def __init__(self, path=None, size=32):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def load(self):
+        '''Read the entries from 'path', if there is a usable cache there'''
+        self.entries = {}
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                if os.fstat(f.fileno()).st_uid != os.geteuid():
+                    return
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if isinstance(cache, dict) and cache.get('version') == self.version:
+            self.entries = cache.get('entries', {})
+
+    def save(self):
+        '''
+        Atomically replace 'path' with the entries. Failing to is not an
+        error, the cache is just not persisted.
+        '''
+        if not self.path:
+            return
+        tmp = None
+        try:
+            _runtime_dir(self.path, create=True)
+            # A new file of our own (mode 0600), never one someone put there.
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                       prefix='.ss.py-cache.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': self.version, 'entries': self.entries},
+                          f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            if tmp is not None:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+
+    def get(self, f, parse, dump=None, load=None):
+        '''
+        What parse(f) returns, from the cache if 'f' hasn't changed since.
+        'dump' turns that into something JSON can store, and 'load' turns it
+        back.
+        '''
+        st = os.stat(f)
+        key = [st.st_dev, st.st_ino, st.st_mtime, st.st_size]
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            entry = self.entries.get(f)
+            if entry is not None and entry['key'] == key:
+                # This is only persisted with the next miss.
+                entry['used'] = time.time()
+                return load(entry['data']) if load else entry['data']
+        # We stat before parsing, so a change in between is only ever seen
+        # as a miss the next time.
+        data = parse(f)
+        with self.lock:
+            self.entries[f] = {'key': key, 'used': time.time(),
+                               'data': dump(data) if dump else data}
+            for x in sorted(self.entries,
+                            key=lambda x: self.entries[x]['used'])[
+                                :max(0, len(self.entries) - self.size)]:
+                del self.entries[x]
+            self.save()
+        return data
+
+
+_parse_cache = ParseCache(__runtime_path('cache'))
+
+
+def __parsed(f, parse, cache=None, **kwargs):
+    '''
+    parse(f) through the ParseCache 'cache', but when capturing or
+    replaying, when the file has to be read.
+    '''
+    if _capture is not None or _replay is not None:
+        return parse(f)
+    return (cache or _parse_cache).get(f, parse, **kwargs)
+
+
+class ProcCache(object):
+    '''
+    Keeps the ProcOwners of processes by their pid, so the same listeners
+    are not looked up in /proc again on every report. An entry is only used
+    while the process with that pid has the same start time, so a pid that
+    was reused is looked up again. Holds at most 'size' processes, evicting
+    the least recently used first.
+    '''
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, pid, starttime, read):
+        '''
+        The ProcOwner of 'pid' if it still has the same 'starttime', and
+        read() otherwise.
+        '''
+        with self.lock:
+            entry = self.entries.get(pid)
+            if entry is not None and entry[0].starttime == starttime:
+                entry[1] = time.time()
+                return entry[0]
+        owner = read()
+        with self.lock:
+            self.entries[pid] = [owner, time.time()]
+            for x in sorted(self.entries, key=lambda x: self.entries[x][1])[
+                    :max(0, len(self.entries) - self.size)]:
+                del self.entries[x]
+        return owner
+
+
+_proc_cache = ProcCache()
+
+
+def _parse_mountinfo(mountinfo):
+    '''
+    Parse /proc/self/mountinfo into a dict of each mountpoint to the
+    'major:minor' of the filesystem mounted on it. Mountpoints are escaped
+    the same way they are in /proc/self/mounts.
+    '''
+    ret = {}
+    for line in mountinfo.splitlines():
+        f = line.split()
+        if len(f) > 4:
+            ret[f[4]] = f[2]
+    return ret
+
+
+# Run by the __statvfs() workers: statvfs every (escaped) path read from
+# stdin and write the numbers, or 'E errno', to stdout.
+_STATVFS_WORKER = r'''
+import os, re, sys
+def unescape(m):
+    return chr(int(m.group(1), 8))
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    try:
+        st = os.statvfs(re.sub(r'\\([0-7]{3})', unescape, line.strip()))
+        out = ' '.join(str(x) for x in st)
+    except OSError as e:
+        out = 'E {0}'.format(e.errno)
+    sys.stdout.write(out + '\n')
+    sys.stdout.flush()
+'''
+
+
+# The __statvfs() workers that hung on a stale mount, by its path. They are
+# killed, but don't go away until the statvfs returns.
+_hung_workers = {}
+
+
+def __statvfs(paths, timeout=2, workers=4):
+    '''
+    statvfs every path in a small pool of disposable worker processes.
+    Returns a dict of each path to its statvfs_result, or to None if the
+    mount is stale: the call didn't return within 'timeout' seconds. Paths
+    that statvfs fails on are left out.
+
+    A statvfs on a dead NFS, FUSE or iSCSI mount sleeps uninterruptibly, so
+    it can't be done in our own process, not even on a thread. The worker it
+    hangs is killed and kept in _hung_workers, and a new one takes over its
+    queue. Until that worker is gone the path is stale without trying it
+    again, so a dead mount only ever holds up one of them.
+    '''
+    results = {}
+    for path, w in list(_hung_workers.items()):
+        if w.poll() is not None:
+            del _hung_workers[path]
+    for path in paths:
+        if path in _hung_workers:
+            results[path] = None
+    pending = [x for x in reversed(paths) if x not in _hung_workers]
+    idle = []
+    # stdout fd of the worker -> (worker, path, start time)
+    busy = {}
+    try:
+        while pending or busy:
+            while pending and len(busy) < workers:
+                if idle:
+                    w = idle.pop()
+                else:
+                    __account('subprocesses')
+                    w = subprocess.Popen(
+                        [sys.executable, '-c', _STATVFS_WORKER],
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        universal_newlines=True)
+                path = pending.pop()
+                w.stdin.write(path + '\n')
+                w.stdin.flush()
+                busy[w.stdout.fileno()] = (w, path, time.time())
+            wait = min(x[2] for x in busy.values()) + timeout - time.time()
+            for fd in select.select(list(busy), [], [], max(0, wait))[0]:
+                w, path, _ = busy.pop(fd)
+                out = w.stdout.readline().split()
+                if not out:
+                    # The worker died on us
+                    continue
+                if out[0] != 'E':
+                    results[path] = os.statvfs_result(
+                        [int(x) for x in out])
+                idle.append(w)
+            now = time.time()
+            for fd, (w, path, start) in list(busy.items()):
+                if now - start >= timeout:
+                    del busy[fd]
+                    results[path] = None
+                    w.kill()
+                    w.stdin.close()
+                    w.stdout.close()
+                    _hung_workers[path] = w
+    finally:
+        for w in idle + [x[0] for x in busy.values()]:
+            w.stdin.close()
+    return results
+
+
+def __get_mounts():
+    '''
+    The mounted /dev filesystems, and a dict of each mountpoint to the
+    major:minor of its device.
+    '''
     mounts = __get_file('/proc/self/mounts').splitlines()
-    mounts = (a.split() for a in mounts if a.startswith('/dev'))
+    mounts = [a.split() for a in mounts if a.startswith('/dev')]
+    try:
+        devices = _parse_mountinfo(__get_file('/proc/self/mountinfo'))
+    except (IOError, OSError):
+        devices = {}
+    return mounts, devices
+
+
+def __get_usage(timeout=2, mounts=None):
+    '''
+    The mounted /dev filesystems and their statvfs, which is None for stale
+    mounts. Bind mounts and other mounts of the same device are only queried
+    once. 'mounts' is the output of __get_mounts(), which is read if not
+    given.
+    '''
+    mounts, devices = mounts or __get_mounts()
+    # The first mountpoint of every device is the one we statvfs.
+    paths = {}
+    for i in mounts:
+        paths.setdefault(devices.get(i[1], i[0]), i[1])
+    st = __recorded(
+        'statvfs', lambda: __statvfs(list(paths.values()), timeout=timeout),
+        dump=lambda st: dict((k, _jsonable(v)) for k, v in st.items()),
+        load=lambda st: dict(
+            (k, v and os.statvfs_result([v[x] for x in _STATVFS_FIELDS]))
+            for k, v in st.items()))
     newmounts = []
     for i in mounts:
-        i.append(os.statvfs(i[1]))
-        newmounts.append(i)
+        path = paths[devices.get(i[1], i[0])]
+        if path in st:
+            newmounts.append(i + [st[path]])
     return(newmounts)
 
 
-def __ss():
+def __socket_owners(proc='/proc'):
+    '''
+    Walk /proc/*/fd once and map every socket inode to the 'users:((...))'
+    string that 'ss -p' would print for it. Processes we are not allowed to
+    look at, or that exit while we are looking, are skipped.
+    '''
+    owners = {}
+    for pid in os.listdir(proc):
+        if not pid.isdigit():
+            continue
+        fddir = os.path.join(proc, pid, 'fd')
+        try:
+            fds = os.listdir(fddir)
+        except OSError:
+            continue
+        name = None
+        for fd in fds:
+            try:
+                link = os.readlink(os.path.join(fddir, fd))
+            except OSError:
+                continue
+            if not link.startswith('socket:['):
+                continue
+            if name is None:
+                try:
+                    name = __get_file(os.path.join(proc, pid, 'comm')).strip()
+                except (IOError, OSError):
+                    break
+            owners.setdefault(link[8:-1], []).append(
+                '("{0}",pid={1},fd={2})'.format(name, pid, fd))
+    return dict((k, 'users:({0})'.format(','.join(v)))
+                for k, v in owners.items())
+
+
+def __ss_owners(proc='/proc'):
+    '''
+    __socket_owners(), recorded. Replaying the root of another system,
+    which has no recording of them, the sockets have no owners.
+    '''
+    try:
+        return __recorded('socket_owners', lambda: __socket_owners(proc))
+    except (IOError, OSError):
+        if _replay is None:
+            raise
+        return {}
+
+
+# The processes in the 'users:((...))' of a socket: each of them whole, and
+# its name, pid and fd.
+_SS_USERS = re.compile(r'\(("(.*?)",pid=(\d+),fd=(\d+))\)')
+
+
+def _parse_users(users):
+    '''
+    Parse the 'users:(("name",pid=1,fd=2),...)' of a socket into a list of
+    (name, pid, fd) tuples of strings.
+    '''
+    if not users:
+        return []
+    return [x[1:] for x in _SS_USERS.findall(users)]
+
+
+def _parse_cgroup(cgroup):
+    '''
+    The systemd unit, or the container scope, that a process runs in from
+    its /proc/<pid>/cgroup: the last .service or .scope in its path, or the
+    last part of the path if there is neither. None for the root cgroup.
+    '''
+    path = ''
+    for line in cgroup.splitlines():
+        # The unified hierarchy, or else the first one that systemd names.
+        hid, _, rest = line.partition(':')
+        controllers, _, p = rest.partition(':')
+        if hid == '0' or not path:
+            path = p
+    parts = [x for x in path.split('/') if x]
+    for x in reversed(parts):
+        if x.endswith('.service') or x.endswith('.scope'):
+            return x
+    return parts[-1] if parts else None
+
+
+def __owners(pids, cache=None, proc='/proc'):
+    '''
+    Look up the ProcOwner of each of the 'pids', through the ProcCache
+    'cache'. Only /proc/<pid>/stat is read for the processes we have seen
+    before. Processes that are gone, or that we can't look at, are left out.
+    '''
+    cache = cache or _proc_cache
+    owners = {}
+    for pid in set(pids):
+        path = os.path.join(proc, pid)
+        try:
+            st = _parse_proc_stat(__get_file(os.path.join(path, 'stat')))
+            owners[pid] = cache.get(
+                pid, st.starttime, lambda: __read_owner(path, st))
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+    return owners
+
+
+def __read_owner(path, st):
+    cmdline = __get_file(os.path.join(path, 'cmdline'), 'rb')
+    try:
+        unit = _parse_cgroup(__get_file(os.path.join(path, 'cgroup')))
+    except (IOError, OSError):
+        unit = None
+    return ProcOwner(st.comm, cmdline.decode('utf-8', 'replace').replace(
+        '\x00', ' ').strip(), unit, st.starttime)
+
+
+def __format_addr(family, packed, port):
+    '''
+    Format a network order address and a port the way 'ss -n' does.
+    '''
+    if family == socket.AF_INET:
+        host = socket.inet_ntop(family, packed[:4])
+    else:
+        host = '[{0}]'.format(socket.inet_ntop(family, packed))
+    return '{0}:{1}'.format(host, port if port else '*')
+
+
+def __proc_net_addr(addr, family):
+    '''
+    Turn a '0100007F:80F1' style /proc/net address into '127.0.0.1:33009'.
+    The kernel prints each 32 bit word of the address in host byte order, so
+    packing it back with the native order gives us the network order bytes.
+    '''
+    host, port = addr.split(':')
+    if family == socket.AF_INET:
+        packed = struct.pack('=I', int(host, 16))
+    else:
+        packed = struct.pack(
+            '=4I', *[int(host[i:i + 8], 16) for i in range(0, 32, 8)])
+    return __format_addr(family, packed, int(port, 16))
+
+
+def _parse_proc_net(net, netid, family=None, owners=None):
+    '''
+    Parse the contents of /proc/net/{tcp,tcp6,udp,udp6} into SsRecord
+    tuples. 'family' is that of the addresses, AF_INET by default, and
+    'owners' the inode map from __socket_owners(), if any.
+
+    The kernel does not export the backlog of listening sockets here, so the
+    Send-Q of a LISTEN socket is always 0, unlike what 'ss' shows.
+    '''
+    return list(_iter_proc_net(net.splitlines(), netid, family, owners))
+
+
+# How many addresses _iter_proc_net() keeps converted at most.
+_PROC_NET_ADDRS = 4096
+
+
+def _iter_proc_net(lines, netid, family=None, owners=None):
+    '''
+    _parse_proc_net() for an iterable of the lines of the file, header and
+    all, yielding the SsRecords one at a time.
+    '''
+    family = family or socket.AF_INET
+    owners = owners or {}
+    # Many sockets share their local address, so only convert each once.
+    addrs = {}
+    for line in islice(lines, 1, None):
+        f = line.split()
+        if len(f) < 10:
+            continue
+        if len(addrs) > _PROC_NET_ADDRS:
+            addrs.clear()
+        for a in f[1:3]:
+            if a not in addrs:
+                addrs[a] = __proc_net_addr(a, family)
+        tx, rx = f[4].split(':')
+        yield SsRecord(netid, _SS_STATES.get(int(f[3], 16), 'UNKNOWN'),
+                       str(int(rx, 16)), str(int(tx, 16)),
+                       addrs[f[1]], addrs[f[2]], owners.get(f[9], ''))
+
+
+def __proc_net_ss(proc='/proc'):
+    '''
+    Collect the same sockets as 'ss -utnaps' straight from /proc/net without
+    forking anything, yielding them as the files are read. IPv6 files are
+    optional, the IPv4 ones are not.
+    '''
+    owners = __ss_owners(proc)
+    for f, netid, family, required in (
+            ('udp', 'udp', socket.AF_INET, True),
+            ('udp6', 'udp', socket.AF_INET6, False),
+            ('tcp', 'tcp', socket.AF_INET, True),
+            ('tcp6', 'tcp', socket.AF_INET6, False)):
+        try:
+            lines = __file_lines(os.path.join(proc, 'net', f))
+        except (IOError, OSError):
+            if required:
+                raise
+            continue
+        for x in _iter_proc_net(lines, netid, family, owners):
+            yield x
+
+
+def _parse_inet_diag(buf, netid, owners=None):
+    '''
+    Parse a buffer of NETLINK_SOCK_DIAG replies into SsRecord tuples.
+    Returns a tuple of (records, done), where done is True once the
+    NLMSG_DONE message that ends the dump has been seen.
+
+    Unlike /proc/net, the kernel fills in the backlog of listening sockets,
+    so Recv-Q and Send-Q match what 'ss' shows.
+    '''
+    owners = owners or {}
+    ret = []
+    offset = 0
+    while offset + _NLMSG.size <= len(buf):
+        length, mtype = _NLMSG.unpack_from(buf, offset)[:2]
+        if mtype == _NLMSG_DONE:
+            return ret, True
+        elif mtype == _NLMSG_ERROR:
+            err = -struct.unpack_from('=i', buf, offset + _NLMSG.size)[0]
+            raise socket.error(err, os.strerror(err))
+        (family, state, _, _, sport, dport, src, dst, _, _, _,
+         rqueue, wqueue, _, inode) = _INET_DIAG_MSG.unpack_from(
+             buf, offset + _NLMSG.size)
+        ret.append(SsRecord(
+            netid, _SS_STATES.get(state, 'UNKNOWN'), str(rqueue), str(wqueue),
+            __format_addr(family, src, socket.ntohs(sport)),
+            __format_addr(family, dst, socket.ntohs(dport)),
+            owners.get(str(inode), '')))
+        if not length:
+            break
+        # Messages are aligned on 4 bytes.
+        offset += (length + 3) & ~3
+    return ret, False
+
+
+def _nlmsg_done(buf):
+    '''
+    Whether the netlink messages in 'buf' end a dump: with NLMSG_DONE, or
+    with the NLMSG_ERROR that the kernel sends instead when it fails.
+    '''
+    offset = 0
+    while offset + _NLMSG.size <= len(buf):
+        length, mtype = _NLMSG.unpack_from(buf, offset)[:2]
+        if mtype in (_NLMSG_DONE, _NLMSG_ERROR):
+            return True
+        if not length:
+            break
+        offset += (length + 3) & ~3
+    return False
+
+
+def __inet_diag(states):
+    '''
+    The raw NETLINK_SOCK_DIAG replies to a dump of the tcp and udp sockets,
+    yielded as (netid, buffer) tuples as they are read.
+    '''
+    nl = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_SOCK_DIAG)
+    try:
+        for seq, (netid, family, proto) in enumerate((
+                ('udp', socket.AF_INET, socket.IPPROTO_UDP),
+                ('udp', socket.AF_INET6, socket.IPPROTO_UDP),
+                ('tcp', socket.AF_INET, socket.IPPROTO_TCP),
+                ('tcp', socket.AF_INET6, socket.IPPROTO_TCP))):
+            req = _INET_DIAG_REQ.pack(family, proto, 0, states)
+            nl.send(_NLMSG.pack(_NLMSG.size + len(req), _SOCK_DIAG_BY_FAMILY,
+                                _NLM_F_REQUEST | _NLM_F_DUMP, seq + 1, 0) +
+                    req)
+            done = False
+            while not done:
+                buf = nl.recv(65536)
+                __account('bytes', len(buf))
+                yield netid, buf
+                done = _nlmsg_done(buf)
+    finally:
+        nl.close()
+
+
+def __netlink_ss(states=_INET_DIAG_STATES):
+    '''
+    Dump the tcp and udp sockets over NETLINK_SOCK_DIAG. The kernel does the
+    filtering on 'states', a mask of 1 << state, which is all of them by
+    default, like /proc/net and 'ss -a' have. The sockets are yielded a
+    reply at a time. The replies are recorded as they are, and parsed again
+    on replay.
+    '''
+    owners = __ss_owners()
+    for netid, buf in __recorded_iter(
+            'inet_diag', lambda: __inet_diag(states),
+            dump=lambda x: [x[0], binascii.hexlify(x[1]).decode('ascii')],
+            load=lambda x: (x[0], binascii.unhexlify(x[1]))):
+        for x in _parse_inet_diag(buf, netid, owners)[0]:
+            yield x
+
+
+# The socket backends __ss() tries, in order.
+_SS_BACKENDS = ('netlink', 'proc', 'ss')
+
+
+def __ss(backends=_SS_BACKENDS):
+    '''
+    Get the sockets used by the functions below, as an iterator that reads
+    them as it goes. By default they are dumped over netlink, or read from
+    /proc/net, as SsRecord tuples. If neither of those work we fall back to
+    the lines of 'ss -utnaps'.
+
+    A backend that fails before its first socket is given up on for the
+    next one; a failure after that fails the scan.
+    '''
+    for backend in backends:
+        if backend == 'netlink':
+            sockets = __netlink_ss()
+        elif backend == 'proc':
+            sockets = __proc_net_ss()
+        else:
+            continue
+        try:
+            first = next(sockets)
+        except StopIteration:
+            return iter([])
+        except (IOError, OSError, AttributeError):
+            # AttributeError: no socket.AF_NETLINK outside of linux
+            continue
+        return chain([first], sockets)
+    return __recorded_iter('ss_output', lambda: __stream(['ss', '-utnaps']))
+
+
+def _parse_rtm_addr(buf, names=None):
+    '''
+    Parse a buffer of rtnetlink RTM_NEWADDR messages into IpAddrs. 'names'
+    maps the interface indexes to their names; the IFA_LABEL of the address
+    is used for those that aren't in it. Returns a tuple of (addrs, done),
+    like _parse_inet_diag().
+    '''
+    names = names or {}
+    ret = []
+    offset = 0
+    while offset + _NLMSG.size <= len(buf):
+        length, mtype = _NLMSG.unpack_from(buf, offset)[:2]
+        if mtype == _NLMSG_DONE:
+            return ret, True
+        elif mtype == _NLMSG_ERROR:
+            err = -struct.unpack_from('=i', buf, offset + _NLMSG.size)[0]
+            raise socket.error(err, os.strerror(err))
+        elif mtype == _RTM_NEWADDR:
+            family, prefixlen, _, scope, index = _IFADDRMSG.unpack_from(
+                buf, offset + _NLMSG.size)
+            attrs = {}
+            a = offset + _NLMSG.size + _IFADDRMSG.size
+            while a + _RTATTR.size <= offset + length:
+                alen, atype = _RTATTR.unpack_from(buf, a)
+                if alen < _RTATTR.size:
+                    break
+                attrs[atype] = buf[a + _RTATTR.size:a + alen]
+                a += (alen + 3) & ~3
+            # IFA_ADDRESS is the peer of point to point links.
+            address = attrs.get(_IFA_LOCAL, attrs.get(_IFA_ADDRESS))
+            if address is not None and \
+                    family in (socket.AF_INET, socket.AF_INET6):
+                label = attrs.get(_IFA_LABEL, b'').rstrip(b'\x00').decode()
+                ret.append(IpAddr(
+                    names.get(index) or label or str(index),
+                    'inet' if family == socket.AF_INET else 'inet6',
+                    socket.inet_ntop(family, address), prefixlen,
+                    _RT_SCOPES.get(scope, str(scope))))
+        if not length:
+            break
+        offset += (length + 3) & ~3
+    return ret, False
+
+
+def __netlink_addrs():
+    '''
+    Dump the addresses of every interface with an rtnetlink RTM_GETADDR.
+    '''
+    nl = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_ROUTE)
+    try:
+        names = dict(socket.if_nameindex())
+    except (AttributeError, OSError):
+        # Python < 3.3
+        names = {}
+    ret = []
+    try:
+        req = _IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        nl.send(_NLMSG.pack(_NLMSG.size + len(req), _RTM_GETADDR,
+                            _NLM_F_REQUEST | _NLM_F_DUMP, 1, 0) + req)
+        done = False
+        while not done:
+            buf = nl.recv(65536)
+            __account('bytes', len(buf))
+            addrs, done = _parse_rtm_addr(buf, names)
+            ret.extend(addrs)
+    finally:
+        nl.close()
+    return ret
+
+
+def _parse_if_inet6(if_inet6):
+    '''
+    Parse /proc/net/if_inet6 into IpAddrs.
+    '''
+    ret = []
+    for line in if_inet6.splitlines():
+        f = line.split()
+        if len(f) < 6:
+            continue
+        ret.append(IpAddr(
+            f[5], 'inet6',
+            socket.inet_ntop(socket.AF_INET6, binascii.unhexlify(f[0])),
+            int(f[2], 16), _IF_INET6_SCOPES.get(int(f[3], 16), f[3])))
+    return ret
+
+
+def __ioctl_addrs(n=128):
+    '''
+    The IPv4 addresses of (up to 'n') interfaces, from the SIOCGIFCONF
+    ioctl and a SIOCGIFNETMASK for each. There is no scope in those, so
+    127/8 is 'host' and everything else 'global'.
+    '''
+    import array
+    import fcntl
+    # sizeof(struct ifreq): the name and a union as big as struct ifmap.
+    size = 40 if struct.calcsize('P') == 8 else 32
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    ret = []
+    try:
+        buf = array.array('B', b'\x00' * (n * size))
+        length = struct.unpack('iP', fcntl.ioctl(
+            s.fileno(), _SIOCGIFCONF,
+            struct.pack('iP', len(buf), buf.buffer_info()[0])))[0]
+        try:
+            buf = buf.tobytes()[:length]
+        except AttributeError:
+            # Python 2
+            buf = buf.tostring()[:length]
+        for offset in range(0, length, size):
+            name = buf[offset:offset + 16].split(b'\x00')[0]
+            # The struct sockaddr_in after the name
+            address = buf[offset + 20:offset + 24]
+            mask = fcntl.ioctl(s.fileno(), _SIOCGIFNETMASK,
+                               struct.pack('{0}s'.format(size), name))
+            prefixlen = bin(struct.unpack('!L', mask[20:24])[0]).count('1')
+            ret.append(IpAddr(
+                name.decode(), 'inet',
+                socket.inet_ntop(socket.AF_INET, address), prefixlen,
+                'host' if address[:1] == b'\x7f' else 'global'))
+    finally:
+        s.close()
+    return ret
+
+
+def __proc_addrs():
     '''
-    Get the output of 'ss -utnapss', all of the output used by the functions
-    below.
+    The addresses of the interfaces without netlink: IPv4 from ioctls and
+    IPv6 from /proc/net/if_inet6, which is missing without IPv6.
     '''
-    return __output(['ss', '-utnaps'], universal_newlines=True).splitlines()
+    try:
+        inet6 = _parse_if_inet6(__get_file('/proc/net/if_inet6'))
+    except (IOError, OSError):
+        inet6 = []
+    return __ioctl_addrs() + inet6
+
 
+# The interface address backends __ip() tries, in order.
+_IP_BACKENDS = ('netlink', 'proc', 'ip')
 
-def __ip(ip='/sbin/ip'):
-    return __output([ip, '-o', 'a'], universal_newlines=True)
+
+def __ip(backends=_IP_BACKENDS, ip='/sbin/ip'):
+    '''
+    The addresses of the interfaces, as IpAddrs from rtnetlink, or from
+    ioctls and /proc/net/if_inet6 without netlink, so iproute2 isn't needed.
+    If neither work we fall back to the output of 'ip -o a'.
+    '''
+    def addrs():
+        for backend in backends:
+            try:
+                if backend == 'netlink':
+                    return __netlink_addrs()
+                elif backend == 'proc':
+                    return __proc_addrs()
+            except (IOError, OSError, AttributeError):
+                # AttributeError: no socket.AF_NETLINK outside of linux
+                continue
+        return __output([ip, '-o', 'a'], universal_newlines=True)
+    return __recorded(
+        'ip', addrs, dump=_jsonable,
+        load=lambda x: [IpAddr(**a) for a in x] if isinstance(x, list) else x)
 
 
 def __tohuman(n):
@@ -262,10 +1379,26 @@ def __get_color(u, t):
     return col, percent
 
 
+def __parse_stale(x):
+    '''
+    The row of a stale mount, for _parse_size and _parse_inodes.
+    '''
+    return {
+        'color': bcolors.RED,
+        'dev': x[0],
+        'size': '-',
+        'used': '-',
+        'avail': '-',
+        'percent': 'stale',
+        'mountpoint': x[1]}
+
+
 def _parse_size(x):
     '''
     set colors, as well as more human-readable sizes.
     '''
+    if x[6] is None:
+        return __parse_stale(x)
     bsize = x[6].f_bsize
     totalsize = x[6].f_blocks * bsize
     bfree = x[6].f_bfree * bsize
@@ -291,6 +1424,8 @@ def _parse_inodes(x):
     '''
     set colors, as well as more human-readable sizes.
     '''
+    if x[6] is None:
+        return __parse_stale(x)
     files = x[6].f_files
     ffree = x[6].f_ffree
     used = files - ffree
@@ -391,12 +1526,120 @@ def format_inodes(disklist):
     return ret
 
 
+def _parse_diskstats(diskstats):
+    '''
+    Parse /proc/diskstats into a dict of the 'major:minor' of every device
+    to its name and its reads, sectors read, ms spent reading, writes,
+    sectors written, ms spent writing and ms spent doing I/O.
+    '''
+    ret = {}
+    for line in diskstats.splitlines():
+        f = line.split()
+        if len(f) < 14:
+            continue
+        ret['{0}:{1}'.format(f[0], f[1])] = (
+            f[2], int(f[3]), int(f[5]), int(f[6]), int(f[7]), int(f[9]),
+            int(f[10]), int(f[12]))
+    return ret
+
+
+def _disk_io(prev, cur, dt):
+    '''
+    The DiskIO of every device between two _parse_diskstats() 'dt' seconds
+    apart, by its 'major:minor'. Devices that weren't in 'prev' are left
+    out. A sector is always 512 bytes here.
+    '''
+    ret = {}
+    if dt <= 0:
+        return ret
+    for dev, c in cur.items():
+        p = prev.get(dev)
+        if p is None:
+            continue
+        reads, writes = c[1] - p[1], c[4] - p[4]
+        ios = reads + writes
+        ret[dev] = DiskIO(
+            c[0], reads / dt, writes / dt, (c[2] - p[2]) * 512 / dt,
+            (c[5] - p[5]) * 512 / dt,
+            (c[3] - p[3] + c[6] - p[6]) / ios if ios else 0.0,
+            min(100.0, (c[7] - p[7]) / (dt * 10)))
+    return ret
+
+
+def __disk_io():
+    '''
+    The _disk_io() since the previous call if it was in the last minute, or
+    over a quarter of a second otherwise, and a dict of every mountpoint to
+    the 'major:minor' of its device, to join them with __get_usage().
+    '''
+    def io():
+        prev, cur, dt = __sampled(
+            'io', lambda: _parse_diskstats(__get_file('/proc/diskstats')))
+        return _disk_io(prev, cur, dt)
+    try:
+        devices = _parse_mountinfo(__get_file('/proc/self/mountinfo'))
+    except (IOError, OSError):
+        devices = {}
+    return __recorded('io', io, dump=_jsonable, load=lambda io: dict(
+        (k, DiskIO(**v)) for k, v in io.items())), devices
+
+
+def format_io(usage, io):
+    '''
+    The I/O of the device of every mount in 'usage', from __get_usage(),
+    next to how full it is: reads and writes per second, bytes read and
+    written per second, the average time an I/O took and how busy the device
+    was. 'io' is what __disk_io() returns. The rows are colored by how busy
+    the device was, like the disk usage is.
+    '''
+    disks, devices = io
+    # Without a mountinfo, going by the name of the device.
+    names = dict((d.name, d) for d in disks.values())
+    width = max([len(x[0]) for x in usage] + [len('Filesystem')]) + 2
+    row = '{0}{1:<{w}}{2:>5}{3:>7}{4:>7}{5:>8}{6:>8}{7:>8}{8:>6} {9}{c}'
+    ret = [row.format('', 'Filesystem', 'Use%', 'r/s', 'w/s', 'read/s',
+                      'write/s', 'await', 'util', 'Mounted on', w=width,
+                      c='')]
+    for x in usage:
+        d = disks.get(devices.get(x[1])) or names.get(
+            os.path.basename(x[0]))
+        if d is None:
+            continue
+        st = x[6]
+        percent = '-' if st is None else '{0:.0f}%'.format(
+            __get_color(st.f_blocks - st.f_bfree, st.f_blocks)[1])
+        col = __get_color(d.util, 100)[0]
+        ret.append(row.format(
+            col, x[0], percent, '{0:.0f}'.format(d.rps),
+            '{0:.0f}'.format(d.wps), __tohuman(d.rbps), __tohuman(d.wbps),
+            '{0:.1f}ms'.format(d.wait), '{0:.0f}%'.format(d.util), x[1],
+            w=width, c=bcolors.S if col else ''))
+    return ret
+
+
+def _parse_ip_output(ip):
+    '''
+    Parse the output of 'ip -o a' into a list of IpAddrs.
+    '''
+    ret = []
+    for line in ip.splitlines():
+        f = line.split()
+        if len(f) < 4 or f[2] not in ('inet', 'inet6'):
+            continue
+        address, _, prefixlen = f[3].partition('/')
+        scope = f[f.index('scope') + 1] if 'scope' in f else ''
+        ret.append(IpAddr(f[1], f[2], address, int(prefixlen or 0), scope))
+    return ret
+
+
 def format_ip_output(ip):
     '''
-    Gets the sbin/ip command. On systems where the binary does not reside in
-    /sbin/ip, it is almost always available via a symbolic link of /sbin
-    /usr/bin.
+    Format the global addresses of the interfaces, from a list of IpAddrs or
+    the output of 'ip -o a'.
     '''
+    if isinstance(ip, list):
+        return ('{0:8}{1}'.format(x.ifname, x.address) for x in ip
+                if x.scope == 'global')
     # Grabs either 1 or 2 lines (usually) per interface: one for ipv4 (has a
     # number at the end) and an ipv6 address (has 'global ' at the end).
     rawips = ip.splitlines()
@@ -416,25 +1659,139 @@ def __strip(x, y='\x00', ign='addr'):
         return x[0], x[1]
 
 
-def _parse_utmp(utmp,
-                _fmt="hi32s4s32s256sii2i16s20s",
-                _fieldnames=["type", "PID", "Line", "ID", "User",
-                             "Hostname", "exit_status", "session",
-                             "time_s", "time_ms", "addr", "unused"],
-                _force=False,
-                _clean=True):
+_UTMP_FMT = "hi32s4s32s256sii2i16s20s"
+_UTMP_FIELDS = ["type", "PID", "Line", "ID", "User", "Hostname",
+                "exit_status", "session", "time_s", "time_ms", "addr",
+                "unused"]
+# ut_types from utmp.h
+BOOT_TIME = 2
+LOGIN_PROCESS = 6
+USER_PROCESS = 7
+
+
+class UtmpRecord(object):
     '''
-    Parse the UTMP file.
-    This is mostly a test to see that it could be done, and how to do it, so
-    use at your own risk. _fmt is set up for linux systems, but can be
-    overridden.
+    A single record of a utmp buffer. Nothing is unpacked until a field is
+    accessed, and strings are only decoded (and stripped of '\x00') when they
+    are asked for. Fields are accessed like a dict, so a record can be used
+    anywhere the dicts from _parse_utmp() are.
+    '''
+    __slots__ = ('_buf', '_offset', '_struct', '_index', '_values')
+
+    def __init__(self, buf, offset, _struct, _index):
+        self._buf = buf
+        self._offset = offset
+        self._struct = _struct
+        self._index = _index
+        self._values = None
+
+    def raw(self, name):
+        '''Get a field without decoding it'''
+        if self._values is None:
+            self._values = self._struct.unpack_from(self._buf, self._offset)
+        return self._values[self._index[name]]
+
+    def __getitem__(self, name):
+        v = self.raw(name)
+        if isinstance(v, bytes) and name != 'addr':
+            try:
+                return v.decode().strip('\x00')
+            except UnicodeDecodeError:
+                pass
+        return v
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
 
-    The specific format is outlined below.
+    def keys(self):
+        return sorted(self._index, key=self._index.get)
 
-    Arguments:
-        utmp -- The utmp bytes to read.
-        _fmt -- "hi32s4s32s256sii2i16s20s"
-                 ||  | |  |   ||| | |  ^ 20 empty bits that are reserved for
+    def tobytes(self):
+        '''The record as it is in the buffer'''
+        return bytes(self._buf[self._offset:self._offset + self._struct.size])
+
+    def asdict(self, clean=True):
+        '''The same dict _parse_utmp() returns for this record'''
+        if clean:
+            return dict((x, self[x]) for x in self._index)
+        return dict((x, self.raw(x)) for x in self._index)
+
+    def __repr__(self):
+        return 'UtmpRecord({0!r})'.format(self.asdict())
+
+
+def _parse_utmp_records(utmp,
+                        types=None,
+                        _fmt=_UTMP_FMT,
+                        _fieldnames=_UTMP_FIELDS,
+                        _force=False):
+    '''
+    Parse a utmp buffer (bytes, a memoryview or an mmap from __map_file())
+    into a list of UtmpRecords, without copying any of it. See _parse_utmp()
+    for the arguments.
+
+    If 'types' is given, only records with one of those ut_types are
+    returned, e.g. (USER_PROCESS,) for the logged in users. The types are
+    read with a struct that skips everything else in the record, so records
+    that are filtered out are never unpacked. This expects the type to be the
+    first field of _fmt, as it is in every utmp.
+    '''
+    record = struct.Struct(_fmt)
+    _filesize = len(utmp)
+
+    # We can't reliably parse a file with a length not equal to the format
+    # length. Raise an exception if we can't parse it correctly before moving
+    # forward.
+    if _filesize % record.size != 0 and not _force:
+        raise UtmpLengthError(
+            "The utmp bytes are either corrupt or the format string is wrong."
+        )
+    # Only whole records are parsed when forced.
+    _end = _filesize - _filesize % record.size
+    index = dict((x, i) for i, x in enumerate(_fieldnames))
+
+    if types is None:
+        offsets = range(0, _end, record.size)
+    else:
+        first = re.match(r'[@=<>!]?[0-9]*[a-zA-Z?]', _fmt).group()
+        typeonly = struct.Struct(
+            '{0}{1}x'.format(first, record.size - struct.calcsize(first)))
+        try:
+            _types = (x[0] for x in typeonly.iter_unpack(
+                memoryview(utmp)[:_end]))
+        except AttributeError:
+            # Python < 3.4 does not have iter_unpack
+            _types = (typeonly.unpack_from(utmp, x)[0]
+                      for x in range(0, _end, record.size))
+        offsets = (i * record.size for i, x in enumerate(_types)
+                   if x in types)
+
+    return [UtmpRecord(utmp, x, record, index) for x in offsets]
+
+
+def _parse_utmp(utmp,
+                _fmt=_UTMP_FMT,
+                _fieldnames=_UTMP_FIELDS,
+                _force=False,
+                _clean=True):
+    '''
+    Parse the UTMP file.
+    This is mostly a test to see that it could be done, and how to do it, so
+    use at your own risk. _fmt is set up for linux systems, but can be
+    overridden.
+
+    This returns a dict for every record. _parse_utmp_records() is much
+    cheaper if not every field of every record is needed.
+
+    The specific format is outlined below.
+
+    Arguments:
+        utmp -- The utmp bytes to read.
+        _fmt -- "hi32s4s32s256sii2i16s20s"
+                 ||  | |  |   ||| | |  ^ 20 empty bits that are reserved for
                  ||  | |  |   ||| | |    future use
                  ||  | |  |   ||| | ^--- 4 ints for address, but this does not
                  ||  | |  |   ||| |      seem to work correctly with ints
@@ -454,59 +1811,472 @@ def _parse_utmp(utmp,
                   strings. Does not affect the 'addr' field.
 
     '''
-    # Get the length of the format string specified.
-    _fmt_len = struct.calcsize(_fmt)
-    # Filesize in bytes of the _utmp file. Should be a multiple of _fmt_len.
-    _filesize = len(utmp)
+    return [x.asdict(_clean) for x in _parse_utmp_records(
+        utmp, _fmt=_fmt, _fieldnames=_fieldnames, _force=_force)]
+
+
+def __utmp_bisect(utmp, record, index, t, right=False):
+    '''
+    Binary search a utmp buffer for the first record with a time_s at or
+    after 't' (or after it, if 'right'). Returns a record number.
+    '''
+    lo, hi = 0, len(utmp) // record.size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        ts = UtmpRecord(utmp, mid * record.size, record, index)['time_s']
+        if ts < t or (right and ts == t):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _parse_wtmp(wtmp,
+                since=None,
+                until=None,
+                types=None,
+                _fmt=_UTMP_FMT,
+                _fieldnames=_UTMP_FIELDS):
+    '''
+    Yield the UtmpRecords of a wtmp or btmp buffer (usually an mmap from
+    __map_file()) newest first, reading backwards from the end of the file.
+
+    wtmp is only ever appended to, so it is sorted by time_s. The records
+    between 'since' and 'until' (both in seconds since the epoch, and both
+    optional) are found with a binary search, so a short window of a huge
+    wtmp only ever touches the records in it. A partial record at the end,
+    from a login being written while we read, is ignored.
+    '''
+    record = struct.Struct(_fmt)
+    index = dict((x, i) for i, x in enumerate(_fieldnames))
+    first = 0
+    last = len(wtmp) // record.size
+    if since is not None:
+        first = __utmp_bisect(wtmp, record, index, since)
+    if until is not None:
+        last = __utmp_bisect(wtmp, record, index, until, right=True)
+    for i in range(last - 1, first - 1, -1):
+        r = UtmpRecord(wtmp, i * record.size, record, index)
+        if types is None or r['type'] in types:
+            yield r
+
+
+def _parse_last(wtmp, btmp=None, since=None, now=None, n=5):
+    '''
+    Get the login history between 'since' and 'now' as a LoginHistory: the
+    'n' most recent logins and reboots from wtmp, and a Counter of the failed
+    logins in btmp by user@host (None without btmp). 'since' defaults to a
+    day before 'now'.
+    '''
+    if now is None:
+        now = time.time()
+    if since is None:
+        since = now - 24 * 60 * 60
+
+    logins = []
+    reboots = []
+    for x in _parse_wtmp(wtmp, since, now, (USER_PROCESS, BOOT_TIME)):
+        if x['type'] == BOOT_TIME:
+            if len(reboots) < n:
+                reboots.append(x)
+        elif len(logins) < n:
+            logins.append(x)
+        if len(logins) == n and len(reboots) == n:
+            break
+
+    failed = None
+    if btmp is not None:
+        failed = Counter(
+            '{0}@{1}'.format(x['User'], x['Hostname'] or x['Line'])
+            for x in _parse_wtmp(btmp, since, now))
+    return LoginHistory(since, logins, reboots, failed)
+
+
+def format_last(wtmp, btmp=None, since=None, now=None, n=5):
+    '''
+    Format the login history from _parse_last(): the recent logins and
+    reboots, and the failed logins with the users and hosts they came from
+    most. Takes the wtmp and btmp buffers, or a LoginHistory.
+    '''
+    if not isinstance(wtmp, LoginHistory):
+        wtmp = _parse_last(wtmp, btmp, since, now, n)
+
+    def _when(t):
+        return time.strftime('%a %H:%M', time.localtime(t))
+
+    ret = ['Logins since {0}:'.format(_when(wtmp.since))]
+    ret.extend('  {0:<8.8} {1:<8.8} {2:<16.16} {3}'.format(
+        x['User'], x['Line'], x['Hostname'] or '-', _when(x['time_s']))
+        for x in wtmp.logins)
+    ret.append('Reboots:')
+    ret.extend('  {0}  {1}'.format(_when(x['time_s']), x['Hostname'])
+               for x in wtmp.reboots)
+    if wtmp.failed is not None:
+        ret.append('Failed logins: {0}'.format(sum(wtmp.failed.values())))
+        ret.extend('  {0:>6} {1}'.format(c, x)
+                   for x, c in wtmp.failed.most_common(3))
+    return ret
+
+
+def _parse_proc_stat(stat, cmdline=''):
+    '''
+    Parse the contents of /proc/<pid>/stat into a ProcStat. The command name
+    can contain spaces and parentheses, so it is everything between the first
+    '(' and the last ')'.
+    '''
+    pid, _, rest = stat.partition(' (')
+    comm, _, rest = rest.rpartition(') ')
+    f = rest.split()
+    return ProcStat(int(pid), comm, f[0], int(f[1]), int(f[2]), int(f[3]),
+                    int(f[4]), int(f[5]), int(f[11]), int(f[12]), int(f[19]),
+                    cmdline)
+
+
+def __proc_stats(proc='/proc'):
+    '''
+    Read /proc/<pid>/stat of every process, once. The cmdline is only read
+    for processes that have a controlling terminal, since that is all that
+    format_w() needs it for. Processes that exit while we look are skipped.
+    '''
+    procs = []
+    for pid in __listdir(proc):
+        if not pid.isdigit():
+            continue
+        try:
+            p = _parse_proc_stat(__get_file(os.path.join(proc, pid, 'stat')))
+            if p.tty:
+                cmdline = __get_file(os.path.join(proc, pid, 'cmdline'), 'rb')
+                p = p._replace(cmdline=cmdline.decode(
+                    'utf-8', 'replace').replace('\x00', ' ').strip())
+        except (IOError, OSError):
+            continue
+        procs.append(p)
+    return procs
+
+
+def __read_proc(path):
+    '''A single os.read() of a small /proc file, without a file object'''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, 4096)
+    finally:
+        os.close(fd)
+
+
+def __swap_used(swaps='/proc/swaps'):
+    '''Whether any swap space is on, from the lines after the header'''
+    try:
+        return __get_file(swaps).count('\n') > 1
+    except (IOError, OSError):
+        return False
+
+
+def __proc_sample(proc='/proc', full=True):
+    '''
+    Read /proc/<pid>/stat of every process, with a single read each, into a
+    dict of (pid, starttime) to (comm, CPU ticks, rss kB, swap kB, fds), the
+    comm as bytes. With
+    'full' the VmSwap of their status (only if there is any swap on) and the
+    number of their open files are read too, and are 0 otherwise.
+    Processes that exit while we look are left out, and so are we and our
+    children, like the __statvfs() workers.
+    '''
+    page = os.sysconf('SC_PAGE_SIZE') // 1024
+    me = str(os.getpid())
+    mine = me.encode()
+    swap = full and __swap_used()
+    scandir = getattr(os, 'scandir', None)
+    # os.scandir() is python >= 3.5
+    pids = [x.name for x in scandir(proc)] if scandir else os.listdir(proc)
+    ret = {}
+    for pid in pids:
+        if not pid.isdigit() or pid == me:
+            continue
+        path = proc + '/' + pid
+        try:
+            stat = __read_proc(path + '/stat')
+        except OSError:
+            continue
+        end = stat.rfind(b') ')
+        f = stat[end + 2:].split(None, 22)
+        if f[1] == mine:
+            continue
+        vmswap = 0
+        fds = 0
+        if full:
+            if swap:
+                try:
+                    status = __read_proc(path + '/status')
+                    i = status.find(b'VmSwap:')
+                    if i >= 0:
+                        vmswap = int(status[i + 7:status.find(b'kB', i)])
+                except OSError:
+                    pass
+            try:
+                fds = len(os.listdir(path + '/fd'))
+            except OSError:
+                pass
+        # The comm is only decoded for the few that make it to the top.
+        ret[pid, int(f[19])] = (stat[stat.find(b'(') + 1:end],
+                                int(f[11]) + int(f[12]), int(f[21]) * page,
+                                vmswap, fds)
+    return ret
+
+
+# The columns of the top processes section, and their fields in ProcUsage.
+_TOP_METRICS = (('cpu', 2), ('rss', 3), ('swap', 4), ('fds', 5))
+
+
+def _top_procs(prev, cur, dt, n=5, hz=100):
+    '''
+    The 'n' processes using the most of each of the _TOP_METRICS, from two
+    samples of __proc_sample() 'dt' seconds apart, as a dict of the metric
+    to a list of ProcUsages, the biggest first. heapq.nlargest() only keeps
+    a heap of the 'n' biggest of each metric as it goes through them.
+    Without a 'prev' sample the CPU use is 0.
+    '''
+    get = prev.get
+    scale = 100.0 / hz / dt if prev and dt > 0 else 0.0
+    # Anything that isn't in 'prev' started after it.
+    rows = [(key[0], comm, (ticks - get(key, (0, 0))[1]) * scale, rss, swap,
+             fds) for key, (comm, ticks, rss, swap, fds) in cur.items()]
+    ret = {}
+    for name, i in _TOP_METRICS:
+        ret[name] = [ProcUsage(int(x[0]), x[1].decode('utf-8', 'replace'),
+                               *x[2:])
+                     for x in heapq.nlargest(n, rows, key=itemgetter(i))
+                     if x[i]]
+    return ret
+
+
+# The time and the data of the last sample taken by __sampled(), by name.
+_samples = {}
+
+
+def __sampled(name, sample, first=None, interval=0.25):
+    '''
+    Two samples of sample(), as (prev, cur, seconds between them). The
+    previous one is the last taken under 'name', if that was in the last
+    minute, and otherwise first() (sample() by default) is taken 'interval'
+    seconds before.
+    '''
+    prev = _samples.get(name)
+    if prev is None or time.time() - prev[0] > 60:
+        prev = (time.time(), (first or sample)())
+        time.sleep(interval)
+    now = time.time()
+    cur = sample()
+    _samples[name] = (now, cur)
+    return prev[1], cur, now - prev[0]
+
+
+def __top_procs(n=5):
+    '''
+    The top processes from _top_procs(), since the previous call if it was
+    in the last minute, or over a quarter of a second otherwise.
+    '''
+    def top():
+        prev, cur, dt = __sampled('top', __proc_sample,
+                                  lambda: __proc_sample(full=False))
+        return _top_procs(prev, cur, dt, n, os.sysconf('SC_CLK_TCK'))
+    return __recorded(
+        'top', top, dump=_jsonable,
+        load=lambda top: dict((k, [ProcUsage(**x) for x in v])
+                              for k, v in top.items()))
 
-    # We can't reliably parse a file with a length not equal to the format
-    # length. Raise an exception if we can't parse it correctly before moving
-    # forward.
-    if not (_filesize % _fmt_len == 0 and not _force):
-        raise UtmpLengthError(
-            "The utmp bytes are either corrupt or the format string is wrong."
-        )
 
-    # Get a number of entries in the utmp file.
-    _entries = _filesize // _fmt_len
+# The number of counters of every CPU that we keep from /proc/stat: user,
+# nice, system, idle, iowait, irq, softirq and steal, see proc(5).
+_CPU_TICKS = 8
 
-    # Initialize the users list.
-    users = []
+# The columns of the CPU section and the counters adding up to each. The
+# guest time is already in user.
+_CPU_FIELDS = (('user', (0, 1)), ('system', (2,)), ('iowait', (4,)),
+               ('irq', (5,)), ('softirq', (6,)), ('steal', (7,)))
 
-    # Walk through the utmp file, unpacking as we go.
-    for ind in range(_entries):
-        # When we unpack we are going to create a dictionary from the output,
-        # using the values defined in the _fieldnames variable.
-        _raw_fields = zip(_fieldnames,
-                          struct.unpack(_fmt, utmp[
-                              (_fmt_len * ind):(_fmt_len * (ind + 1))]))
-        # Build the dictionary using dictionary comprehension.
-        if _clean:
-            _raw_fields = map(__strip, _raw_fields)
-        user_dict = dict((x, y) for x, y in _raw_fields)
-        # Add the dictionary to the users list
-        users.append(user_dict)
 
-    # The uses list is going to be what is used, so return it.
-    return users
+def _parse_cpu_stat(stat):
+    '''
+    Parse the cpu lines of /proc/stat into the names of the CPUs, 'cpu' for
+    all of them first, and a single array of the _CPU_TICKS counters of each
+    one after the other, so that hundreds of CPUs are two objects rather
+    than thousands.
+    '''
+    names = []
+    ticks = array('d')
+    for line in stat.splitlines():
+        if not line.startswith('cpu'):
+            break
+        f = line.split()
+        names.append(f[0])
+        # Older kernels don't have all of them.
+        f.extend('0' * (_CPU_TICKS + 1 - len(f)))
+        ticks.extend(float(x) for x in f[1:_CPU_TICKS + 1])
+    return names, ticks
+
 
+def _cpu_usage(prev, cur):
+    '''
+    The percentage of the time every CPU spent in each of the _CPU_FIELDS,
+    and busy (anything but idle and iowait), between two _parse_cpu_stat()
+    of the same CPUs. Returns the names of the CPUs and an array of their
+    percentages one after the other, len(_CPU_FIELDS) + 1 of them each.
+    '''
+    names, ticks = cur
+    before = prev[1] if prev[0] == names else array('d', [0]) * len(ticks)
+    width = len(_CPU_FIELDS) + 1
+    ret = array('d', [0]) * (len(names) * width)
+    for cpu in range(len(names)):
+        base = cpu * _CPU_TICKS
+        d = [ticks[base + i] - before[base + i] for i in range(_CPU_TICKS)]
+        total = sum(d)
+        if total <= 0:
+            continue
+        out = cpu * width
+        for j, (_, fields) in enumerate(_CPU_FIELDS):
+            ret[out + j] = 100.0 * sum(d[i] for i in fields) / total
+        ret[out + width - 1] = 100.0 * (total - d[3] - d[4]) / total
+    return names, ret
+
+
+def __cpu_usage():
+    '''
+    The _cpu_usage() since the previous call if it was in the last minute,
+    or over a quarter of a second otherwise.
+    '''
+    def usage():
+        return _cpu_usage(*__sampled(
+            'cpu', lambda: _parse_cpu_stat(__get_file('/proc/stat')))[:2])
+    return __recorded('cpu', usage, dump=lambda x: [x[0], list(x[1])],
+                      load=lambda x: (x[0], array('d', x[1])))
+
+
+def format_cpu(usage, n=16):
+    '''
+    The time spent in each of the _CPU_FIELDS by all CPUs together and by
+    every CPU, colored by how busy it is like the disk usage is. With more
+    than 'n' CPUs only the busy ones (over 75%) are listed.
+    '''
+    names, pcts = usage
+    width = len(_CPU_FIELDS) + 1
+    row = '{0}{1:<7}' + ''.join(' {{{0}:>7.1f}}'.format(i + 2)
+                                for i in range(len(_CPU_FIELDS))) + '{c}'
+    ret = ['{0:<7}'.format('CPU') + ''.join(
+        ' {0:>7}'.format(x) for x, _ in _CPU_FIELDS)]
+    quiet = 0
+    for cpu, name in enumerate(names):
+        values = pcts[cpu * width:(cpu + 1) * width]
+        busy = values[-1]
+        if cpu and len(names) > n + 1 and busy <= 75:
+            quiet += 1
+            continue
+        col = __get_color(busy, 100)[0]
+        ret.append(row.format(col, 'all' if name == 'cpu' else name,
+                              *values[:-1], c=bcolors.S if col else ''))
+    if quiet:
+        ret.append('(and {0} more CPUs under 75% busy)'.format(quiet))
+    return ret
 
-def format_w(loadavg, uptime, utmp):
+
+def format_top(top, n=5):
+    '''
+    The top processes by CPU, resident memory, swap and open files side by
+    side, 'n' of each. CPU use is colored like the disk usage.
+    '''
+    ret = ['{0:<18} {1:<18} {2:<18} {3}'.format(
+        'CPU', 'RSS', 'Swap', 'Files')]
+    columns = [top.get(name, [])[:n] for name, _ in _TOP_METRICS]
+    for row in range(max(len(x) for x in columns)):
+        cells = []
+        for (name, _), column in zip(_TOP_METRICS, columns):
+            if row >= len(column):
+                cells.append(' ' * 18)
+                continue
+            p = column[row]
+            if name == 'cpu':
+                col = __get_color(p.cpu, 100)[0]
+                value = '{0}{1:>5.1f}%{2}'.format(col, p.cpu,
+                                                  bcolors.S if col else '')
+            elif name == 'fds':
+                value = '{0:>6}'.format(p.fds)
+            else:
+                value = '{0:>6}'.format(__tohuman(getattr(p, name) * 1024))
+            cells.append('{0:<11.11} {1}'.format(p.comm, value))
+        ret.append(' '.join(cells).rstrip())
+    return ret
+
+
+def __w_ttys(lines, dev='/dev'):
+    '''
+    Get the device number and the last access time of each terminal.
+    '''
+    ttys = {}
+    for line in lines:
+        try:
+            st = os.stat(os.path.join(dev, line))
+        except OSError:
+            continue
+        ttys[line] = (st.st_rdev, st.st_atime)
+    return ttys
+
+
+def __w_ival(t):
+    '''
+    Format a number of seconds like the IDLE, JCPU and PCPU columns of 'w'.
+    '''
+    if t >= 48 * 60 * 60:
+        return '{0}days'.format(int(t) // (24 * 60 * 60))
+    elif t >= 60 * 60:
+        return '{0}:{1:02}m'.format(int(t) // (60 * 60), int(t) % 3600 // 60)
+    elif t >= 60:
+        return '{0}:{1:02}'.format(int(t) // 60, int(t) % 60)
+    return '{0:.2f}s'.format(t)
+
+
+def __w_login(t, now):
+    '''
+    Format a login time like the LOGIN@ column of 'w'.
+    '''
+    if now - t > 6 * 24 * 60 * 60:
+        fmt = '%d%b%y'
+    elif now - t > 12 * 60 * 60:
+        fmt = '%a%H'
+    else:
+        fmt = '%H:%M'
+    return time.strftime(fmt, time.localtime(t))
+
+
+def format_w(loadavg, uptime, utmp, procs=None, ttys=None, now=None):
     '''
     Formats the output of the 'w' command. The header is replaced and some
     slightly more accurate information is used.
+
+    The user table is built from utmp, the access times of the terminals and
+    a single read of /proc/<pid>/stat, instead of running 'w'. 'procs' is a
+    list of ProcStats, 'ttys' a dict of the terminal name to its (st_rdev,
+    st_atime), and 'now' the current time. They are read from the system if
+    not given.
     '''
     loadavg = loadavg.split()
     uptime = uptime.split()
+    from datetime import timedelta
     hruptime = str(timedelta(seconds=int(uptime[0].split('.')[0])))
 
     # Uses utmp to find the logged in users
     # utmpvalues = parse_utmp('/var/run/utmp')
-    utmpvalues = [x for x in utmp if x['type'] == 7]
+    utmpvalues = [x for x in utmp if x['type'] == USER_PROCESS]
+
+    if now is None:
+        now = time.time()
+    if ttys is None:
+        ttys = __w_ttys(x['Line'] for x in utmpvalues)
+    if procs is None:
+        procs = __proc_stats()
+    hz = os.sysconf('SC_CLK_TCK')
 
     # Get the time format things
     date = time.strftime(
-        '%H:%M:%S', time.localtime(time.time()))
+        '%H:%M:%S', time.localtime(now))
 
     finallist = []
     finallist.append(
@@ -516,10 +2286,36 @@ def format_w(loadavg, uptime, utmp):
             usrs=len(utmpvalues),
             loadavgs=', '.join(loadavg[0:3])))
 
-    # cut off w's uptime and stuff
-    w = __output(['w'], universal_newlines=True)
-    lin = w.splitlines()
-    finallist.extend(lin[1:])
+    # Group the processes by their controlling terminal, and index them by
+    # pid for the sessions without a foreground process.
+    bytty = {}
+    bypid = {}
+    for p in procs:
+        bypid.setdefault(p.pid, p)
+        if p.tty:
+            bytty.setdefault(p.tty, []).append(p)
+
+    row = '{0:<8.8} {1:<8.8} {2:<16.16} {3:<7} {4:>7} {5:>7} {6:>7} {7}'
+    finallist.append(row.format('USER', 'TTY', 'FROM', 'LOGIN@', 'IDLE',
+                                'JCPU', 'PCPU', 'WHAT'))
+    for u in utmpvalues:
+        rdev, atime = ttys.get(u['Line'], (None, None))
+        tprocs = bytty.get(rdev, [])
+        # Like 'w', the process we show is the newest one in the foreground
+        # process group of the terminal, or the login process.
+        fg = [p for p in tprocs if p.pgrp == p.tpgid]
+        if fg:
+            best = max(fg, key=lambda p: p.starttime)
+        else:
+            best = bypid.get(u['PID'])
+        jcpu = sum(p.utime + p.stime for p in tprocs) / hz
+        finallist.append(row.format(
+            u['User'], u['Line'], u['Hostname'] or '-',
+            __w_login(u['time_s'], now),
+            __w_ival(max(now - atime, 0)) if atime is not None else '?',
+            __w_ival(jcpu) if tprocs else '',
+            __w_ival((best.utime + best.stime) / hz) if best else '',
+            (best.cmdline or best.comm) if best else '-'))
     return finallist
 
 
@@ -537,6 +2333,19 @@ def _parse_mem(m):
     return dict((x[0][0:-1], x[1]) for x in meminfo)
 
 
+def _parse_snmp(snmp):
+    '''
+    Parse /proc/net/snmp, where every protocol has a line of field names
+    followed by a line of their values, into a dict of the protocols to a
+    dict of their fields to the values.
+    '''
+    lines = [x.split() for x in snmp.splitlines()]
+    ret = {}
+    for names, values in zip(lines[::2], lines[1::2]):
+        ret[names[0][:-1]] = dict(zip(names[1:], (int(x) for x in values[1:])))
+    return ret
+
+
 def format_mem(memdict, memerr=0.7, memwarn=0.5):
     '''
     Format the memory we get from _parse_mem(). Two optional arguments, memerr
@@ -604,40 +2413,143 @@ def format_swap(memdict, swaperr=0.7, swapwarn=0.5):
                                                     totalmb)
 
 
-def __regex_ss(a, n):
+def _scan_ss(sslist, peers=False):
+    '''
+    Walk the sockets a single time, filling in everything the ss formatters
+    need as we go: the local and remote ports of ESTAB sockets, the LISTEN
+    sockets, and a count of every (netid, state). With 'peers' the remote
+    addresses and the processes of ESTAB sockets are counted too, for
+    format_peers(). Takes any iterable of 'ss' lines or SsRecords, so the
+    output of 'ss' can be scanned straight from the pipe. Returns an SsScan.
+    '''
+    nin = []
+    nout = []
+    addrs = [] if peers else None
+    procs = [] if peers else None
+    listeners = []
+    states = {}
+    get = states.get
+    for x in sslist:
+        if isinstance(x, tuple):
+            a = x
+        else:
+            a = x.split()
+            # Headers and summaries
+            if len(a) < 6 or (a[0] != 'tcp' and a[0] != 'udp'):
+                continue
+        key = a[0], a[1]
+        states[key] = get(key, 0) + 1
+        if a[1] == 'ESTAB':
+            nin.append(a[4].rpartition(':')[2])
+            if peers:
+                peer, _, port = a[5].rpartition(':')
+                nout.append(port)
+                addrs.append(peer)
+                # users:(("name",pid=1,fd=2),...)
+                procs.append(a[6].split('"', 2)[1] if len(a) > 6 and a[6]
+                             else '-')
+            else:
+                nout.append(a[5].rpartition(':')[2])
+        elif a[1] == 'LISTEN':
+            if a is not x:
+                x = SsRecord(a[0], a[1], a[2], a[3], a[4], a[5],
+                             a[6] if len(a) > 6 else '')
+            listeners.append(x)
+    # Counter() counts a list much faster than we can in the loop above.
+    if peers:
+        addrs, procs = Counter(addrs), Counter(procs)
+    return SsScan(Counter(nin), Counter(nout), listeners, Counter(states),
+                  addrs, procs, None)
+
+
+class SpaceSaving(Counter):
+    '''
+    A Counter that only keeps its 'size' most common elements, with the
+    Space-Saving algorithm, so it takes the same memory however many
+    elements it is fed. Once it has twice 'size' of them the least common
+    are evicted, and 'floor' is raised to the largest count evicted.
+
+    A new element starts at 'floor', so the count of an element may be too
+    high by errors[elem], but never too low; anything not counted at all
+    was seen at most 'floor' times.
+    '''
+
+    def __init__(self, iterable=None, size=1000):
+        self.size = size
+        self.floor = 0
+        self.errors = {}
+        super(SpaceSaving, self).__init__(iterable)
+
+    def update(self, iterable=None):
+        '''Count the elements of 'iterable', or the counts of a mapping'''
+        if iterable is None:
+            return
+        if not hasattr(iterable, 'items'):
+            iterable = Counter(iterable)
+        floor = self.floor
+        for elem, c in iterable.items():
+            if elem in self:
+                self[elem] += c
+            else:
+                self[elem] = floor + c
+                if floor:
+                    self.errors[elem] = floor
+        if len(self) >= 2 * self.size:
+            self.__evict()
+
+    def __evict(self):
+        keep = set(x for x, _ in self.most_common(self.size))
+        for elem in [x for x in self if x not in keep]:
+            self.floor = max(self.floor, self[elem])
+            del self[elem]
+            self.errors.pop(elem, None)
+
+
+def _sketch_ss(sslist, size=1000, chunk=1 << 16):
     '''
-    Splits up the ss ports and IP's.
-    Return a list of ports
+    _scan_ss() the sockets 'chunk' of them at a time, counting their ports,
+    peers and processes in SpaceSavings of 'size', so scanning millions of
+    sockets takes no more memory than scanning a few thousand. Returns an
+    SsScan.
     '''
-    a = a.split()
-    # if len(a) == 5
-    return re.match('.+:([^:]*$)', a[n]).groups()[0]
+    it = iter(sslist)
+    nin, nout, peers, procs = [SpaceSaving(size=size) for _ in range(4)]
+    listeners = []
+    states = Counter()
+    for part in iter(lambda: list(islice(it, chunk)), []):
+        scan = _scan_ss(part, peers=True)
+        nin.update(scan.nin)
+        nout.update(scan.nout)
+        peers.update(scan.peers)
+        procs.update(scan.procs)
+        listeners.extend(scan.listeners)
+        states.update(scan.states)
+    return SsScan(nin, nout, listeners, states, peers, procs, None)
 
 
 def _parse_ssutn(sslist, header=12):
     '''
     Private function used by format_ssutn thta actually runs the 'ss' command.
     Does the 'sort | uniq -c' part of the old shell script using the
-    collections.Counter class.
+    collections.Counter class. Takes 'ss' lines, SsRecords or an SsScan;
+    the first 'header' lines are skipped, but never records.
     '''
-    # Remove the header from the output.
-    ss = sslist[header:]
-    # Run a list comprehension on the ss list and return a tuple of (in, out).
-    _nin = (__regex_ss(x, 4) for x in ss
-            if re.match('^(tcp|udp) +ESTAB', x))
-    _nout = (__regex_ss(x, 5) for x in ss
-             if re.match('^(tcp|udp) +ESTAB', x))
-
-    return Counter(_nin), Counter(_nout)
+    if not isinstance(sslist, SsScan):
+        # Remove the header from the output.
+        sslist = _scan_ss(x for i, x in enumerate(sslist)
+                          if i >= header or isinstance(x, SsRecord))
+    return sslist.nin, sslist.nout
 
 
 def format_ssutn(sslist, n=3, header=12):
     '''
     Print out the number of out and in sockets that are open in a pair of
     columns, similar to what a '| sort | uniq -n | sort -r' would get you.
-    Takes a number, n, as input, defaulting to 3.
+    Takes a number, n, as input, defaulting to 3. 'header' is the number of
+    lines of 'ss' output to skip, which doesn't apply to SsRecords.
 
-    Returns the 'n' most common sockets.
+    Returns the 'n' most common sockets. Counts from a _sketch_ss() that
+    may be too high have how much too high they can be after them.
     '''
     a = _parse_ssutn(sslist, header=header)
     if n <= (len(a[0])):
@@ -650,24 +2562,129 @@ def format_ssutn(sslist, n=3, header=12):
     else:
         nin = a[1].most_common(len(a[1]))
 
-    return (('      {0:7<} {1:8>}'.format(y, x) for x, y in out),
-            ('      {0:7<} {1:8>}'.format(y, x) for x, y in nin))
+    return ((__format_count(x, y, a[0]) for x, y in out),
+            (__format_count(x, y, a[1]) for x, y in nin))
 
 
-def __format_ss_proc_line(a):
+def __format_count(elem, count, counter):
+    error = getattr(counter, 'errors', {}).get(elem)
+    if error:
+        return '      {0:7<} {1:8>} (error <= {2})'.format(count, elem, error)
+    return '      {0:7<} {1:8>}'.format(count, elem)
+
+
+# The prefix lengths _rollup_peers() rolls addresses up through, by the
+# number of bits in an address.
+_ROLLUP_PREFIXES = {32: (32, 24, 16, 8, 0), 128: (128, 64, 48, 32, 0)}
+
+
+def __peer_address(peer):
+    '''
+    The address of a peer as 'ss' prints it, '[...]' around IPv6 and maybe
+    a '%interface', as (bits, int). IPv4 mapped IPv6 addresses are IPv4.
+    Returns None for anything else, like '*'.
+    '''
+    peer = peer.strip('[]').partition('%')[0]
+    if peer.startswith('::ffff:') and '.' in peer:
+        peer = peer[7:]
+    for family, bits in ((socket.AF_INET, 32), (socket.AF_INET6, 128)):
+        try:
+            packed = socket.inet_pton(family, peer)
+        except (socket.error, ValueError):
+            continue
+        return bits, int(binascii.hexlify(packed), 16)
+    return None
+
+
+def __network(bits, net, prefixlen):
+    '''Format the first 'prefixlen' bits 'net' of an address as CIDR'''
+    family = socket.AF_INET if bits == 32 else socket.AF_INET6
+    address = socket.inet_ntop(family, binascii.unhexlify(
+        '{0:0{1}x}'.format(net << (bits - prefixlen), bits // 4)))
+    if prefixlen == bits:
+        return address
+    return '{0}/{1}'.format(address, prefixlen)
+
+
+def _rollup_peers(peers, by='auto', share=0.05):
+    '''
+    Group a Counter of the peers of sockets, as in SsScan.peers, into a
+    Counter of their networks:
+
+        'ip': every address on its own
+        'prefix': the /24 of IPv4 addresses and the /64 of IPv6 ones
+        'auto': a trie of the prefixes in _ROLLUP_PREFIXES is walked up
+        from the addresses, and a prefix is a group of its own once it has
+        at least 'share' of all the sockets (not counting those in groups
+        below it). The rest of them end up in 0.0.0.0/0 and ::/0.
+
+    Peers that aren't addresses are left out.
+    '''
+    threshold = max(1, share * sum(peers.values()))
+    levels = {32: Counter(), 128: Counter()}
+    for peer, c in peers.items():
+        address = __peer_address(peer)
+        if address is not None:
+            levels[address[0]][address[1]] += c
+    ret = Counter()
+    for bits, level in levels.items():
+        if by == 'prefix':
+            plen = 24 if bits == 32 else 64
+            for net, c in level.items():
+                ret[__network(bits, net >> (bits - plen), plen)] += c
+            continue
+        elif by != 'auto':
+            for net, c in level.items():
+                ret[__network(bits, net, bits)] += c
+            continue
+        prefixes = _ROLLUP_PREFIXES[bits]
+        for plen, parent in zip(prefixes, prefixes[1:] + (None,)):
+            up = Counter()
+            for net, c in level.items():
+                if c >= threshold or parent is None:
+                    ret[__network(bits, net, plen)] += c
+                else:
+                    up[net >> (plen - parent)] += c
+            level = up
+    return ret
+
+
+def format_peers(sslist, by='auto', n=3, share=0.05):
+    '''
+    The 'n' biggest groups of ESTAB sockets, in the columns of
+    format_ssutn(), grouped by their local 'port', their 'process', or
+    their peer: by 'ip', 'prefix' or 'auto', see _rollup_peers(). Takes
+    'ss' lines, SsRecords or an SsScan of them with their peers.
+    '''
+    if not isinstance(sslist, SsScan):
+        sslist = _scan_ss(sslist, peers=True)
+    if by == 'port':
+        groups = sslist.nin
+    elif by == 'process':
+        groups = sslist.procs
+    else:
+        groups = _rollup_peers(sslist.peers, by, share)
+    return ['      {0:7<} {1:8>}'.format(y, x)
+            for x, y in groups.most_common(n)]
+
+
+def __format_ss_proc_line(a, owners=None):
     '''
     Private function to get a pretty formatted 'ss -ntlp' output. Takes a line
-    of 'ss -ntlp' output as input, returns a formatted string.
+    of 'ss -ntlp' output as input, returns a formatted string. The systemd
+    unit of each process is added from 'owners', if it is in there.
     '''
     recv = a[2]
     send = a[3]
     port = a[4]
+    owners = owners or {}
     try:
-        proc = a[6]
-
-        proc = re.sub(r'^users:\(\(', '', proc)
-        proc = re.sub(r'\)\)$', '', proc)
-        proclist = proc.split('),(')
+        proclist = []
+        for proc, _, pid, _ in _SS_USERS.findall(a[6]):
+            owner = owners.get(pid)
+            if owner is not None and owner.unit:
+                proc = '{0} ({1})'.format(proc, owner.unit)
+            proclist.append(proc)
         proclen = len(proclist)
         if proclen > 2:
             procstring = '{0}, {1} (and {2} more)'.format(proclist[0],
@@ -676,8 +2693,10 @@ def __format_ss_proc_line(a):
         elif proclen == 2:
             procstring = '{0}, {1}'.format(proclist[0],
                                            proclist[1])
-        else:
+        elif proclen == 1:
             procstring = '{0}'.format(proclist[0])
+        else:
+            procstring = ''
     except:
         procstring = ''
 
@@ -689,8 +2708,28 @@ def format_ssntlp(sslist, m=2):
     Gets the 'ss -ntlp' output and formats it correctly, as per the
     __format_ss_proc_line() function. Returns a generator, not a list.
     '''
-    ssntlp = (x for x in sslist if re.match('^(tcp|udp) +LISTEN.*', x))
-    return (__format_ss_proc_line(x.split()) for x in ssntlp)
+    if not isinstance(sslist, SsScan):
+        sslist = _scan_ss(sslist)
+    return (__format_ss_proc_line(x, sslist.owners)
+            for x in sslist.listeners)
+
+
+def format_sssum(sslist):
+    '''
+    Summarize the sockets, similar to the first lines of 'ss -s'.
+    '''
+    if not isinstance(sslist, SsScan):
+        sslist = _scan_ss(sslist)
+    states = Counter()
+    netids = Counter()
+    for (netid, state), n in sslist.states.items():
+        netids[netid] += n
+        if netid == 'tcp':
+            states[state] += n
+    tcp = 'TCP:   {0} (estab {1}, listen {2}, timewait {3})  UDP: {4}'
+    return ['Total: {0}'.format(netids['tcp'] + netids['udp']),
+            tcp.format(netids['tcp'], states['ESTAB'], states['LISTEN'],
+                       states['TIME-WAIT'], netids['udp'])]
 
 
 def parse_release(rel, name='', **kwargs):
@@ -769,73 +2808,1267 @@ def format_release(reldict, **kwargs):
                              v=reldict['VERSION'])
 
 
-def main():
-    '''
-    Printing out our final product
-    '''
-    sslist = __ss()
-    ssutn = format_ssutn(sslist)
-    meminfo = _parse_mem(__get_file('/proc/meminfo'))
-    la = __get_file('/proc/loadavg')
-    up = __get_file('/proc/uptime')
-    sizes = __get_usage()
-    uts = __get_file('/var/run/utmp', 'rb')
-    ut = _parse_utmp(uts)
-    release = None
-    for f in ['/etc/os-release',
-              '/etc/redhat-release',
-              '/etc/lsb-release',
-              '/etc/debian_version']:
-        if os.path.exists(f):
-            rel = __get_file(f).splitlines()
-            relfile = f
-            release = format_release(
-                parse_release(rel, name=os.path.split(relfile)[1]))
-            break
-    if not release:
+_RELEASE_FILES = ['/etc/os-release', '/etc/redhat-release',
+                  '/etc/lsb-release', '/etc/debian_version']
+
+
+def __get_release(cache=None):
+    '''
+    Find and parse the release file of the system, through the ParseCache
+    'cache'. Returns None if there isn't one we know about.
+    '''
+    for f in _RELEASE_FILES:
+        if __exists(f):
+            return __parsed(
+                f, lambda f: parse_release(__get_file(f).splitlines(),
+                                           name=os.path.split(f)[1]), cache)
+
+
+def __get_users(utmp='/var/run/utmp', cache=None):
+    '''
+    The logged in users from utmp, the terminals they are on, and the time
+    their idle times are from. The records are kept in the ParseCache
+    'cache' as their bytes.
+    '''
+    ut = __parsed(
+        utmp,
+        lambda f: _parse_utmp_records(__map_file(f), types=(USER_PROCESS,)),
+        cache,
+        dump=lambda ut: binascii.hexlify(
+            b''.join(x.tobytes() for x in ut)).decode('ascii'),
+        load=lambda x: _parse_utmp_records(binascii.unhexlify(x)))
+    return (ut, __recorded('ttys', lambda: __w_ttys(x['Line'] for x in ut)),
+            __recorded('time', time.time))
+
+
+def _users_time(users):
+    '''The time the 'users' were read at, or now if they don't have it'''
+    return users[2] if len(users) > 2 else time.time()
+
+
+def __get_history(wtmp='/var/log/wtmp', btmp='/var/log/btmp'):
+    '''
+    The login history of the last day from wtmp and btmp. wtmp might not
+    exist and btmp is only readable by root, so either can be missing.
+    '''
+    try:
+        wtmp = __map_file(wtmp)
+    except (IOError, OSError):
+        wtmp = b''
+    try:
+        btmp = __map_file(btmp)
+    except (IOError, OSError):
+        btmp = None
+    return _parse_last(wtmp, btmp, now=__recorded('time', time.time))
+
+
+def __with_owners(scan):
+    '''The SsScan with the ProcOwners of its listeners'''
+    return scan._replace(owners=__owners(
+        pid for x in scan.listeners for _, pid, _ in _parse_users(x[6])))
+
+
+# The probes collect() runs: a name, a function returning the raw data, and
+# the number of seconds it gets before it is considered hung.
+_PROBES = [
+    ('hostname', lambda: __recorded('hostname', socket.gethostname), 1),
+    ('release', __get_release, 2),
+    ('ip', lambda: __ip(), 5),
+    ('loadavg', lambda: __get_file('/proc/loadavg'), 2),
+    ('uptime', lambda: __get_file('/proc/uptime'), 2),
+    ('users', __get_users, 5),
+    ('procs', __proc_stats, 10),
+    ('top', __top_procs, 10),
+    ('cpu', __cpu_usage, 5),
+    ('io', __disk_io, 5),
+    ('history', __get_history, 5),
+    ('usage', __get_usage, 10),
+    ('meminfo', lambda: _parse_mem(__get_file('/proc/meminfo')), 2),
+    ('ss', lambda: __with_owners(_scan_ss(__ss(), peers=True)), 20),
+]
+
+
+def approx_probes(probes, size):
+    '''
+    The 'probes' with the sockets counted by _sketch_ss() into at most
+    'size' ports, as they stream in, rather than all of them listed and
+    counted exactly. Only the map of socket inodes to their processes grows
+    with the number of sockets, and, when capturing, the raw inputs that are
+    recorded.
+    '''
+    def sketch():
+        return __with_owners(_sketch_ss(__ss(), size))
+    return [('ss', sketch, t) if name == 'ss' else (name, f, t)
+            for name, f, t in probes]
+
+
+# How many seconds the data of each probe stays fresh in --daemon mode.
+_PROBE_TTLS = {'hostname': 3600, 'release': 3600, 'ip': 60, 'loadavg': 1,
+               'uptime': 1, 'users': 5, 'procs': 5, 'top': 5, 'cpu': 1,
+               'io': 1, 'history': 60, 'usage': 30, 'meminfo': 1, 'ss': 5}
+
+
+# The CPU time of the current thread, where there is a clock for it.
+_thread_time = getattr(time, 'thread_time', None)
+
+
+class Profiler(object):
+    '''
+    Measures every probe collect() runs and every section render() formats
+    while it is installed, with install() or as a context manager:
+
+        with Profiler() as p:
+            print(render(collect()))
+        print('\\n'.join(format_profile(p.stats)))
+
+    'stats' has the ProfileStats of each, by 'probe:<name>' or
+    'section:<name>': its wall and CPU time (of its thread), the subprocesses
+    it started, the bytes it read from files, pipes and netlink, and the
+    peak of its allocations, with tracemalloc if 'memory'.
+
+    With 'serial' the probes are run one after another, so that the
+    allocations, and the cProfile of 'pstats', are their own. Without it
+    'peak' is None for the probes, which share the process.
+    '''
+    def __init__(self, serial=True, memory=True, pstats=False):
+        self.serial = serial
+        self.memory = memory
+        self.pstats = pstats
+        self.stats = {}
+        self.profiles = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.tracemalloc = None
+
+    def install(self):
+        global _profiler
+        if self.memory:
+            try:
+                import tracemalloc
+            except ImportError:
+                # Python < 3.4
+                tracemalloc = None
+            if tracemalloc and not tracemalloc.is_tracing() and \
+                    hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.start()
+                self.tracemalloc = tracemalloc
+        _profiler = self
+
+    def uninstall(self):
+        global _profiler
+        _profiler = None
+        if self.tracemalloc is not None:
+            self.tracemalloc.stop()
+            self.tracemalloc = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc):
+        self.uninstall()
+
+    def account(self, key, n=1):
+        counters = getattr(self.local, 'counters', None)
+        if counters is not None:
+            counters[key] += n
+
+    def run(self, name, f, *args):
+        '''Run f(*args), measuring it as 'name'.'''
+        counters = self.local.counters = {'subprocesses': 0, 'bytes': 0}
+        tracing = self.tracemalloc is not None and (
+            self.serial or not name.startswith('probe:'))
+        if tracing:
+            self.tracemalloc.reset_peak()
+            base = self.tracemalloc.get_traced_memory()[0]
+        profile = None
+        if self.pstats:
+            import cProfile
+            profile = cProfile.Profile()
+        start = time.time()
+        cpu = _thread_time() if _thread_time else None
+        try:
+            if profile is not None:
+                try:
+                    return profile.runcall(f, *args)
+                except ValueError:
+                    # Another profiler is active, e.g. of a hung probe.
+                    profile = None
+            return f(*args)
+        finally:
+            stats = ProfileStats(
+                time.time() - start,
+                _thread_time() - cpu if _thread_time else None,
+                counters['subprocesses'], counters['bytes'],
+                self.tracemalloc.get_traced_memory()[1] - base
+                if tracing else None)
+            self.local.counters = None
+            with self.lock:
+                self.stats[name] = stats
+                if profile is not None:
+                    self.profiles.append(profile)
+
+    def dump(self, path):
+        '''Write the cProfile of everything measured to a pstats file'''
+        import pstats
+        stats = None
+        for profile in self.profiles:
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if stats is not None:
+            stats.dump_stats(path)
+
+
+# The Profiler measuring the probes and sections, if any.
+_profiler = None
+
+
+def __profiled(name, f, *args):
+    '''f(*args), measured by the Profiler if there is one installed'''
+    if _profiler is None:
+        return f(*args)
+    return _profiler.run(name, f, *args)
+
+
+def format_profile(stats):
+    '''
+    Format the ProfileStats of a Profiler, slowest first.
+    '''
+    def ms(t):
+        return '-' if t is None else '{0:.1f}ms'.format(t * 1000)
+    ret = ['{0:24} {1:>9} {2:>9} {3:>7} {4:>7} {5:>7}'.format(
+        'Profile', 'wall', 'cpu', 'subproc', 'read', 'peak')]
+    for name, x in sorted(stats.items(), key=lambda x: -x[1].wall):
+        ret.append('{0:24} {1:>9} {2:>9} {3:>7} {4:>7} {5:>7}'.format(
+            name, ms(x.wall), ms(x.cpu), x.subprocesses, __tohuman(x.bytes),
+            '-' if x.peak is None else __tohuman(x.peak)))
+    return ret
+
+
+def __run_probe(results, name, f):
+    try:
+        results[name] = __profiled('probe:' + name, f)
+    except Exception as e:
+        results[name] = e
+
+
+def collect(probes=None, timeout=None, running=None):
+    '''
+    Run the probes concurrently, each on its own thread, and return a dict of
+    their name to their data. A probe that fails has the exception as its
+    data, one that misses its deadline a ProbeTimeout. Hung probes are left
+    running on daemon threads, so they never block us, or our exit.
+
+    'probes' defaults to _PROBES, 'timeout' overrides all of their deadlines.
+    The time this takes is that of the slowest probe, not of all of them.
+
+    Callers that collect repeatedly can pass the same 'running' dict every
+    time, so a probe that is still hung from a previous call is not started
+    again.
+    '''
+    if probes is None:
+        probes = _PROBES
+    if running is None:
+        running = {}
+    results = {}
+    threads = []
+    start = time.time()
+    for name, f, t in probes:
+        if name in running and running[name].is_alive():
+            results[name] = ProbeTimeout('still hung')
+            continue
+        th = threading.Thread(target=__run_probe, args=(results, name, f))
+        th.daemon = True
+        th.start()
+        running[name] = th
+        threads.append((timeout or t, name, th))
+        if _profiler is not None and _profiler.serial:
+            th.join(timeout or t)
+    for t, name, th in sorted(threads, key=lambda x: x[0]):
+        th.join(max(0, start + t - time.time()))
+    # Copy the results before a hung probe can come back and change them.
+    data = dict(results)
+    for t, name, th in threads:
+        if name not in data:
+            data[name] = ProbeTimeout('timed out after {0:g}s'.format(t))
+    return data
+
+
+def __render_host(hostname, release):
+    if release:
+        release = format_release(release)
+    else:
         release = "Unknown Release"
+    return 'Hostname: {0}\nos-release: {1}'.format(hostname, release)
+
+
+def __render_w(loadavg, uptime, users, procs):
+    return '\n'.join(format_w(loadavg, uptime, users[0], procs=procs,
+                              ttys=users[1], now=_users_time(users)))
+
+
+def __render_disk(usage):
+    return '{0}\n\n{1}'.format('\n'.join(format_size(usage)),
+                               '\n'.join(format_inodes(usage)))
+
+
+def __render_mem(meminfo):
+    return 'Memory Used: {0}\nSwap status: {1}'.format(format_mem(meminfo),
+                                                       format_swap(meminfo))
+
+
+def __render_conc(ss):
+    ssutn = format_ssutn(ss)
+    return 'Connection Concentration:\nIN (top 3)::\n{0}\n' \
+        'OUT (top 3)::\n{1}'.format('\n'.join(ssutn[0]),
+                                    '\n'.join(ssutn[1]))
+
+
+def __render_peers(ss, by='auto'):
+    return 'Connections by {0} (top 3)::\n{1}'.format(
+        'peer network' if by == 'auto' else by,
+        '\n'.join(format_peers(ss, by)))
+
+
+# The sections of the report, in order: a name, the probes whose data it
+# needs, and a function formatting that data.
+_SECTIONS = [
+    ('host', ('hostname', 'release'), __render_host),
+    ('ip', ('ip',), lambda ip: '\n'.join(format_ip_output(ip))),
+    ('w', ('loadavg', 'uptime', 'users', 'procs'), __render_w),
+    ('cpu', ('cpu',), lambda cpu: '\n'.join(format_cpu(cpu))),
+    ('last', ('history',), lambda h: '\n'.join(format_last(h))),
+    ('disk', ('usage',), __render_disk),
+    ('io', ('usage', 'io'), lambda usage, io: '\n'.join(format_io(usage, io))),
+    ('mem', ('meminfo',), __render_mem),
+    ('top', ('top',),
+     lambda top: 'Top processes::\n' + '\n'.join(format_top(top))),
+    ('conn', ('ss',),
+     lambda ss: 'Connection Summary:\n' + '\n'.join(format_sssum(ss))),
+    ('conc', ('ss',), __render_conc),
+    ('peers', ('ss',), __render_peers),
+    ('listen', ('ss',),
+     lambda ss: 'Listening       Recv-Q Send-Q Processes\n' +
+     '\n'.join(format_ssntlp(ss))),
+]
+
+
+def __render_section(data, name, probes, f):
+    '''
+    Format a single section, or say why it can't be if one of its probes
+    failed or timed out.
+    '''
+    for x in probes:
+        if isinstance(data[x], Exception):
+            return '{0}{1}: {2}: {3}{4}'.format(bcolors.RED, name, x,
+                                                data[x], bcolors.S)
+    return __profiled('section:' + name, f, *[data[x] for x in probes])
+
+
+def render(data, sections=None):
+    '''
+    Format the data from collect() into the report, each section separated
+    by a line of dashes. Sections whose probes weren't collected are left
+    out.
+    '''
+    sep = '-' * 75
+    ret = [sep]
+    for name, probes, f in _SECTIONS if sections is None else sections:
+        if all(x in data for x in probes):
+            ret.append(__render_section(data, name, probes, f))
+            ret.append(sep)
+    return '\n'.join(ret)
+
+
+def __metric_labels(**labels):
+    '''Format Prometheus labels, escaped as the text format wants them'''
+    if not labels:
+        return ''
+
+    def esc(v):
+        return str(v).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+    return '{{{0}}}'.format(','.join('{0}="{1}"'.format(k, esc(labels[k]))
+                                     for k in sorted(labels)))
+
+
+def format_metrics(data, ports=20):
+    '''
+    Format the data from collect() as Prometheus/OpenMetrics text gauges:
+    memory from _parse_mem(), bytes and inodes of every mount, the load
+    average, the number of logged in users, and the ESTAB connections of the
+    'ports' busiest local and remote ports. Every probe also gets an
+    ss_probe_success gauge, and a probe that failed has no other metrics.
+    '''
+    metrics = []
+
+    def gauge(name, doc, samples):
+        metrics.append('# HELP {0} {1}'.format(name, doc))
+        metrics.append('# TYPE {0} gauge'.format(name))
+        metrics.extend('{0}{1} {2}'.format(name, labels, value)
+                       for labels, value in samples)
+
+    def ok(x):
+        return x in data and not isinstance(data[x], Exception)
+
+    gauge('ss_probe_success', 'Whether the probe collected its data.',
+          [(__metric_labels(probe=x), int(ok(x))) for x in sorted(data)])
+
+    if ok('meminfo'):
+        m = data['meminfo']
+        # Everything is in kB but the HugePages_ counts.
+        gauge('ss_memory_bytes', 'Fields of /proc/meminfo in bytes.',
+              [(__metric_labels(field=k), int(m[k]) * 1024) for k in sorted(m)
+               if not k.startswith('HugePages_')])
+        gauge('ss_memory_hugepages', 'The HugePages_ counts of meminfo.',
+              [(__metric_labels(field=k), m[k]) for k in sorted(m)
+               if k.startswith('HugePages_')])
+
+    if ok('usage'):
+        fs = [(__metric_labels(device=x[0], mountpoint=x[1]), x[6])
+              for x in data['usage']]
+        gauge('ss_filesystem_stale', 'Whether statvfs hung on the mount.',
+              [(labels, int(st is None)) for labels, st in fs])
+        fs = [(labels, st) for labels, st in fs if st is not None]
+        for name, doc, f in (
+                ('size_bytes', 'Size of the filesystem.',
+                 lambda st: st.f_blocks * st.f_bsize),
+                ('free_bytes', 'Free space on the filesystem.',
+                 lambda st: st.f_bfree * st.f_bsize),
+                ('files', 'Inodes on the filesystem.',
+                 lambda st: st.f_files),
+                ('files_free', 'Free inodes on the filesystem.',
+                 lambda st: st.f_ffree)):
+            gauge('ss_filesystem_' + name, doc,
+                  [(labels, f(st)) for labels, st in fs])
+
+    if ok('loadavg'):
+        la = data['loadavg'].split()
+        for i, n in enumerate(('1', '5', '15')):
+            gauge('ss_load' + n, '{0} minute load average.'.format(n),
+                  [('', la[i])])
+
+    if ok('users'):
+        gauge('ss_users', 'Logged in users from utmp.',
+              [('', len(data['users'][0]))])
+
+    if ok('ss'):
+        scan = data['ss']
+        gauge('ss_sockets', 'Sockets by netid and state.',
+              [(__metric_labels(netid=k[0], state=k[1]), v)
+               for k, v in sorted(scan.states.items())])
+        gauge('ss_established_connections',
+              'ESTAB sockets of the busiest local (in) and remote (out) '
+              'ports.',
+              [(__metric_labels(direction=d, port=p), n)
+               for d, c in (('in', scan.nin), ('out', scan.nout))
+               for p, n in c.most_common(ports)])
+
+    return '\n'.join(metrics) + '\n'
+
+
+def __structure_usage(usage):
+    return [{'device': x[0], 'mountpoint': x[1], 'fstype': x[2],
+             'options': x[3], 'stale': x[6] is None,
+             'statvfs': _jsonable(x[6])} for x in usage]
+
+
+def __structure_loadavg(loadavg):
+    f = loadavg.split()
+    running, _, total = f[3].partition('/')
+    return {'load1': float(f[0]), 'load5': float(f[1]),
+            'load15': float(f[2]), 'running': int(running),
+            'total': int(total)}
+
+
+def __structure_users(users):
+    now = _users_time(users)
+    ret = []
+    for x in users[0]:
+        atime = users[1].get(x['Line'], (None, None))[1]
+        ret.append({'user': x['User'], 'line': x['Line'],
+                    'host': x['Hostname'], 'pid': x['PID'],
+                    'login': x['time_s'],
+                    'idle': None if atime is None else max(now - atime, 0)})
+    return ret
+
+
+def __structure_ss(scan):
+    return {'states': _jsonable(scan.states), 'in': dict(scan.nin),
+            'out': dict(scan.nout), 'listeners': _jsonable(scan.listeners),
+            'peers': dict(scan.peers or {}), 'procs': dict(scan.procs or {}),
+            'owners': _jsonable(scan.owners or {})}
+
+
+def __structure_cpu(usage):
+    names, pcts = usage
+    fields = [x for x, _ in _CPU_FIELDS] + ['busy']
+    return dict((name, dict(zip(fields, pcts[i * len(fields):
+                                             (i + 1) * len(fields)])))
+                for i, name in enumerate(names))
+
+
+# How the data of a probe is structured for --json, if not by _jsonable.
+_STRUCTURES = {
+    'ip': lambda ip: _jsonable(
+        ip if isinstance(ip, list) else _parse_ip_output(ip)),
+    'loadavg': __structure_loadavg,
+    'uptime': lambda up: dict(zip(('uptime', 'idle'),
+                                  [float(x) for x in up.split()])),
+    'users': __structure_users,
+    'usage': __structure_usage,
+    'meminfo': lambda m: dict((k, int(v)) for k, v in m.items()),
+    'ss': __structure_ss,
+    'cpu': __structure_cpu,
+    'io': lambda io: dict((k, _jsonable(v)) for k, v in io[0].items()),
+}
+
+# The raw /proc/<pid>/stat of every process is only needed for the w table,
+# so it is left out of --json, whoever collected it.
+_JSON_SKIP = ('procs',)
+_JSON_PROBES = [x for x in _PROBES if x[0] not in _JSON_SKIP]
+
+
+def structured(data):
+    '''
+    Turn the data from collect() into plain dicts, lists and numbers for
+    json.dumps(), without formatting any of it. Probes that failed are
+    {'error': ..., 'type': ...}, and those in _JSON_SKIP are left out.
+    '''
+    ret = {}
+    for k, v in data.items():
+        if k in _JSON_SKIP:
+            continue
+        if k in _STRUCTURES and not isinstance(v, Exception):
+            v = _STRUCTURES[k](v)
+        ret[k] = _jsonable(v)
+    return ret
+
+
+def select_sections(include=None, exclude=None, sections=None):
+    '''
+    The 'sections' (_SECTIONS by default) named in 'include', or all of
+    them, less those named in 'exclude', in the order of the report. The
+    names are given as lists or as comma separated strings. Raises
+    ValueError for a section we don't have.
+    '''
+    sections = _SECTIONS if sections is None else sections
+    names = [x[0] for x in sections]
+
+    def split(x):
+        if isinstance(x, str):
+            x = [y.strip() for y in x.split(',') if y.strip()]
+        return x
+    include = split(include)
+    exclude = split(exclude) or []
+    for x in (include or []) + exclude:
+        if x not in names:
+            raise ValueError('no section {0!r}, there are: {1}'.format(
+                x, ', '.join(names)))
+    return [x for x in sections
+            if (include is None or x[0] in include) and x[0] not in exclude]
+
+
+def section_probes(sections, probes=None):
+    '''
+    The probes (_PROBES by default) that the 'sections' need, and only
+    those, so the others are never run.
+    '''
+    needed = set(p for x in sections for p in x[1])
+    return [x for x in (_PROBES if probes is None else probes)
+            if x[0] in needed]
+
+
+def main(timeout=None, sections=None, probes=None):
+    '''
+    Printing out our final product, of only the 'sections' if given, from
+    the 'probes' (_PROBES by default).
+    '''
+    if sections is None:
+        return render(collect(probes, timeout=timeout))
+    return render(collect(section_probes(sections, probes), timeout=timeout),
+                  sections)
+
+
+def capture(out, probes=None, timeout=None):
+    '''
+    collect() the 'probes', recording all of their raw inputs into the tar
+    archive 'out'. Returns the data, as collect() does.
+    '''
+    global _capture
+    _capture = Capture()
+    try:
+        data = collect(probes, timeout=timeout)
+    finally:
+        recorded, _capture = _capture, None
+    recorded.write(out)
+    return data
+
+
+def replay(path, probes=None, timeout=None):
+    '''
+    collect() the 'probes' from the inputs in 'path', a tar archive from
+    capture() or a directory tree, instead of from this system.
+    '''
+    global _replay
+    _replay = Replay(path)
+    try:
+        return collect(probes, timeout=timeout)
+    finally:
+        _replay = None
+
+
+_STATVFS_FIELDS = ['f_bsize', 'f_frsize', 'f_blocks', 'f_bfree', 'f_bavail',
+                   'f_files', 'f_ffree', 'f_favail', 'f_flag', 'f_namemax']
+
+
+def _jsonable(x):
+    '''
+    Turn the data from collect() into something json.dumps() can take.
+    '''
+    if isinstance(x, Exception):
+        return {'error': str(x), 'type': x.__class__.__name__}
+    elif isinstance(x, UtmpRecord):
+        x = x.asdict()
+        # ut_addr_v6 is binary, even where it happens to decode.
+        x['addr'] = binascii.hexlify(x['addr']).decode()
+        return dict((k, _jsonable(v)) for k, v in x.items())
+    elif isinstance(x, os.statvfs_result):
+        return dict((f, getattr(x, f)) for f in _STATVFS_FIELDS)
+    elif hasattr(x, '_asdict'):
+        # namedtuples
+        return dict((k, _jsonable(v)) for k, v in x._asdict().items())
+    elif isinstance(x, dict):
+        return dict((' '.join(k) if isinstance(k, tuple) else str(k),
+                     _jsonable(v)) for k, v in x.items())
+    elif isinstance(x, (list, tuple)):
+        return [_jsonable(v) for v in x]
+    elif isinstance(x, bytes):
+        # On python 2 bytes is str, so only what isn't text is hexlified.
+        try:
+            if isinstance(x, str):
+                x.decode('utf-8')
+                return x
+        except UnicodeDecodeError:
+            pass
+        return binascii.hexlify(x).decode()
+    return x
+
+
+def _set_colors(on):
+    '''
+    Turn the colors of the formatters on or off, whether we are on a tty or
+    not.
+    '''
+    for c, code in (('GREEN', '\033[1;32m'), ('YELLOW', '\033[1;33m'),
+                    ('RED', '\033[1;31m'), ('S', '\033[0m')):
+        setattr(bcolors, c, code if on else '')
+
+
+class SnapshotCache(object):
+    '''
+    Keeps the data of the probes warm, re-running each one when its TTL from
+    _PROBE_TTLS runs out, along with the report, the JSON and the metrics of
+    the latest snapshot. Those are rendered on refresh, so answering for them
+    is just a lookup. Only the 'formats' asked for are rendered.
+    '''
+    def __init__(self, probes=None, ttls=None, sections=None,
+                 formats=('text', 'color', 'json', 'metrics')):
+        self.probes = probes or _PROBES
+        self.ttls = ttls or _PROBE_TTLS
+        self.sections = sections
+        self.formats = formats
+        self.data = {}
+        self.updated = {}
+        self.running = {}
+        self.answers = {}
+
+    def due(self, now=None):
+        '''The probes whose data is stale'''
+        now = time.time() if now is None else now
+        return [x for x in self.probes
+                if now - self.updated.get(x[0], 0) >= self.ttls.get(x[0], 0)]
+
+    def wait(self, now=None):
+        '''Seconds until the next probe needs refreshing'''
+        now = time.time() if now is None else now
+        return max(0, min(self.updated.get(x[0], 0) + self.ttls.get(x[0], 0)
+                          for x in self.probes) - now)
+
+    def refresh(self):
+        '''
+        Re-run the probes that are due and re-render. Returns their names.
+        '''
+        due = self.due()
+        if not due:
+            return []
+        now = time.time()
+        self.data.update(collect(due, running=self.running))
+        for x in due:
+            self.updated[x[0]] = now
+        answers = {}
+        color = bool(bcolors.S)
+        try:
+            for f in ('color', 'text'):
+                if f in self.formats:
+                    _set_colors(f == 'color')
+                    answers[f] = render(self.data, self.sections)
+        finally:
+            _set_colors(color)
+        if 'json' in self.formats:
+            answers['json'] = json.dumps(structured(self.data),
+                                         sort_keys=True)
+        if 'metrics' in self.formats:
+            answers['metrics'] = format_metrics(self.data)
+        # Swap them in all at once for the server thread.
+        self.answers = dict((k, v.encode('utf-8'))
+                            for k, v in answers.items())
+        return [x[0] for x in due]
+
+    def run(self, stop=None):
+        '''Refresh until 'stop' (a threading.Event) is set'''
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            self.refresh()
+            stop.wait(max(self.wait(), 0.05))
+
+
+def __default_socket():
+    return __runtime_path('sock')
+
+
+def daemon(path=None, cache=None):
+    '''
+    Serve snapshots from a SnapshotCache over a Unix socket at 'path'. A
+    client sends one line, 'text', 'color', 'json' or 'metrics', and gets
+    that snapshot back before we close the connection. The socket is created
+    with the permissions of our umask; the snapshots include the failed
+    logins and process owners, so don't open it up to users that shouldn't
+    see them.
+    '''
+    path = path or __default_socket()
+    _runtime_dir(path, create=True)
+    try:
+        __from_daemon(path, 'text')
+    except (socket.error, IOError, OSError):
+        pass
+    else:
+        raise RuntimeError('a daemon is already running on ' + path)
+    cache = cache or SnapshotCache()
+    cache.refresh()
+    stop = threading.Event()
+    refresher = threading.Thread(target=cache.run, args=(stop,))
+    refresher.daemon = True
+    refresher.start()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(64)
+    # Clean up the socket when we are stopped.
+    signal.signal(signal.SIGTERM, lambda *a: sys.exit(0))
+    try:
+        while True:
+            conn = server.accept()[0]
+            try:
+                conn.settimeout(1)
+                req = conn.recv(64).decode('ascii', 'replace').strip()
+                conn.sendall(cache.answers.get(req or 'text', b''))
+            except (socket.error, IOError):
+                pass
+            finally:
+                conn.close()
+    finally:
+        stop.set()
+        server.close()
+        os.unlink(path)
+
+
+# The probes the exporter needs.
+_EXPORTER_PROBES = ('meminfo', 'usage', 'loadavg', 'users', 'ss')
+
+
+def exporter(address='127.0.0.1', port=9466, cache=None):
+    '''
+    Serve the metrics of a SnapshotCache at http://address:port/metrics.
+    The cache refreshes each probe on its own TTL in the background, and
+    scrapes only ever get its pre-built body, so they stay cheap however
+    often they come.
+    '''
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    cache = cache or SnapshotCache(
+        [x for x in _PROBES if x[0] in _EXPORTER_PROBES],
+        formats=('metrics',))
+    cache.refresh()
+    stop = threading.Event()
+    refresher = threading.Thread(target=cache.run, args=(stop,))
+    refresher.daemon = True
+    refresher.start()
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = cache.answers.get('metrics', b'')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((address, port), MetricsHandler)
+    try:
+        server.serve_forever()
+    finally:
+        stop.set()
+        server.server_close()
+
+
+def ndjson(interval, count=None, out=None):
+    '''
+    Write a JSON snapshot, with the 'time' it was taken, as a line to 'out'
+    every 'interval' seconds, 'count' times or forever. Each probe is only
+    re-run when its TTL is up, as in --daemon mode.
+    '''
+    out = out or sys.stdout
+    cache = SnapshotCache(_JSON_PROBES, formats=())
+    n = 0
+    while count is None or n < count:
+        start = time.time()
+        cache.refresh()
+        line = structured(cache.data)
+        line['time'] = start
+        out.write(json.dumps(line, sort_keys=True) + '\n')
+        out.flush()
+        n += 1
+        if count is None or n < count:
+            time.sleep(max(0, start + interval - time.time()))
+
+
+def __when_changed(changed, f):
+    '''
+    Wrap 'f' so it is only re-run when 'changed()' says its source changed,
+    returning the data of the last run otherwise. A run that fails is
+    retried on the next call.
+    '''
+    last = []
+
+    def g():
+        if changed() or not last:
+            last[:] = [f()]
+        return last[0]
+    return g
+
+
+def __every(seconds):
+    '''A change detector for sources we can't watch, firing every 'seconds'.'''
+    last = [time.time()]
 
-    p = """{sep}
-Hostname: {host}
-os-release: {osrelease}
-{sep}
-{ipaddrs}
-{sep}
-{wout}
-{sep}
-{fs}
-
-{inodes}
-{sep}
-Memory Used: {memory}
-Swap status: {swap}
-{sep}
-Connection Summary:
-{sssum}
-{sep}
-Connection Concentration:
-IN (top 3)::
-{nsin}
-OUT (top 3)::
-{nsout}
-{sep}
-Listening       Recv-Q Send-Q Processes
-{ssproc}
-{sep}""".format(sep=('-' * 75),
-                host=socket.gethostname(),
-                osrelease=release,
-                ipaddrs='\n'.join(format_ip_output(__ip())),
-                wout='\n'.join(format_w(la, up, ut)),
-                fs='\n'.join(format_size(sizes)),
-                inodes='\n'.join(format_inodes(sizes)),
-                memory=format_mem(meminfo),
-                swap=format_swap(meminfo),
-                sssum='\n'.join(sslist[:2]),
-                nsin='\n'.join(ssutn[0]),
-                nsout='\n'.join(ssutn[1]),
-                ssproc='\n'.join(format_ssntlp(sslist)))
-
-    return p
+    def changed():
+        if time.time() - last[0] < seconds:
+            return False
+        last[0] = time.time()
+        return True
+    return changed
+
+
+def __files_changed(files):
+    '''
+    A change detector for 'files' comparing their inode, mtime and size, and
+    whether they exist.
+    '''
+    def signature():
+        sig = []
+        for f in files:
+            try:
+                st = os.stat(f)
+                sig.append((st.st_ino, st.st_mtime, st.st_size))
+            except OSError:
+                sig.append(None)
+        return sig
+    last = [signature()]
+
+    def changed():
+        sig = signature()
+        if sig == last[0]:
+            return False
+        last[0] = sig
+        return True
+    return changed
+
+
+def __mounts_changed(mounts='/proc/self/mounts'):
+    '''
+    A change detector for the mount table. The kernel flags an open
+    /proc/self/mounts with POLLPRI whenever something is mounted or
+    unmounted.
+    '''
+    f = open(mounts)
+    p = select.poll()
+    p.register(f, select.POLLPRI | select.POLLERR)
+
+    def changed():
+        if not p.poll(0):
+            return False
+        # Re-reading it rearms the event.
+        f.seek(0)
+        f.read()
+        return True
+    return changed
+
+
+_RTMGRP_IPV4_IFADDR = 0x10
+_RTMGRP_IPV6_IFADDR = 0x100
+
+
+def __addrs_changed(fallback=60):
+    '''
+    A change detector for the addresses of the interfaces, subscribed to the
+    rtnetlink address groups. Where there's no netlink we look again every
+    'fallback' seconds.
+    '''
+    try:
+        s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                          socket.NETLINK_ROUTE)
+        s.bind((0, _RTMGRP_IPV4_IFADDR | _RTMGRP_IPV6_IFADDR))
+        s.setblocking(False)
+    except (AttributeError, socket.error):
+        return __every(fallback)
+
+    def changed():
+        ret = False
+        while True:
+            try:
+                s.recv(65536)
+            except socket.error as e:
+                # ENOBUFS means we missed some, which is a change too.
+                if e.errno == errno.ENOBUFS:
+                    ret = True
+                    continue
+                return ret
+            ret = True
+    return changed
+
+
+def _watch_probes():
+    '''
+    The probes of --interval mode. The slow sources, the release, the mount
+    list and the addresses, are only re-read when they change; /proc/net/snmp
+    is added for the rate of new connections.
+    '''
+    mounts = __when_changed(__mounts_changed(), __get_mounts)
+    probes = dict((x[0], x) for x in _PROBES)
+    probes['release'] = (
+        'release',
+        __when_changed(__files_changed(_RELEASE_FILES), __get_release), 2)
+    probes['ip'] = ('ip', __when_changed(__addrs_changed(), __ip), 5)
+    probes['usage'] = ('usage', lambda: __get_usage(mounts=mounts()), 10)
+    return [probes[x[0]] for x in _PROBES] + [
+        ('snmp', lambda: _parse_snmp(__get_file('/proc/net/snmp')), 2)]
+
+
+# The TTLs of --interval mode. Everything is re-run on every tick, but for
+# the utmp and process scans, which are too slow for that.
+_WATCH_TTLS = {'users': 5, 'procs': 5, 'history': 60}
+
+
+def _rates(prev, cur, dt):
+    '''
+    What changed per second between two snapshots of collect() 'dt' seconds
+    apart: the ESTAB sockets of every local ('in') and remote ('out') port,
+    the TCP connections opened actively and passively, the used bytes of
+    every mount and the used memory. Anything missing from either snapshot
+    is left out.
+    '''
+    def ok(x):
+        return all(x in d and not isinstance(d[x], Exception)
+                   for d in (prev, cur))
+    ret = {'dt': dt}
+    if ok('ss'):
+        for d in ('nin', 'nout'):
+            p, c = getattr(prev['ss'], d), getattr(cur['ss'], d)
+            ret[d[1:]] = dict((k, (c.get(k, 0) - p.get(k, 0)) / dt)
+                              for k in set(p) | set(c)
+                              if c.get(k, 0) != p.get(k, 0))
+    if ok('snmp'):
+        p, c = prev['snmp'].get('Tcp', {}), cur['snmp'].get('Tcp', {})
+        for k in ('ActiveOpens', 'PassiveOpens'):
+            if k in p and k in c:
+                ret[k] = (c[k] - p[k]) / dt
+    if ok('usage'):
+        def used(usage):
+            return dict((x[1], (x[6].f_blocks - x[6].f_bfree) *
+                         x[6].f_bsize) for x in usage if x[6] is not None)
+        p, c = used(prev['usage']), used(cur['usage'])
+        ret['disk'] = dict((k, (c[k] - p[k]) / dt) for k in c if k in p)
+    if ok('meminfo'):
+        def used(m):
+            return int(m['MemTotal']) - int(m.get('MemAvailable',
+                                                  m['MemFree']))
+        ret['mem'] = (used(cur['meminfo']) - used(prev['meminfo'])) * \
+            1024 / dt
+    return ret
+
+
+def format_rates(rates, n=3):
+    '''
+    Format the rates from _rates(): new TCP connections, the 'n' ports whose
+    ESTAB sockets changed the most each way, the growth of the mounts that
+    changed, and of the used memory.
+    '''
+    def sign(x, f='{0:.1f}'):
+        return ('+' if x > 0 else '') + f.format(x)
+
+    def human(x):
+        return ('+' if x > 0 else '') + __tohuman(x)
+    ret = ['Rates (per second, over {0:.1f}s):'.format(rates['dt'])]
+    if 'ActiveOpens' in rates:
+        ret.append('New TCP connections: {0:.1f} ({1:.1f} active, '
+                   '{2:.1f} passive)'.format(
+                       rates['ActiveOpens'] + rates['PassiveOpens'],
+                       rates['ActiveOpens'], rates['PassiveOpens']))
+    for d, name in (('in', 'IN'), ('out', 'OUT')):
+        if d in rates:
+            top = sorted(rates[d].items(), key=lambda x: -abs(x[1]))[:n]
+            ret.append('ESTAB {0} (top {1})::'.format(name, n))
+            ret.extend('{0:>7} {1}'.format(k, sign(v)) for k, v in top)
+    if 'disk' in rates:
+        ret.append('Disk growth:')
+        ret.extend('{0:>7} {1}'.format(human(rates['disk'][k]), k)
+                   for k in sorted(rates['disk']) if rates['disk'][k])
+    if 'mem' in rates:
+        ret.append('Memory used: {0}'.format(human(rates['mem'])))
+    return ret
+
+
+def watch(interval, count=None, out=None, sections=None):
+    '''
+    Print the report, or only its 'sections', every 'interval' seconds,
+    'count' times or forever, with the rates since the previous one at the
+    bottom. On a tty the screen is cleared first, like watch(1).
+    '''
+    out = out or sys.stdout
+    probes = _watch_probes()
+    if sections is None:
+        sections = _SECTIONS
+    else:
+        probes = section_probes(sections, probes) + [
+            x for x in probes if x[0] == 'snmp']
+    cache = SnapshotCache(probes, _WATCH_TTLS, formats=())
+    sections = sections + [
+        ('rates', ('rates',), lambda r: '\n'.join(format_rates(r)))]
+    prev = None
+    n = 0
+    while count is None or n < count:
+        start = time.time()
+        cache.refresh()
+        data = dict(cache.data)
+        if prev is not None:
+            data['rates'] = _rates(prev[1], cache.data, start - prev[0])
+        prev = start, dict(cache.data)
+        if out.isatty():
+            out.write('\033[H\033[2J')
+        out.write(render(data, sections) + '\n')
+        out.flush()
+        n += 1
+        if count is None or n < count:
+            time.sleep(max(0, start + interval - time.time()))
+
+
+# The probes of the snapshots fleet() merges.
+_FLEET_PROBES = ('hostname', 'release', 'usage', 'meminfo', 'ss')
+
+
+def _fleet_load(path):
+    '''
+    Load a snapshot for fleet(): a --capture archive, which is replayed, or
+    the output of --json. This runs in the worker processes, so it returns
+    the structured() data, or the error the way _jsonable() has it.
+    '''
+    try:
+        if path.endswith('.json'):
+            with open(path) as f:
+                return path, json.load(f)
+        return path, structured(replay(
+            path, [x for x in _PROBES if x[0] in _FLEET_PROBES]))
+    except Exception as e:
+        return path, _jsonable(e)
+
+
+def __failed(x):
+    return isinstance(x, dict) and set(x) == set(['error', 'type'])
+
+
+def _merge_fleet(snapshots, n=5):
+    '''
+    Merge the structured() snapshots of many hosts, a dict of their names to
+    their data, into a dict of:
+
+    'in', 'out': the 'n' ports with the most ESTAB sockets over all hosts,
+    as (sockets, port, hosts, the host with the most)
+    'disks': the 'n' fullest filesystems, as (used, total, host, mountpoint)
+    'memory': every host by memory used, that isn't MemAvailable (or
+    without buffers and cache on kernels without it), as (memory used, swap
+    used, host), each a fraction of the total
+    'releases': a Counter of the releases
+
+    Probes that failed on a host are left out.
+    '''
+    ret = {'hosts': len(snapshots), 'disks': [], 'memory': [],
+           'releases': Counter()}
+    conns = {'in': (Counter(), Counter(), {}),
+             'out': (Counter(), Counter(), {})}
+    for host, data in snapshots.items():
+        ss = data.get('ss')
+        if ss is not None and not __failed(ss):
+            for d, (total, hosts, busiest) in conns.items():
+                for port, c in ss[d].items():
+                    total[port] += c
+                    hosts[port] += 1
+                    if c > busiest.get(port, (0, None))[0]:
+                        busiest[port] = (c, host)
+        usage = data.get('usage')
+        if usage is not None and not __failed(usage):
+            for x in usage:
+                st = x['statvfs']
+                if x['stale'] or not st['f_blocks']:
+                    continue
+                ret['disks'].append(
+                    ((st['f_blocks'] - st['f_bfree']) * st['f_bsize'],
+                     st['f_blocks'] * st['f_bsize'], host, x['mountpoint']))
+        m = data.get('meminfo')
+        if m is not None and not __failed(m):
+            if 'MemAvailable' in m:
+                used = m['MemTotal'] - m['MemAvailable']
+            else:
+                used = m['MemTotal'] - m['MemFree'] - m.get('Buffers', 0) - \
+                    m.get('Cached', 0)
+            swap = m.get('SwapTotal', 0) - m.get('SwapFree', 0)
+            ret['memory'].append((used / m['MemTotal'],
+                                  swap / m['SwapTotal'] if swap else 0,
+                                  host))
+        rel = data.get('release')
+        if not __failed(rel):
+            ret['releases'][format_release(rel) if rel
+                            else 'Unknown Release'] += 1
+    for d, (total, hosts, busiest) in conns.items():
+        ret[d] = [(c, port, hosts[port], busiest[port][1])
+                  for port, c in total.most_common(n)]
+    ret['disks'] = heapq.nlargest(n, ret['disks'],
+                                  key=lambda x: x[0] / x[1])
+    ret['memory'].sort(reverse=True)
+    return ret
+
+
+def format_fleet(fleet, n=5, memerr=0.7, memwarn=0.5):
+    '''
+    Format the merged snapshots from fleet(): the busiest ports over all
+    hosts, the fullest filesystems, the 'n' hosts using the most memory and
+    how many hosts run each release.
+    '''
+    def memcolor(x):
+        if x > memerr:
+            return bcolors.RED
+        elif x > memwarn:
+            return bcolors.YELLOW
+        return bcolors.GREEN
+    ret = ['Hosts: {0}'.format(fleet['hosts'])]
+    for path, e in fleet.get('errors', []):
+        ret.append('{0}{1}: {2}{3}'.format(bcolors.RED, path, e['error'],
+                                           bcolors.S))
+    ret.append('Connection Concentration:')
+    for d, name in (('in', 'IN'), ('out', 'OUT')):
+        ret.append('{0} (top {1})::'.format(name, n))
+        ret.extend('{0:>7} {1:<6} {2} hosts, most on {3}'.format(*x)
+                   for x in fleet[d][:n])
+    ret.append('Fullest Filesystems:')
+    for used, total, host, mnt in fleet['disks'][:n]:
+        col, percent = __get_color(used, total)
+        ret.append('{0}{1:>6.0f}%{2} {3}:{4}'.format(col, percent, bcolors.S,
+                                                     host, mnt))
+    ret.append('Memory Pressure (memory, swap used):')
+    ret.extend('{0}{1:>6.1%}{2} {3}{4:>6.1%}{5} {6}'.format(
+        memcolor(mem), mem, bcolors.S, memcolor(swap), swap, bcolors.S, host)
+        for mem, swap, host in fleet['memory'][:n])
+    ret.append('Releases:')
+    ret.extend('{0:>7} {1}'.format(c, rel)
+               for rel, c in fleet['releases'].most_common())
+    return ret
+
+
+def fleet(path, workers=None, n=5):
+    '''
+    Load every snapshot in the directory 'path', --capture archives and
+    --json output, on a pool of 'workers' processes (one per CPU by
+    default) and merge them with _merge_fleet(). Snapshots are known by
+    their hostname, and those that can't be read are in 'errors' as
+    (path, error).
+    '''
+    from multiprocessing import Pool
+    files = sorted(os.path.join(path, x) for x in os.listdir(path)
+                   if x.endswith(('.tar', '.tar.gz', '.tgz', '.json')))
+    pool = Pool(workers)
+    try:
+        loaded = pool.map(_fleet_load, files, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    snapshots = {}
+    errors = []
+    for f, data in loaded:
+        if __failed(data):
+            errors.append((f, data))
+            continue
+        host = data.get('hostname')
+        if not host or __failed(host):
+            host = os.path.basename(f)
+        elif host in snapshots:
+            host = '{0} ({1})'.format(host, os.path.basename(f))
+        snapshots[host] = data
+    ret = _merge_fleet(snapshots, n)
+    ret['errors'] = errors
+    return ret
+
+
+def __from_daemon(path=None, req='text', timeout=1):
+    '''
+    Ask a running daemon for a snapshot. Raises socket.error if there isn't
+    one, or if the socket isn't ours or root's, since anyone could have put
+    one there to feed us a made up report.
+    '''
+    path = path or __default_socket()
+    _runtime_dir(path)
+    st = os.lstat(path)
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid not in (0, os.geteuid()):
+        raise socket.error('{0} is not our daemon'.format(path))
+    c = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        c.settimeout(timeout)
+        c.connect(path)
+        c.sendall(req.encode('ascii') + b'\n')
+        ret = []
+        while True:
+            b = c.recv(65536)
+            if not b:
+                break
+            ret.append(b)
+    finally:
+        c.close()
+    if not ret:
+        raise socket.error('empty answer from the daemon')
+    return b''.join(ret).decode('utf-8')
 
 
 def errors():
@@ -850,8 +4083,153 @@ def errors():
         return '\n'.join(errors)
 
 
-if __name__ == '__main__':
-    print(main())
+def __options(args=None):
+    from optparse import OptionParser
+    p = OptionParser(description='Print a summary of the system status.')
+    p.add_option('--daemon', action='store_true', default=False,
+                 help='stay resident, serving cached snapshots on --socket')
+    p.add_option('--socket', default=None,
+                 help='the daemon socket (default: /run/ss.py.sock as root, '
+                      'or one in $XDG_RUNTIME_DIR)')
+    p.add_option('--exporter', metavar='[ADDRESS:]PORT', default=None,
+                 help='serve Prometheus metrics over HTTP at /metrics, on '
+                      '127.0.0.1 unless an address is given')
+    p.add_option('--json', action='store_true', default=False,
+                 help='print the collected data as JSON instead of the report')
+    p.add_option('--ndjson', metavar='SECONDS', type='float', default=None,
+                 help='print a JSON snapshot per line every SECONDS')
+    p.add_option('--interval', metavar='SECONDS', type='float', default=None,
+                 help='print the report every SECONDS, with rates of change')
+    p.add_option('--count', type='int', default=None,
+                 help='stop after this many --ndjson or --interval snapshots')
+    p.add_option('--capture', metavar='FILE', default=None,
+                 help='also record every input of the report into the tar '
+                      'archive FILE')
+    p.add_option('--replay', metavar='FILE', default=None,
+                 help='print the report from an archive made with --capture')
+    p.add_option('--root', metavar='DIR', default=None,
+                 help='print the report from the files under DIR, laid out '
+                      'like a --capture archive')
+    p.add_option('--fleet', metavar='DIR', default=None,
+                 help='merge the --capture archives and --json snapshots '
+                      'of many hosts in DIR')
+    p.add_option('--workers', type='int', default=None,
+                 help='the processes --fleet loads snapshots with (default: '
+                      'one per CPU)')
+    p.add_option('--profile', action='store_true', default=False,
+                 help='print the time, CPU, subprocesses, bytes read and '
+                      'allocations of every probe and section to stderr')
+    p.add_option('--pstats', metavar='FILE', default=None,
+                 help='with --profile, also write a cProfile of them to FILE')
+    p.add_option('--sections', metavar='LIST', default=None,
+                 help='only collect and print these sections, comma '
+                      'separated, of: ' + ', '.join(x[0] for x in _SECTIONS))
+    p.add_option('--exclude', metavar='LIST', default=None,
+                 help='collect and print all sections but these')
+    p.add_option('--group-by', metavar='BY', default=None,
+                 choices=['auto', 'prefix', 'ip', 'port', 'process'],
+                 help='group the connections of the peers section by auto '
+                      '(the busiest networks, the default), prefix (/24 and '
+                      '/64), ip, port or process')
+    p.add_option('--approx', type='int', metavar='SIZE', default=None,
+                 help='count the ports of the connections approximately, '
+                      'in at most SIZE counters each, for hosts with '
+                      'millions of sockets')
+    p.add_option('--no-daemon', action='store_true', default=False,
+                 help="collect everything ourselves, even if there is a "
+                      "daemon running")
+    opts = p.parse_args(args)[0]
+    if opts.sections or opts.exclude:
+        try:
+            opts.sections = select_sections(opts.sections, opts.exclude)
+        except ValueError as e:
+            p.error(str(e))
+    if opts.approx is not None and opts.approx < 1:
+        p.error('--approx has to be at least 1')
+    if opts.ndjson is not None and opts.ndjson < 1:
+        p.error('--ndjson has to be at least 1')
+    if opts.group_by:
+        opts.sections = [
+            (name, probes, (lambda ss: __render_peers(ss, opts.group_by))
+             if name == 'peers' else f)
+            for name, probes, f in opts.sections or _SECTIONS]
+    return opts
+
+
+def cli(args=None):
+    '''
+    Run ss.py from the command line. Without --daemon the report comes from
+    a running daemon if there is one, and is collected here if not.
+    '''
+    opts = __options(args)
+    if not (opts.profile or opts.pstats):
+        return __cli(opts)
+    # Profile collecting it, not asking the daemon for it.
+    opts.no_daemon = True
+    with Profiler(pstats=bool(opts.pstats)) as profiler:
+        ret = __cli(opts)
+    print('\n'.join(format_profile(profiler.stats)), file=sys.stderr)
+    if opts.pstats:
+        profiler.dump(opts.pstats)
+    return ret
+
+
+def __cli(opts):
+    if opts.daemon:
+        return daemon(opts.socket)
+    if opts.exporter:
+        address, _, port = opts.exporter.rpartition(':')
+        return exporter(address or '127.0.0.1', int(port))
+    if opts.ndjson is not None:
+        return ndjson(opts.ndjson, opts.count)
+    if opts.interval:
+        return watch(opts.interval, opts.count, sections=opts.sections)
+    if opts.fleet:
+        print('\n'.join(format_fleet(fleet(opts.fleet, opts.workers))))
+        return
+    probes = _JSON_PROBES if opts.json else _PROBES
+    if opts.approx:
+        probes = approx_probes(probes, opts.approx)
+        # The daemon counts them exactly.
+        opts.no_daemon = True
+    if opts.sections is not None:
+        probes = section_probes(opts.sections, probes)
+        # The daemon only has whole reports.
+        opts.no_daemon = True
+    if opts.capture or opts.replay or opts.root:
+        if opts.capture:
+            data = capture(opts.capture, probes)
+        else:
+            data = replay(opts.replay or opts.root, probes)
+        print(json.dumps(__profiled('format:json', structured, data),
+                         sort_keys=True) if opts.json
+              else render(data, opts.sections))
+        return
+    if opts.json:
+        out = None
+        if not opts.no_daemon:
+            try:
+                out = __from_daemon(opts.socket, 'json')
+            except (socket.error, IOError, OSError):
+                pass
+        print(out or json.dumps(
+            __profiled('format:json', structured, collect(probes)),
+            sort_keys=True))
+        return
+    out = None
+    if not opts.no_daemon:
+        try:
+            out = __from_daemon(
+                opts.socket, 'color' if sys.stdout.isatty() else 'text')
+        except (socket.error, IOError, OSError):
+            pass
+    print(out or main(sections=opts.sections,
+                      probes=approx_probes(_PROBES, opts.approx)
+                      if opts.approx else None))
     e = errors()
     if e:
         print(e, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -7,9 +7,24 @@ Simple tests for some of the functions in the ss.py script
 import unittest
 import ss
 import collections
+import json
+import mmap
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import time
+from binascii import hexlify, unhexlify
 from ss import __strip as ssstrip
 
 
+def utmp_record(typ, user, line, host, t):
+    '''Pack a single utmp record'''
+    return struct.pack(ss._UTMP_FMT, typ, 100, line.encode(), b'',
+                       user.encode(), host.encode(), 0, 0, t, 0, b'', b'')
+
+
 class TestSystemStatus(unittest.TestCase):
     statvfsout = collections.namedtuple('statvfs_result', ['f_bsize',
                                                            'f_blocks',
@@ -78,6 +93,41 @@ MemAvailable:    5763740 kB'''
     ssutn = [['      3 55151', '      2 42337', '      1 46661'],
              ['      3 993', '      2 7700', '      1 5127']]
 
+    # /proc/net/tcp prints addresses as host order words.
+    lo = '{0:08X}'.format(
+        struct.unpack('=I', socket.inet_aton('127.0.0.1'))[0])
+    procnettcp = '\n'.join([
+        '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when '
+        'retrnsmt   uid  timeout inode',
+        '   0: {0}:80F1 00000000:0000 0A 00000000:00000000 00:00000000 '
+        '00000000  1000        0 12345 1 0000000000000000 100 0 0 10 0',
+        '   1: {0}:A561 {0}:1E14 01 00000002:00000001 00:00000000 '
+        '00000000  1000        0 12346 1 0000000000000000 20 4 30 10 -1',
+    ]).format(lo)
+    procnetrecords = [
+        ss.SsRecord('tcp', 'LISTEN', '0', '0', '127.0.0.1:33009',
+                    '0.0.0.0:*', 'users:(("weechat",pid=548,fd=14))'),
+        ss.SsRecord('tcp', 'ESTAB', '1', '2', '127.0.0.1:42337',
+                    '127.0.0.1:7700', '')]
+
+    # A NETLINK_SOCK_DIAG tcp dump recorded on x86_64: one LISTEN socket, one
+    # ESTAB socket and the NLMSG_DONE that ends the dump.
+    inetdiag = unhexlify(''.join([
+        '7c0000001400020001000000150f0000020a0000bc8f00007f00000100000000',
+        '0000000000000000000000000000000000000000000000000000000002000000',
+        '00000000000000000000000000040000feff0000920300000500080000000000',
+        '08000f00000000000c001500010000000000000006001600520000007c000000',
+        '1400020001000000150f000002010200ed54bc8f7f0000010000000000000000',
+        '000000007f000001000000000000000000000000000000000300000000000000',
+        '50030000000000000000000000000000d50b0000050008000000000008000f00',
+        '000000000c001500010000000000000006001600520000001400000003000200',
+        '01000000150f000000000000']))
+    inetdiagrecords = [
+        ss.SsRecord('tcp', 'LISTEN', '0', '1024', '127.0.0.1:48271',
+                    '0.0.0.0:*', 'users:(("mpd",pid=558,fd=3))'),
+        ss.SsRecord('tcp', 'ESTAB', '0', '0', '127.0.0.1:60756',
+                    '127.0.0.1:48271', '')]
+
     utmpbytes = b"\x02\x00\x00\x00\x00\x00\x00\x00~\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00~~\x00\x00reboot\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x003.14.3-1-ARCH\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xe0\xc0kS\xeb'\t\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
     utmpdict = {'Line': '~',
                 'addr': b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00',
@@ -85,6 +135,21 @@ MemAvailable:    5763740 kB'''
                 'PID': 0, 'User': 'reboot', 'session': 0, 'time_ms': 600043,
                 'type': 2, 'exit_status': 0, 'time_s': 1399570656}
 
+    wtmpbytes = b''.join([
+        utmp_record(2, 'reboot', '~', '3.14.3-1-ARCH', 1000),
+        utmp_record(7, 'wgiokas', 'tty1', '', 1010),
+        utmp_record(7, 'root', 'pts/0', '10.0.0.1', 1020),
+        utmp_record(8, '', 'pts/0', '', 1030),
+        utmp_record(7, 'wgiokas', 'pts/1', '10.0.0.2', 1040),
+        utmp_record(7, 'wgiokas', 'pts/2', '10.0.0.2', 1050)])
+
+    procstat = ('20920 (tmux: server) S 1 20920 20920 34817 21004 4194560 '
+                '1297 0 0 0 150 50 0 0 20 0 1 0 3456 18169856 1024 '
+                '18446744073709551615 1 1 0 0 0 0 0 3 1 0 0 0 0 0 0 0 0 0 0 0 '
+                '0 0')
+    procstatrec = ss.ProcStat(20920, 'tmux: server', 'S', 1, 20920, 20920,
+                              34817, 21004, 150, 50, 3456, '')
+
     redhat_release = ['Fedora release 21 (Rawhide)']
     rh_release_dict = {'NAME': 'Fedora', 'VERSION': '21 (Rawhide)'}
 
@@ -121,11 +186,212 @@ MemAvailable:    5763740 kB'''
         'This runs format_size, make sure the full output is okay'
         self.assertEqual(ss.format_size(self.dfout), self.dfout_correct)
 
+    def test_format_size_stale(self):
+        '''Stale mounts are shown, but not queried'''
+        self.assertEqual(
+            ss.format_size([self.dfout_base + [None]])[1].split(),
+            [ss.bcolors.RED + '/dev/sda1', '-', '-', '-', 'stale',
+             '/' + ss.bcolors.S])
+        self.assertEqual(
+            ss.format_inodes([self.dfout_base + [None]])[1].split()[4],
+            'stale')
+
+    def hang_statvfs(self):
+        '''Make the statvfs workers never answer for the path "hang"'''
+        worker = ss._STATVFS_WORKER
+        self.addCleanup(setattr, ss, '_STATVFS_WORKER', worker)
+        self.addCleanup(ss._hung_workers.clear)
+        ss._STATVFS_WORKER = worker.replace(
+            'import os, re, sys', 'import os, re, sys, time').replace(
+            '    try:\n',
+            "    if line.strip() == 'hang':\n        time.sleep(60)\n"
+            "    try:\n", 1)
+
+    def test_statvfs(self):
+        '''statvfs in the workers, and a hung one is stale'''
+        statvfs = getattr(ss, '__statvfs')
+        st = statvfs(['/', '/nonexistent'])
+        self.assertEqual(list(st), ['/'])
+        self.assertEqual(st['/'].f_bsize, os.statvfs('/').f_bsize)
+        # A worker that never answers for 'hang' is killed after 'timeout'
+        self.hang_statvfs()
+        start = time.time()
+        st = statvfs(['hang', '/'], timeout=0.5, workers=1)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(st['hang'], None)
+        self.assertEqual(st['/'].f_bsize, os.statvfs('/').f_bsize)
+
+    def test_statvfs_hung(self):
+        '''A stale mount isn't tried again while its worker is hung'''
+        self.hang_statvfs()
+        spawned = []
+        real = ss.subprocess
+
+        class Subprocess(object):
+            PIPE = real.PIPE
+
+            def Popen(self, *args, **kwargs):
+                w = real.Popen(*args, **kwargs)
+                spawned.append(w)
+                self.kill = w.kill
+                # Killing a worker in D state does nothing
+                w.kill = lambda: None
+                return w
+        self.addCleanup(setattr, ss, 'subprocess', real)
+        ss.subprocess = Subprocess()
+        statvfs = getattr(ss, '__statvfs')
+        for _ in range(2):
+            self.assertEqual(statvfs(['hang'], timeout=0.5), {'hang': None})
+        self.assertEqual(len(spawned), 1)
+        ss.subprocess.kill()
+        spawned[0].wait()
+        self.assertEqual(statvfs(['hang'], timeout=0.5), {'hang': None})
+        self.assertEqual(len(spawned), 2)
+        ss.subprocess.kill()
+
+    def test_get_usage_dedup(self):
+        '''Mounts of the same device are only queried once'''
+        queried = []
+
+        def statvfs(paths, timeout):
+            queried.extend(paths)
+            return dict((x, self.dfout_okay[-1]) for x in paths)
+        self.addCleanup(setattr, ss, '__statvfs', getattr(ss, '__statvfs'))
+        setattr(ss, '__statvfs', statvfs)
+        mounts = [['/dev/sda1', '/', 'ext4'], ['/dev/sda1', '/srv', 'ext4'],
+                  ['/dev/sdb1', '/home', 'ext4']]
+        devices = {'/': '8:1', '/srv': '8:1', '/home': '8:17'}
+        usage = getattr(ss, '__get_usage')(mounts=(mounts, devices))
+        self.assertEqual(sorted(queried), ['/', '/home'])
+        self.assertEqual([x[1] for x in usage], ['/', '/srv', '/home'])
+        self.assertEqual(usage[1][-1], self.dfout_okay[-1])
+
+    def test_disk_io(self):
+        '''Work out the I/O of every mount from /proc/diskstats'''
+        prev = ss._parse_diskstats(
+            '   8       0 sda 100 0 800 50 200 0 1600 150 0 100 200 0 0 0 0\n'
+            '   8       1 sda1 10 0 80 5 20 0 160 15 0 10 20 0 0 0 0\n'
+            '   7       0 loop0 0 0 0 0\n')
+        self.assertEqual(sorted(prev), ['8:0', '8:1'])
+        cur = ss._parse_diskstats(
+            '   8   0 sda 300 0 2400 250 400 0 3200 350 0 1100 200 0 0 0 0\n'
+            '   8       1 sda1 10 0 80 5 20 0 160 15 0 10 20 0 0 0 0\n'
+            '   8      16 sdb 1 0 8 1 0 0 0 0 0 1 1 0 0 0 0\n')
+        io = ss._disk_io(prev, cur, 2.0)
+        self.assertEqual(sorted(io), ['8:0', '8:1'])
+        self.assertEqual(io['8:0'], ss.DiskIO('sda', 100, 100, 409600,
+                                              409600, 1.0, 50.0))
+        self.assertEqual(io['8:1'].util, 0)
+        usage = [self.dfout_warn, ['/dev/sdb', '/srv', 0, 0, 0, 0, None],
+                 ['/dev/sda', '/mnt', 0, 0, 0, 0, None]]
+        self.addCleanup(ss._set_colors, bool(ss.bcolors.S))
+        ss._set_colors(False)
+        lines = ss.format_io(usage, (io, {'/': '8:0', '/srv': '8:16'}))
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[1].split(),
+                         ['/dev/sda1', '85%', '100', '100', '400K', '400K',
+                          '1.0ms', '50%', '/'])
+        self.assertEqual(lines[2].split()[-1], '/mnt')
+
+    def test_parse_mountinfo(self):
+        '''Get the device number of every mountpoint'''
+        self.assertEqual(ss._parse_mountinfo(
+            '22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n'
+            '40 22 8:1 /srv /mnt/my\\040srv rw - ext4 /dev/sda1 rw\n'
+            '41 22 0:40 / /proc rw - proc proc rw\n'),
+            {'/': '8:1', '/mnt/my\\040srv': '8:1', '/proc': '0:40'})
+
     def test_format_ip_output(self):
         '''We should get the correct output from parse_ip_output'''
         self.assertEqual(list(ss.format_ip_output(self.ipoutput)),
                          self.good_ip_out)
 
+    def test_parse_ip_output(self):
+        '''Parse the addresses out of 'ip -o a' '''
+        ips = ss._parse_ip_output(self.ipoutput)
+        self.assertEqual(len(ips), 7)
+        self.assertEqual(ips[3], ss.IpAddr(
+            'eth0', 'inet6', '2001:4802:7801:102:7eb4:d9f4:ff20:1ba7', 64,
+            'global'))
+
+    def test_parse_rtm_addr(self):
+        '''Parse the addresses out of rtnetlink RTM_NEWADDR messages'''
+        def msg(mtype, body):
+            return struct.pack('=LHHLL', 16 + len(body), mtype, 2, 1, 0) + body
+
+        def attr(atype, value):
+            pad = b'\x00' * (-len(value) % 4)
+            return struct.pack('=HH', 4 + len(value), atype) + value + pad
+        buf = msg(20, struct.pack('=BBBBL', socket.AF_INET, 24, 0, 0, 4) +
+                  attr(1, socket.inet_aton('192.0.2.2')) +
+                  attr(2, socket.inet_aton('192.0.2.2')) +
+                  attr(3, b'eth0:1\x00')) + \
+            msg(20, struct.pack('=BBBBL', socket.AF_INET6, 64, 0, 253, 4) +
+                attr(1, socket.inet_pton(socket.AF_INET6, 'fe80::1')))
+        self.assertEqual(ss._parse_rtm_addr(buf), ([
+            ss.IpAddr('eth0:1', 'inet', '192.0.2.2', 24, 'global'),
+            ss.IpAddr('4', 'inet6', 'fe80::1', 64, 'link')], False))
+        addrs, done = ss._parse_rtm_addr(buf + msg(3, b'\x00' * 4),
+                                         {4: 'eth0'})
+        self.assertTrue(done)
+        self.assertEqual([x.ifname for x in addrs], ['eth0', 'eth0'])
+        self.assertEqual(list(ss.format_ip_output(addrs)),
+                         ['eth0    192.0.2.2'])
+
+    def test_parse_if_inet6(self):
+        '''Parse the IPv6 addresses out of /proc/net/if_inet6'''
+        self.assertEqual(ss._parse_if_inet6(
+            'fe8000000000000000fc00fffe000001 04 40 20 80     eth0\n'
+            '00000000000000000000000000000001 01 80 10 80       lo\n'
+            'fd000000000000000000000000000002 04 40 00 82     eth0\n'), [
+                ss.IpAddr('eth0', 'inet6', 'fe80::fc:ff:fe00:1', 64, 'link'),
+                ss.IpAddr('lo', 'inet6', '::1', 128, 'host'),
+                ss.IpAddr('eth0', 'inet6', 'fd00::2', 64, 'global')])
+
+    def test_structured(self):
+        '''Structured data for --json, with no formatting'''
+        data = ss.structured({
+            'usage': [self.dfout_okay, self.dfout_base + [None]],
+            'loadavg': '0.09 0.15 0.21 1/100 2000',
+            'meminfo': self.correctmem,
+            'ss': ss._scan_ss(self.ssout),
+            'ip': ss.ProbeTimeout('timed out'),
+            'procs': {('1', 5): self.procstatrec}})
+        # Whether a daemon collected the processes or not
+        self.assertNotIn('procs', data)
+        self.assertEqual(data['usage'][0]['statvfs']['f_bfree'], 99)
+        self.assertEqual(data['usage'][1]['stale'], True)
+        self.assertEqual(data['loadavg']['load5'], 0.15)
+        self.assertEqual(data['loadavg']['total'], 100)
+        self.assertEqual(data['meminfo']['MemFree'], 694180)
+        self.assertEqual(data['ss']['in'], {'55151': 3, '42337': 2,
+                                            '46661': 1})
+        self.assertEqual(data['ip']['type'], 'ProbeTimeout')
+        json.dumps(data)
+
+    def test_merge_fleet(self):
+        '''Snapshots of many hosts merged into one view'''
+        a = ss.structured({
+            'usage': [self.dfout_okay, self.dfout_base + [None]],
+            'meminfo': self.correctmem, 'ss': ss._scan_ss(self.ssout),
+            'release': {'NAME': 'Arch Linux', 'VERSION': 'rolling'}})
+        b = ss.structured({
+            'usage': [self.dfout_err], 'meminfo': self.correctmem,
+            'ss': ss._scan_ss(self.ssout[:4]),
+            'release': ss.ProbeTimeout('timed out')})
+        fleet = ss._merge_fleet({'a': a, 'b': b}, n=2)
+        self.assertEqual(fleet['hosts'], 2)
+        self.assertEqual(fleet['in'][0][1:], ('55151', 2, 'a'))
+        self.assertEqual(fleet['in'][0][0],
+                         3 + ss._scan_ss(self.ssout[:4]).nin['55151'])
+        self.assertEqual(fleet['disks'], [(99 * 4096, 409600, 'b', '/'),
+                                          (4096, 409600, 'a', '/')])
+        self.assertEqual([x[2] for x in fleet['memory']], ['b', 'a'])
+        self.assertEqual(fleet['releases'], {'Arch Linux, rolling': 1})
+        lines = ss.format_fleet(fleet, n=2)
+        self.assertEqual(lines[0], 'Hosts: 2')
+        self.assertIn('      1 Arch Linux, rolling', lines)
+
     def test_strip(self):
         '''Make sure we correctly strip bytes'''
         for s in ((('a', b'\x01\x00'), '\x00', 'b', ('a', '\x01')),
@@ -143,22 +409,612 @@ MemAvailable:    5763740 kB'''
         self.assertEqual(list(ss.format_ssntlp(self.ssout)),
                          self.ssntlp)
 
+    def test_parse_users(self):
+        '''Parse the processes of a socket'''
+        self.assertEqual(
+            ss._parse_users('users:(("mpd",pid=558,fd=3),'
+                            '("systemd",pid=353,fd=19))'),
+            [('mpd', '558', '3'), ('systemd', '353', '19')])
+        self.assertEqual(ss._parse_users(''), [])
+
+    def test_parse_cgroup(self):
+        '''Find the unit or container scope of a process'''
+        self.assertEqual(ss._parse_cgroup('0::/system.slice/mpd.service\n'),
+                         'mpd.service')
+        self.assertEqual(ss._parse_cgroup(
+            '12:pids:/kubepods/burstable/pod1a2b/cri-containerd-9f.scope\n'
+            '1:name=systemd:/kubepods/burstable/pod1a2b\n'),
+            'cri-containerd-9f.scope')
+        self.assertEqual(ss._parse_cgroup('0::/user.slice/foo\n'), 'foo')
+        self.assertEqual(ss._parse_cgroup('0::/\n'), None)
+
+    def test_proc_cache(self):
+        '''Owners are looked up again once the pid is reused'''
+        cache = ss.ProcCache(size=2)
+        reads = []
+
+        def read(name, starttime):
+            return lambda: reads.append(name) or ss.ProcOwner(
+                name, name, None, starttime)
+        self.assertEqual(cache.get('1', 10, read('a', 10)).name, 'a')
+        self.assertEqual(cache.get('1', 10, read('b', 10)).name, 'a')
+        self.assertEqual(cache.get('1', 20, read('c', 20)).name, 'c')
+        cache.get('2', 10, read('d', 10))
+        cache.get('3', 10, read('e', 10))
+        self.assertEqual(sorted(cache.entries), ['2', '3'])
+        self.assertEqual(reads, ['a', 'c', 'd', 'e'])
+        scan = ss._scan_ss(self.ssout)._replace(
+            owners={'558': ss.ProcOwner('mpd', 'mpd', 'mpd.service', 1)})
+        self.assertEqual(list(ss.format_ssntlp(scan))[1],
+                         ':::7700              0    128 "mpd",pid=558,fd=3 '
+                         '(mpd.service), "systemd",pid=353,fd=19')
+
     def test_ssutn(self):
         '''Test ss -ntu output formatting.'''
         self.assertEqual(
             [list(x) for x in ss.format_ssutn(self.ssout, header=2)],
             self.ssutn)
 
+    def test_scan_ss(self):
+        '''A single scan feeds all of the ss formatters'''
+        scan = ss._scan_ss(iter(self.ssout))
+        self.assertEqual(scan.states, {('tcp', 'ESTAB'): 6,
+                                       ('tcp', 'LISTEN'): 2})
+        self.assertEqual(list(ss.format_ssntlp(scan)), self.ssntlp)
+        self.assertEqual([list(x) for x in ss.format_ssutn(scan)],
+                         self.ssutn)
+
+    def test_rollup_peers(self):
+        '''Peers roll up into the prefixes that are big enough'''
+        peers = ss.Counter({'10.0.0.1': 5, '10.0.0.2': 5, '10.0.1.1': 1,
+                            '10.9.0.1': 1, '[2001:db8::1]': 4,
+                            '[::ffff:10.0.0.1]': 2, '*': 3})
+        self.assertEqual(ss._rollup_peers(peers, 'ip')['10.0.0.1'], 7)
+        self.assertEqual(ss._rollup_peers(peers, 'prefix'),
+                         {'10.0.0.0/24': 12, '10.0.1.0/24': 1,
+                          '10.9.0.0/24': 1, '2001:db8::/64': 4})
+        self.assertEqual(ss._rollup_peers(peers, 'auto', share=0.1),
+                         {'10.0.0.1': 7, '10.0.0.2': 5, '2001:db8::1': 4,
+                          '0.0.0.0/0': 2})
+        self.assertEqual(ss._rollup_peers(peers, 'auto', share=0.5),
+                         {'10.0.0.0/24': 12, '::/0': 4, '0.0.0.0/0': 2})
+
+    def test_format_peers(self):
+        '''Group the ESTAB sockets by their peers, ports and processes'''
+        self.assertEqual(ss.format_peers(self.ssout, 'prefix', n=2),
+                         ['      3 173.194.64.0/24',
+                          '      2 127.0.0.0/24'])
+        self.assertEqual(ss.format_peers(self.ssout, 'process', n=1),
+                         ['      3 offlineimap'])
+        self.assertEqual(ss.format_peers(ss._scan_ss(self.ssout, peers=True),
+                                         'port', n=1),
+                         ['      3 55151'])
+
+    def test_space_saving(self):
+        '''A SpaceSaving keeps the heavy hitters, with bounds on the rest'''
+        stream = ['80'] * 50 + ['443'] * 30 + [str(x) for x in range(100)]
+        # '80' is in the range() too.
+        counts = ss.SpaceSaving(size=4)
+        for i in range(0, len(stream), 10):
+            counts.update(stream[i:i + 10])
+        self.assertTrue(len(counts) < 8)
+        self.assertEqual(counts.most_common(2), [('80', 51), ('443', 30)])
+        exact = ss.Counter(stream)
+        for elem, c in counts.items():
+            self.assertTrue(c - counts.errors.get(elem, 0) <= exact[elem] <= c)
+        self.assertTrue(max(exact[x] for x in exact if x not in counts)
+                        <= counts.floor)
+
+    def test_sketch_ss(self):
+        '''The sketched sockets format like the exact ones'''
+        scan = ss._sketch_ss(self.ssout, size=2, chunk=3)
+        self.assertEqual(scan.peers.most_common(1), [('173.194.64.109', 3)])
+        self.assertEqual(scan.states, {('tcp', 'ESTAB'): 6,
+                                       ('tcp', 'LISTEN'): 2})
+        self.assertEqual(len(scan.listeners), 2)
+        self.assertEqual(list(ss.format_ssutn(scan, n=1)[0]),
+                         ['      3 55151'])
+        scan.nin.errors['55151'] = 1
+        self.assertEqual(list(ss.format_ssutn(scan, n=1)[0]),
+                         ['      3 55151 (error <= 1)'])
+
+    def test_sketch_ss_streams(self):
+        '''The sketch only reads a chunk of the sockets ahead'''
+        read = [0]
+
+        def lines():
+            header, _, estab = self.procnettcp.splitlines()
+            yield header
+            for _ in range(1000):
+                read[0] += 1
+                yield estab
+        scanned = []
+        scan_ss = ss._scan_ss
+
+        def scan(part, peers=False):
+            scanned.append(read[0])
+            return scan_ss(part, peers)
+        self.addCleanup(setattr, ss, '_scan_ss', scan_ss)
+        ss._scan_ss = scan
+        sketch = ss._sketch_ss(ss._iter_proc_net(lines(), 'tcp'), size=10,
+                               chunk=100)
+        self.assertEqual(scanned, list(range(100, 1001, 100)))
+        self.assertEqual(sketch.nout['7700'], 1000)
+
+    def test_approx_report(self):
+        '''A whole report can be made with the sockets sketched'''
+        data = ss.collect(ss.approx_probes(ss._PROBES, 10))
+        self.assertIsNotNone(data['ss'].peers)
+        report = ss.render(data)
+        self.assertIn('Connection Concentration', report)
+        self.assertIn('Connections by peer network', report)
+        self.assertIsInstance(ss.structured(data)['ss']['peers'], dict)
+
+    def test_sssum(self):
+        '''Summarize the sockets in the ss output'''
+        self.assertEqual(
+            ss.format_sssum(self.ssout),
+            ['Total: 8',
+             'TCP:   8 (estab 6, listen 2, timewait 0)  UDP: 0'])
+
+    def test_parse_proc_net(self):
+        '''Parse /proc/net/tcp into the same records ss lines give us'''
+        self.assertEqual(
+            ss._parse_proc_net(self.procnettcp, 'tcp',
+                               owners={'12345': self.procnetrecords[0][6]}),
+            self.procnetrecords)
+
+    def test_parse_inet_diag(self):
+        '''Decode a recorded sock_diag dump'''
+        owners = {'914': self.inetdiagrecords[0][6]}
+        self.assertEqual(ss._parse_inet_diag(self.inetdiag, 'tcp', owners),
+                         (self.inetdiagrecords, True))
+        # A dump can be split over several reads
+        self.assertEqual(
+            ss._parse_inet_diag(self.inetdiag[:124], 'tcp', owners),
+            (self.inetdiagrecords[:1], False))
+
+    def test_inet_diag_timewait(self):
+        '''TIME-WAIT sockets from netlink make it into the summary'''
+        self.assertTrue(ss._INET_DIAG_STATES & (1 << 6))
+        lo = socket.inet_aton('127.0.0.1') + b'\0' * 12
+        msgs = []
+        for state in (6, 6, 1):
+            msg = ss._INET_DIAG_MSG.pack(
+                socket.AF_INET, state, 0, 0, socket.htons(443),
+                socket.htons(50000), lo, lo, 0, b'\0' * 8, 0, 0, 0, 0, 0)
+            msgs.append(ss._NLMSG.pack(ss._NLMSG.size + len(msg), 20, 2, 1,
+                                       0) + msg)
+        msgs.append(ss._NLMSG.pack(ss._NLMSG.size + 4, ss._NLMSG_DONE, 2, 1,
+                                   0) + b'\0' * 4)
+        records, done = ss._parse_inet_diag(b''.join(msgs), 'tcp')
+        self.assertTrue(done)
+        self.assertEqual([x.state for x in records],
+                         ['TIME-WAIT', 'TIME-WAIT', 'ESTAB'])
+        self.assertEqual(ss.format_sssum(records),
+                         ['Total: 3', 'TCP:   3 (estab 1, listen 0, '
+                          'timewait 2)  UDP: 0'])
+
+    def test_replay_ss(self):
+        '''The sockets replay from their raw inputs, or from a sysroot'''
+        self.assertTrue(ss._nlmsg_done(self.inetdiag))
+        self.assertFalse(ss._nlmsg_done(self.inetdiag[:124]))
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        probes = [x for x in ss._PROBES if x[0] == 'ss']
+        root = os.path.join(tmp, 'root')
+        os.makedirs(os.path.join(root, 'proc', 'net'))
+        for f, data in (('tcp', self.procnettcp), ('udp', '')):
+            with open(os.path.join(root, 'proc', 'net', f), 'w') as xf:
+                xf.write(data)
+        scan = ss.replay(root, probes)['ss']
+        self.assertEqual(scan.states, {('tcp', 'ESTAB'): 1,
+                                       ('tcp', 'LISTEN'): 1})
+        self.assertEqual(scan.listeners[0][6], '')
+        # A netlink dump is recorded as the replies, and parsed on replay
+        os.makedirs(os.path.join(root, '.ss.py'))
+        for name, data in (
+                ('inet_diag', [['tcp', hexlify(self.inetdiag).decode()]]),
+                ('socket_owners', {'914': self.inetdiagrecords[0][6]})):
+            with open(os.path.join(root, '.ss.py', name + '.json'),
+                      'w') as xf:
+                json.dump(data, xf)
+        scan = ss.replay(root, probes)['ss']
+        self.assertEqual(scan.states, {('tcp', 'ESTAB'): 1,
+                                       ('tcp', 'LISTEN'): 1})
+        self.assertEqual(scan.listeners[0][6], self.inetdiagrecords[0][6])
+
+    def test_ssutn_records(self):
+        '''SsRecords and ss lines are counted the same way'''
+        self.assertEqual(
+            [list(x) for x in ss.format_ssutn(self.procnetrecords)],
+            [['      1 42337'], ['      1 7700']])
+        # No records are taken for the header of 'ss' output
+        self.assertEqual(
+            [list(x) for x in ss.format_ssutn(self.procnetrecords[1:] * 20)],
+            [['      20 42337'], ['      20 7700']])
+
+    def test_parse_proc_stat(self):
+        '''Parse /proc/<pid>/stat, even with odd process names'''
+        self.assertEqual(ss._parse_proc_stat(self.procstat),
+                         self.procstatrec)
+
+    def test_cpu_usage(self):
+        '''Work out the time spent by every CPU from two samples'''
+        prev = ss._parse_cpu_stat(
+            'cpu  100 0 100 800 0 0 0 0 0 0\n'
+            'cpu0 50 0 50 400 0 0 0 0 0 0\n'
+            'cpu1 50 0 50 400 0 0 0\n'
+            'intr 1 2 3\n')
+        self.assertEqual(prev[0], ['cpu', 'cpu0', 'cpu1'])
+        self.assertEqual(len(prev[1]), 3 * ss._CPU_TICKS)
+        cur = ss._parse_cpu_stat(
+            'cpu  160 10 120 860 20 0 20 10 0 0\n'
+            'cpu0 110 10 60 400 0 0 20 0 0 0\n'
+            'cpu1 50 0 60 460 20 0 0 10 0 0\n')
+        names, pcts = ss._cpu_usage(prev, cur)
+        self.addCleanup(ss._set_colors, bool(ss.bcolors.S))
+        ss._set_colors(False)
+        self.assertEqual(list(pcts[:7]), [35, 10, 10, 0, 10, 5, 60])
+        self.assertEqual(list(pcts[7:14]), [70, 10, 0, 0, 20, 0, 100])
+        self.assertEqual(list(pcts[14:]), [0, 10, 20, 0, 0, 10, 20])
+        lines = ss.format_cpu((names, pcts))
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[2].startswith('cpu0       70.0'))
+        lines = ss.format_cpu((names, pcts), n=1)
+        self.assertEqual([x.split()[0] for x in lines],
+                         ['CPU', 'all', 'cpu0', '(and'])
+
+    def test_proc_sample(self):
+        '''We and our children are not in the process samples'''
+        child = ss.subprocess.Popen(['sleep', '10'])
+        self.addCleanup(child.wait)
+        self.addCleanup(child.kill)
+        pids = [x[0] for x in getattr(ss, '__proc_sample')(full=False)]
+        self.assertIn(str(os.getppid()), pids)
+        self.assertNotIn(str(os.getpid()), pids)
+        self.assertNotIn(str(child.pid), pids)
+
+    def test_top_procs(self):
+        '''Find the top processes of each metric from two samples'''
+        prev = {('1', 5): (b'init', 100, 0, 0, 0),
+                ('2', 9): (b'nginx', 1000, 0, 0, 0)}
+        cur = {('1', 5): (b'init', 150, 8000, 0, 50),
+               ('2', 9): (b'nginx', 1100, 400000, 1024, 12),
+               ('3', 400): (b'make', 20, 2000, 0, 3)}
+        top = ss._top_procs(prev, cur, 2.0, n=2, hz=100)
+        self.assertEqual([(x.comm, x.cpu) for x in top['cpu']],
+                         [('nginx', 50.0), ('init', 25.0)])
+        self.assertEqual([x.pid for x in top['rss']], [2, 1])
+        self.assertEqual([x.pid for x in top['swap']], [2])
+        self.assertEqual([x.fds for x in top['fds']], [50, 12])
+        self.assertEqual(ss._top_procs({}, cur, 0)['cpu'], [])
+        lines = ss.format_top(top)
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[2].startswith('init'))
+        self.assertTrue(lines[1].endswith('init            50'))
+
+    def test_format_w(self):
+        '''Build the w user table ourselves'''
+        hz = os.sysconf('SC_CLK_TCK')
+        now = 1399570656 + 3600
+        user = dict(self.utmpdict, type=7, User='wgiokas', Line='pts/3',
+                    Hostname='', PID=21000)
+        procs = [ss.ProcStat(21000, 'zsh', 'S', 1, 21000, 21000, 34819,
+                             21004, 2 * hz, hz, 10, '-zsh'),
+                 ss.ProcStat(21004, 'vim', 'S', 21000, 21004, 21000, 34819,
+                             21004, hz, 0, 20, 'vim ss.py'),
+                 ss.ProcStat(21005, 'vim', 'S', 1, 21005, 21005, 34818,
+                             21005, hz, 0, 20, 'vim test_ss.py')]
+        w = ss.format_w('0.09 0.15 0.21 1/100 2000', '18001.21 1000.00',
+                        [self.utmpdict, user], procs=procs,
+                        ttys={'pts/3': (34819, now - 75)}, now=now)
+        self.assertEqual(w[0], ' {0} up 5:00:01, 1 user, load average: '
+                         '0.09, 0.15, 0.21'.format(
+                             time.strftime('%H:%M:%S', time.localtime(now))))
+        self.assertEqual(w[1].split(), ['USER', 'TTY', 'FROM', 'LOGIN@',
+                                        'IDLE', 'JCPU', 'PCPU', 'WHAT'])
+        self.assertEqual(w[2].split(), [
+            'wgiokas', 'pts/3', '-',
+            time.strftime('%H:%M', time.localtime(1399570656)),
+            '1:15', '4.00s', '1.00s', 'vim', 'ss.py'])
+
     def test_parse_utmp(self):
         '''Make sure utmp is working right'''
         self.assertDictEqual(ss._parse_utmp(self.utmpbytes)[0],
                              self.utmpdict)
 
+    def test_parse_utmp_records(self):
+        '''Records behave like the utmp dicts, and can be filtered by type'''
+        user = struct.pack('h', 7) + self.utmpbytes[2:]
+        records = ss._parse_utmp_records(self.utmpbytes + user)
+        self.assertEqual([x['type'] for x in records], [2, 7])
+        self.assertDictEqual(records[0].asdict(), self.utmpdict)
+        self.assertEqual(records[0]['User'], 'reboot')
+        self.assertEqual(records[0].raw('Line')[:2], b'~\x00')
+        records = ss._parse_utmp_records(memoryview(self.utmpbytes + user),
+                                         types=(ss.USER_PROCESS,))
+        self.assertEqual([x['type'] for x in records], [7])
+        self.assertEqual(records[0]['Hostname'], '3.14.3-1-ARCH')
+
+    def test_parse_utmp_mmap(self):
+        '''The utmp can be parsed straight from an mmap of the file'''
+        user = struct.pack('h', 7) + self.utmpbytes[2:]
+        with tempfile.TemporaryFile() as f:
+            f.write(self.utmpbytes + user)
+            f.flush()
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                records = ss._parse_utmp_records(m, types=(ss.USER_PROCESS,))
+                self.assertEqual([x['User'] for x in records], ['reboot'])
+                self.assertEqual(records[0]['type'], 7)
+                self.assertEqual(len(ss._parse_utmp(m)), 2)
+            finally:
+                del records
+                m.close()
+
+    def test_parse_cache(self):
+        '''Files are only parsed again once they change'''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'cache')
+        parsed = []
+
+        def parse(f):
+            parsed.append(f)
+            with open(f) as xf:
+                return xf.read().split()
+        files = [os.path.join(tmp, x) for x in ('a', 'b')]
+        for f in files:
+            with open(f, 'w') as xf:
+                xf.write('x y')
+        cache = ss.ParseCache(path, size=1)
+        self.assertEqual(cache.get(files[0], parse), ['x', 'y'])
+        # Persisted, and read back by the next process.
+        cache = ss.ParseCache(path, size=1)
+        self.assertEqual(cache.get(files[0], parse), ['x', 'y'])
+        self.assertEqual(parsed, files[:1])
+        self.assertEqual(oct(os.stat(path).st_mode & 0o777), oct(0o600))
+        self.assertEqual(sorted(os.listdir(tmp)), ['a', 'b', 'cache'])
+        # Nothing is written where anyone else could have put something.
+        shared = os.path.join(tmp, 'shared')
+        os.mkdir(shared)
+        os.chmod(shared, 0o777)
+        victim = os.path.join(tmp, 'victim')
+        os.symlink(victim, os.path.join(shared, 'cache.{0}.tmp'.format(
+            os.getpid())))
+        ss.ParseCache(os.path.join(shared, 'cache')).get(files[1], parse)
+        self.assertFalse(os.path.exists(victim))
+        self.assertFalse(os.path.exists(os.path.join(shared, 'cache')))
+        with open(files[0], 'a') as xf:
+            xf.write(' z')
+        self.assertEqual(cache.get(files[0], parse), ['x', 'y', 'z'])
+        # Only one file fits, so 'a' is evicted.
+        cache.get(files[1], parse)
+        cache.get(files[0], parse)
+        self.assertEqual(parsed, (files[:1] + files[1:]) * 2 + files[:1])
+        # The utmp records are kept as their bytes.
+        user = utmp_record(ss.USER_PROCESS, 'root', 'pts/0', 'host', 1000)
+        records = ss._parse_utmp_records(self.utmpbytes + user,
+                                         types=(ss.USER_PROCESS,))
+        self.assertEqual(records[0].tobytes(), user)
+
+    def test_capture_replay(self):
+        '''A capture replays to the same data, from the archive or a tree'''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        archive = os.path.join(tmp, 'capture.tar')
+        probes = [x for x in ss._PROBES
+                  if x[0] in ('hostname', 'loadavg', 'meminfo', 'release')]
+        data = ss.capture(archive, probes)
+        self.assertEqual(ss.replay(archive, probes), data)
+        self.assertEqual(ss.Replay(archive).listdir('/proc'),
+                         ['loadavg', 'meminfo'])
+        root = os.path.join(tmp, 'root')
+        os.makedirs(os.path.join(root, 'proc'))
+        with open(os.path.join(root, 'proc', 'loadavg'), 'w') as f:
+            f.write('0.09 0.15 0.21 1/100 2000\n')
+        data = ss.replay(root, probes)
+        self.assertEqual(data['loadavg'], '0.09 0.15 0.21 1/100 2000\n')
+        self.assertTrue(isinstance(data['meminfo'], IOError))
+        self.assertEqual(data['release'], None)
+
+    def test_parse_wtmp(self):
+        '''Read a window of wtmp backwards'''
+        self.assertEqual(
+            [x['time_s'] for x in ss._parse_wtmp(self.wtmpbytes)],
+            [1050, 1040, 1030, 1020, 1010, 1000])
+        self.assertEqual(
+            [x['Line'] for x in ss._parse_wtmp(self.wtmpbytes, 1015, 1040,
+                                               types=(ss.USER_PROCESS,))],
+            ['pts/1', 'pts/0'])
+        self.assertEqual(
+            list(ss._parse_wtmp(self.wtmpbytes, since=1051)), [])
+
+    def test_format_last(self):
+        '''Recent logins, reboots and failed logins'''
+        last = ss.format_last(self.wtmpbytes, self.wtmpbytes[384:],
+                              since=1000, now=1045, n=2)
+        self.assertEqual([x.split()[0] for x in last],
+                         ['Logins', 'wgiokas', 'root', 'Reboots:',
+                          time.strftime('%a', time.localtime(1000)),
+                          'Failed', '1', '1', '1'])
+        self.assertEqual(last[5], 'Failed logins: 4')
+
     def test_parse_utmp_fail(self):
         '''Fail when the bytes are a bad length'''
         with self.assertRaises(ss.UtmpLengthError):
             ss._parse_utmp(b'\x00\x01')
 
+    def test_collect(self):
+        '''Hung and broken probes don't hold up the others'''
+        start = time.time()
+        data = ss.collect([('fast', lambda: 1, 1),
+                           ('hung', lambda: time.sleep(5), 0.1),
+                           ('broken', lambda: 1 / 0, 1)])
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(data['fast'], 1)
+        self.assertIsInstance(data['hung'], ss.ProbeTimeout)
+        self.assertIsInstance(data['broken'], ZeroDivisionError)
+        report = ss.render(data, [('one', ('fast',), str),
+                                  ('two', ('fast', 'hung'), str)])
+        self.assertEqual(report.splitlines()[1:4:2],
+                         ['1', '{0}two: hung: timed out after 0.1s{1}'.format(
+                             ss.bcolors.RED, ss.bcolors.S)])
+
+    def test_profiler(self):
+        '''Every probe and section is measured while profiling'''
+        probes = [x for x in ss._PROBES if x[0] == 'loadavg'] + [
+            ('alloc', lambda: len([0] * 100000), 1)]
+        with ss.Profiler() as p:
+            data = ss.collect(probes)
+            ss.render(data, [('load', ('loadavg',), str)])
+        self.assertIsNone(ss._profiler)
+        self.assertEqual(sorted(p.stats),
+                         ['probe:alloc', 'probe:loadavg', 'section:load'])
+        self.assertEqual(p.stats['probe:loadavg'].bytes,
+                         len(data['loadavg']))
+        self.assertEqual(p.stats['probe:loadavg'].subprocesses, 0)
+        if p.stats['probe:alloc'].peak is not None:
+            self.assertGreater(p.stats['probe:alloc'].peak, 100000 * 8)
+        lines = ss.format_profile(p.stats)
+        self.assertEqual(lines[0].split(),
+                         ['Profile', 'wall', 'cpu', 'subproc', 'read', 'peak'])
+        self.assertEqual(len(lines), 4)
+
+    def test_select_sections(self):
+        '''Only the probes of the sections asked for are run'''
+        self.assertEqual([x[0] for x in ss.select_sections('mem,disk')],
+                         ['disk', 'mem'])
+        self.assertEqual(
+            [x[0] for x in ss.select_sections(exclude='host, ip,w')],
+            ['cpu', 'last', 'disk', 'io', 'mem', 'top', 'conn', 'conc',
+             'peers', 'listen'])
+        self.assertEqual(
+            [x[0] for x in ss.select_sections(['conn', 'conc'], ['conc'])],
+            ['conn'])
+        self.assertRaises(ValueError, ss.select_sections, 'mem,memory')
+        self.assertEqual(
+            [x[0] for x in ss.section_probes(ss.select_sections('w,mem'))],
+            ['loadavg', 'uptime', 'users', 'procs', 'meminfo'])
+        self.assertEqual(
+            [x[0] for x in ss.section_probes(ss.select_sections('conn,conc'))],
+            ['ss'])
+
+    def test_from_daemon_untrusted(self):
+        '''Only a daemon socket in a private directory is asked'''
+        from_daemon = getattr(ss, '__from_daemon')
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'sock')
+            with open(path, 'w'):
+                pass
+            self.assertRaises(socket.error, from_daemon, path)
+            os.chmod(d, 0o777)
+            self.assertRaises(OSError, from_daemon, path)
+            self.assertRaises(OSError, ss._runtime_dir, path, True)
+            os.chmod(d, 0o700)
+            os.unlink(path)
+            ss._runtime_dir(os.path.join(d, 'sub', 'sock'), create=True)
+            self.assertEqual(os.stat(os.path.join(d, 'sub')).st_mode & 0o777,
+                             0o700)
+        finally:
+            os.chmod(d, 0o700)
+            shutil.rmtree(d)
+
+    def test_snapshot_cache(self):
+        '''Probes are only re-run once their TTL is up'''
+        runs = []
+        cache = ss.SnapshotCache(
+            [('slow', lambda: runs.append('slow') or len(runs), 1),
+             ('fast', lambda: runs.append('fast') or len(runs), 1)],
+            {'slow': 3600, 'fast': 0},
+            [('both', ('slow', 'fast'), lambda a, b: 'slow fast')])
+        self.assertEqual(sorted(cache.refresh()), ['fast', 'slow'])
+        self.assertEqual(cache.refresh(), ['fast'])
+        self.assertEqual(sorted(runs), ['fast', 'fast', 'slow'])
+        self.assertEqual(cache.answers['text'].splitlines()[1], b'slow fast')
+        self.assertEqual(json.loads(cache.answers['json'].decode())['slow'],
+                         cache.data['slow'])
+
+    def test_jsonable(self):
+        '''Collected data can be turned into JSON'''
+        scan = ss._scan_ss(self.ssout)
+        data = json.loads(json.dumps(ss._jsonable(
+            {'ss': scan, 'err': ss.ProbeTimeout('timed out'),
+             'utmp': ss._parse_utmp_records(self.utmpbytes)})))
+        self.assertEqual(data['ss']['states'],
+                         {'tcp ESTAB': 6, 'tcp LISTEN': 2})
+        self.assertEqual(data['ss']['listeners'][0]['local'],
+                         '127.0.0.1:33265')
+        self.assertEqual(data['err'], {'error': 'timed out',
+                                       'type': 'ProbeTimeout'})
+        self.assertEqual(data['utmp'][0]['addr'], '0' * 32)
+        self.assertEqual(data['utmp'][0]['User'], 'reboot')
+        # Binary that isn't text, even where bytes is str.
+        self.assertEqual(ss._jsonable({'raw': b'\xff\x00'}), {'raw': 'ff00'})
+
+    def test_format_metrics(self):
+        '''Prometheus gauges from the collected data'''
+        meminfo = ss._parse_mem(self.micromem + '\nHugePages_Total: 2')
+        metrics = ss.format_metrics({
+            'meminfo': meminfo,
+            'usage': [self.dfout_okay, self.dfout_base + [None]],
+            'loadavg': '0.09 0.15 0.21 1/100 2000',
+            'users': ([self.utmpdict], {}),
+            'ss': ss._scan_ss(self.ssout),
+            'ip': ss.ProbeTimeout('timed out')}, ports=1).splitlines()
+        for line in ['ss_probe_success{probe="ip"} 0',
+                     'ss_probe_success{probe="ss"} 1',
+                     'ss_memory_bytes{field="MemTotal"} 8254377984',
+                     'ss_memory_hugepages{field="HugePages_Total"} 2',
+                     'ss_filesystem_stale{device="/dev/sda1",'
+                     'mountpoint="/"} 1',
+                     'ss_filesystem_size_bytes{device="/dev/sda1",'
+                     'mountpoint="/"} 409600',
+                     'ss_load15 0.21',
+                     'ss_users 1',
+                     'ss_sockets{netid="tcp",state="ESTAB"} 6',
+                     'ss_established_connections{direction="in",'
+                     'port="55151"} 3',
+                     'ss_established_connections{direction="out",'
+                     'port="993"} 3']:
+            self.assertIn(line, metrics)
+        self.assertEqual(len([x for x in metrics
+                              if x.startswith('ss_established')]), 2)
+
+    def test_parse_snmp(self):
+        '''The counters of /proc/net/snmp by protocol'''
+        snmp = ss._parse_snmp(
+            'Ip: Forwarding DefaultTTL\nIp: 2 64\n'
+            'Tcp: RtoAlgorithm ActiveOpens PassiveOpens MaxConn\n'
+            'Tcp: 1 9 8 -1\n')
+        self.assertEqual(snmp['Tcp']['ActiveOpens'], 9)
+        self.assertEqual(snmp['Tcp']['MaxConn'], -1)
+        self.assertEqual(snmp['Ip'], {'Forwarding': 2, 'DefaultTTL': 64})
+
+    def test_rates(self):
+        '''What changed per second between two snapshots'''
+        mem = ss._parse_mem(self.micromem)
+        prev = {'ss': ss._scan_ss(self.ssout[:-1]),
+                'snmp': {'Tcp': {'ActiveOpens': 10, 'PassiveOpens': 100}},
+                'usage': [self.dfout_okay], 'meminfo': mem,
+                'ip': ss.ProbeTimeout('timed out')}
+        cur = {'ss': ss._scan_ss(self.ssout),
+               'snmp': {'Tcp': {'ActiveOpens': 14, 'PassiveOpens': 120}},
+               'usage': [self.dfout_warn], 'meminfo': mem, 'ip': ''}
+        rates = ss._rates(prev, cur, 2)
+        self.assertEqual(rates['ActiveOpens'], 2)
+        self.assertEqual(rates['PassiveOpens'], 10)
+        self.assertEqual(rates['disk'], {'/': 84 * 4096 / 2})
+        self.assertEqual(rates['mem'], 0)
+        lines = ss.format_rates(rates)
+        self.assertEqual(lines[1],
+                         'New TCP connections: 12.0 (2.0 active, '
+                         '10.0 passive)')
+        self.assertIn('  +168K /', lines)
+        self.assertEqual(lines[-1], 'Memory used: 0B')
+
     def test_parse_release_rh(self):
         '''Make sure the different redhat-release files are parsed right'''
         self.assertDictEqual(
@@ -180,7 +1036,6 @@ MemAvailable:    5763740 kB'''
         self.assertDictEqual(
             ss.parse_release(self.lsb_release), self.lsb_release_dict)
 
-    # TODO: format_w tests (makes extensive use of time.*)
     # TODO: format_mem and format_swap tests
 
 